@@ -14,10 +14,10 @@ export async function POST(request: Request) {
     return NextResponse.json({ error: "No autenticado" }, { status: 401 });
   }
 
-  const { documentUrl, originalFileName } = await request.json();
+  const { documentId, documentUrl, originalFileName } = await request.json();
 
-  if (!documentUrl || !originalFileName) {
-    return NextResponse.json({ error: "Falta documentUrl o originalFileName" }, { status: 400 });
+  if (!documentId || !documentUrl || !originalFileName) {
+    return NextResponse.json({ error: "Falta documentId, documentUrl o originalFileName" }, { status: 400 });
   }
 
   try {
@@ -32,6 +32,9 @@ export async function POST(request: Request) {
       body: JSON.stringify({
         document_url: documentUrl, // URL del documento a firmar (ej. de Supabase Storage)
         original_file_name: originalFileName, // Nombre original del archivo
+        document_id: documentId, // Clave de revisiones e índice; dos archivos con el mismo nombre no se mezclan
+        user_id: user.id, // Identidad de la sesión (cubeta de admisión); nunca la que mande el navegador
+        lane: "interactive", // Firma desde la interfaz; los lotes usan "bulk"
         // Aquí puedes pasar información adicional que tu servicio PyHanko pueda necesitar:
         // - Detalles del firmante (obtenidos de 'user' o pasados desde el frontend)
         // - Tipo de firma (ej. PAdES B-T, B-LT, B-LTA)
@@ -66,7 +69,7 @@ export async function POST(request: Request) {
     //     signed_by_user_id: user.id,
     //     signed_file_name: signedDocumentData.new_file_name
     //   })
-    //   .eq("storage_url", documentUrl); // O usa el ID del documento si lo tienes
+    //   .eq("id", documentId);
 
     return NextResponse.json({
       message: "Documento enviado al servicio de firma. El proceso puede ser asíncrono.",
@@ -1,8 +1,10 @@
-import subprocess
 import os
-from pyhanko.sign import signers
-from pyhanko.sign.fields import SigFieldSpec
-from pyhanko.sign.signers import PdfSigner, PdfSignatureMetadata
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "scripts"))
+from pfx_cache import load_pkcs12_signer
 
 # ---------- ARCHIVOS ----------
 input_pdf = 'documento.pdf'
@@ -12,51 +14,88 @@ cert_file = 'certificate.crt'
 pfx_file = 'certificado.p12'
 pfx_password = '123456'  # Puedes cambiar esta contraseña
 
-# ---------- 1. Generar clave y certificado autofirmado con OpenSSL ----------
-if not os.path.exists(pfx_file):
-    print('🔐 Generando certificado autofirmado...')
-    
-    subprocess.run(['openssl', 'genrsa', '-out', key_file, '2048'], check=True)
-
-    subprocess.run([
-        'openssl', 'req', '-new', '-x509', '-key', key_file,
-        '-out', cert_file, '-days', '365',
-        '-subj', '/CN=Usuario Prueba/O=Organizacion Prueba/C=MX'
-    ], check=True)
-
-    subprocess.run([
-        'openssl', 'pkcs12', '-export',
-        '-out', pfx_file,
-        '-inkey', key_file,
-        '-in', cert_file,
-        '-passout', f'pass:{pfx_password}'
-    ], check=True)
-
-    print('✅ Certificado PFX generado con éxito.')
-
-# ---------- 2. Cargar certificado y firmar el PDF ----------
-print('✍️ Firmando PDF...')
-
-signer = signers.SimpleSigner.load_pkcs12(
-    pfx_file=pfx_file,
-    passphrase=pfx_password.encode()
-)
-
-signature_meta = PdfSignatureMetadata(
-    field_name='FirmaDigital',
-    reason='Firma de prueba generada automáticamente',
-    location='Script Python',
-    signer_name='Usuario Prueba',
-)
-
-pdf_signer = PdfSigner(
-    signature_meta=signature_meta,
-    signer=signer,
-    existing_fields_only=False,
-    new_field_spec=SigFieldSpec(sig_field_name='FirmaDigital')
-)
-
-with open(input_pdf, 'rb') as inf, open(output_pdf, 'wb') as outf:
-    pdf_signer.sign_pdf(inf, outf)
-
-print(f'✅ PDF firmado: {output_pdf}')
+
+# ---------- 1. Generar clave, certificado autofirmado y PKCS#12 (en proceso, sin openssl) ----------
+def generar_pfx(pfx_path, password, common_name='Usuario Prueba', organization='Organizacion Prueba', country='MX'):
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.primitives.serialization import pkcs12
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    subject = x509.Name([
+        x509.NameAttribute(NameOID.COMMON_NAME, common_name),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, organization),
+        x509.NameAttribute(NameOID.COUNTRY_NAME, country),
+    ])
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(private_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(datetime.utcnow())
+        .not_valid_after(datetime.utcnow() + timedelta(days=365))
+        .sign(private_key, hashes.SHA256())
+    )
+
+    # Mismos archivos que generaba openssl: clave y certificado PEM además del PFX
+    with open(key_file, 'wb') as f:
+        f.write(private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption(),
+        ))
+    with open(cert_file, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(pfx_path, 'wb') as f:
+        f.write(pkcs12.serialize_key_and_certificates(
+            name=common_name.encode(),
+            key=private_key,
+            cert=certificate,
+            cas=None,
+            encryption_algorithm=serialization.BestAvailableEncryption(password.encode()),
+        ))
+
+
+# ---------- 2. Firmar un PDF (el PFX se descifra una sola vez por proceso) ----------
+def firmar_pdf(input_path, output_path):
+    from pyhanko.sign.fields import SigFieldSpec
+    from pyhanko.sign.signers import PdfSigner, PdfSignatureMetadata
+    from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter
+
+    signer = load_pkcs12_signer(pfx_file, pfx_password)
+
+    signature_meta = PdfSignatureMetadata(
+        field_name='FirmaDigital',
+        reason='Firma de prueba generada automáticamente',
+        location='Script Python',
+        name='Usuario Prueba',
+    )
+
+    pdf_signer = PdfSigner(
+        signature_meta=signature_meta,
+        signer=signer,
+        new_field_spec=SigFieldSpec(sig_field_name='FirmaDigital')
+    )
+
+    with open(input_path, 'rb') as inf, open(output_path, 'wb') as outf:
+        pdf_signer.sign_pdf(IncrementalPdfFileWriter(inf), existing_fields_only=False, output=outf)
+
+
+if __name__ == '__main__':
+    if not os.path.exists(pfx_file):
+        print('🔐 Generando certificado autofirmado...')
+        generar_pfx(pfx_file, pfx_password)
+        print('✅ Certificado PFX generado con éxito.')
+
+    # Sin argumentos firma documento.pdf; con argumentos firma cada PDF como <nombre>_firmado.pdf
+    trabajos = [(input_pdf, output_pdf)]
+    if len(sys.argv) > 1:
+        trabajos = [(pdf, f'{os.path.splitext(pdf)[0]}_firmado.pdf') for pdf in sys.argv[1:]]
+
+    for entrada, salida in trabajos:
+        print(f'✍️ Firmando PDF {entrada}...')
+        firmar_pdf(entrada, salida)
+        print(f'✅ PDF firmado: {salida}')
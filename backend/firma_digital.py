@@ -2,15 +2,17 @@
 import sys #Accede a los argumentos desde la línea de comandos (gestiona archivos desde la terminal)
 from pathlib import Path #Permite trabajar con rutas de archivos (utilizado para el pdf) (gestiona archivos desde la terminal)
 from os.path import exists #Comprueba si existe un archivo (gestiona archivos desde la terminal)
-from pyhanko.sign import signers #Permite firmar y verificar el PDF
-from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter #Permite editar el PDF
-from pyhanko.pdf_utils.reader import PdfFileReader #Permite leer y analizar archivos PDF
-from PyPDF2 import PdfReader, PdfWriter  #Permite manipular leer y escribir metadatos en el PDF
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "scripts")) #Permite usar los módulos compartidos de scripts/
+from pdf_precheck import precheck_pdf_file, PdfPrecheckError #Pre-chequeo estructural rápido del PDF (antes del parser completo)
+from audit_log import audit #Registro de auditoría encadenado por hash (no bloquea la firma)
+import signature_fields #Campos de firma pre-asignados (mismos nombres y ubicación que el backend)
+#pyhanko y PyPDF2 se importan dentro de cada función para que cada acción cargue solo lo que usa
 
 #FUNCIONES PARA LOS METADATOS
 
 #Establece un límite de firmas en el PDF
 def set_max_signers(pdf_path: str, max_signers: int):
+    from PyPDF2 import PdfReader, PdfWriter #Permite manipular leer y escribir metadatos en el PDF
     reader = PdfReader(pdf_path) #Abre el PDF
     writer = PdfWriter() #Crea un nuevo escritor de PDF para añadir metadatos
     for page in reader.pages: #Itera sobre las páginas del PDF original
@@ -21,9 +23,28 @@ def set_max_signers(pdf_path: str, max_signers: int):
     with open(pdf_path, "wb") as f: #Abre el PDF en modo escritura binaria
         writer.write(f) #Escribe el PDF con los metadatos actualizados
     print(f"🔐 Límite de firmas ({max_signers}) guardado en el PDF.") #Conformación de guardado
+    prepare_signature_fields(pdf_path, max_signers) #Crea de una vez los campos de firma vacíos para todos los firmantes
+
+#Crea los campos de firma vacíos Signature1..SignatureN (una sola vez, al fijar el límite)
+#Así cada firmante solo llena un campo existente y su actualización incremental es más pequeña
+def prepare_signature_fields(pdf_path: str, max_signers: int):
+    created = signature_fields.prepare_signature_fields_file(pdf_path, max_signers) #Solo escribe si falta algún campo
+    if created: #Informa solo cuando se agregó una actualización al PDF
+        print(f"🖊️ {len(created)} campo(s) de firma preparados en el PDF.") #Confirmación
+    return created
+
+#Devuelve True si el PDF ya tiene un campo de firma vacío con ese nombre
+def has_empty_field(pdf_path: str, field_name: str) -> bool:
+    from pyhanko.sign import fields #Permite enumerar campos de firma
+    from pyhanko.pdf_utils.reader import PdfFileReader #Permite leer y analizar archivos PDF
+
+    with open(pdf_path, 'rb') as f: #Abre el PDF en modo lectura binaria
+        reader = PdfFileReader(f) #Crea un lector de PDF
+        return any(name == field_name for name, _, _ in fields.enumerate_sig_fields(reader, filled_status=False)) #Busca el campo vacío
 
 #Lanza un error si no encuentra ese dato
 def get_max_signers(pdf_path: str) -> int:
+    from PyPDF2 import PdfReader #Permite leer los metadatos del PDF
     reader = PdfReader(pdf_path) #Lee los metadatos del PDF
     metadata = reader.metadata #Extrae los metadatos del PDF
     max_signers = metadata.get("/MaxSigners") #Analiza el metadato personalizado del PDF
@@ -40,8 +61,12 @@ def sign_pdf_inplace(
     cert_path: str, #Ruta al certificado digital (cert.pem)
     ca_chain_paths: tuple = (), #Cadena de certificados intermedios
     passphrase: str = None, #Contraseña del archivo (key.pem)
-    field_name: str = "Signature1" #Define metadatos de la firma (nombre del campo de firma)
+    field_name: str = "Signature1", #Define metadatos de la firma (nombre del campo de firma)
+    existing_fields_only: bool = False, #True si el campo ya fue pre-asignado y solo hay que llenarlo
+    precheck: bool = True #False si quien llama ya hizo el pre-chequeo del mismo archivo
 ) -> None:
+    from pyhanko.sign import signers #Permite firmar y verificar el PDF
+    from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter #Permite editar el PDF
 
     if not exists(pdf_path): #Comprueba si el PDF existe
         raise FileNotFoundError(f"PDF no encontrado: {pdf_path}") #Si no existe el PDF lanza un error
@@ -49,6 +74,8 @@ def sign_pdf_inplace(
         raise FileNotFoundError(f"Clave privada no encontrada: {key_path}") #Si no existe la clave privada lanza un error
     if not exists(cert_path): #Comprueba si el certificado existe
         raise FileNotFoundError(f"Certificado no encontrado: {cert_path}") #Si no existe el certificado lanza un error
+    if precheck: #Rechaza PDFs truncados, no-PDFs o demasiado grandes antes de parsearlos
+        precheck_pdf_file(pdf_path)
 
     signer = signers.SimpleSigner.load( #Carga el firmante con la clave y el certificado
         key_path, #Carga la clave privada desde el archivo
@@ -71,21 +98,26 @@ def sign_pdf_inplace(
         pdf_signer.sign_pdf( #Firma el PDF
             writer, #Firma el PDF
             in_place=True, #Modifica el PDF original directamente
-            output=pdf_file #Escribe los cambios en el mismo archivo
+            output=pdf_file, #Escribe los cambios en el mismo archivo
+            existing_fields_only=existing_fields_only #No crea campos nuevos si el campo ya existe
         )
+    audit("sign", document_id=pdf_path, field_name=field_name, certificate=cert_path) #Registra la firma en la bitácora de auditoría
 
 #FUNCIÓN QUE VERIFICA LA FORMA EN EL PDF
 
 #Verifica si hay firmas en el PDF y muestra información sobre ellas
 def check_signatures(pdf_path: str) -> bool:
+    from pyhanko.pdf_utils.reader import PdfFileReader #Permite leer y analizar archivos PDF
     if not exists(pdf_path): #Comprueba si el PDF existe
         print(f"Error: PDF no encontrado en la ruta: {pdf_path}") #Si no existe el PDF lanza un error
         return False
 
     try:
+        precheck_pdf_file(pdf_path) #Rechaza PDFs malformados antes de parsearlos
         with open(pdf_path, 'rb') as f: #Abre el PDF en modo lectura binaria
             reader = PdfFileReader(f) #Crea un lector de PDF
             signatures = reader.embedded_signatures #Extrae las firmas incrustadas del PDF
+            audit("verify", document_id=pdf_path, total_signatures=len(signatures)) #Registra la verificación en la bitácora de auditoría
             if signatures: #Comprueba si hay firmas en el PDF
                 print(f"✅ Se encontraron {len(signatures)} firma(s) en '{pdf_path}':") #Si hay firmas, muestra la cantidad de firmas encontradas
                 for i, sig in enumerate(signatures): #Itera sobre las firmas encontradas
@@ -95,6 +127,9 @@ def check_signatures(pdf_path: str) -> bool:
             else:
                 print(f"⚠️ No se encontraron firmas en '{pdf_path}'.") #Si no hay firmas indica que no se encontraron firmas
                 return False
+    except PdfPrecheckError as e: #El PDF no pasó el pre-chequeo estructural
+        print(f"❌ PDF rechazado '{pdf_path}': {e.to_dict()}") #Muestra el error estructurado
+        return False
     except Exception as e: #Analiza los errores que ocurran al intentar leer el PDF
         print(f"❌ Error al verificar el PDF '{pdf_path}': {e}") #Si ocurre un error al leer el PDF lanza un mensaje de error
         return False
@@ -123,6 +158,13 @@ if __name__ == "__main__":
 
     pwd = sys.argv[4] if len(sys.argv) > 4 else None #Contraseña del archivo (key.pem) si se proporciona
 
+    # Rechaza PDFs malformados antes de cualquier parseo completo
+    try:
+        precheck_pdf_file(pdf_file) #Pre-chequeo estructural rápido
+    except PdfPrecheckError as e: #El PDF no pasó el pre-chequeo
+        print(f"❌ PDF rechazado: {e.to_dict()}") #Muestra el error estructurado
+        sys.exit(1) #Salir con error
+
     # Obtiene el límite de firmas desde el PDF
     try:
         max_signers = get_max_signers(pdf_file) #Obtiene el límite de firmas del PDF
@@ -130,6 +172,7 @@ if __name__ == "__main__":
         print(e) #Si ocurre un error al obtener el límite de firmas lanza un mensaje de error
         sys.exit(1) #Salir con error si ocurre un error al obtener el límite de firmas
 
+    from pyhanko.pdf_utils.reader import PdfFileReader #Permite leer y analizar archivos PDF
     with open(pdf_file, 'rb') as f: #Abre el PDF en modo lectura binaria
         reader = PdfFileReader(f) #Crea un lector de PDF
         existing_signatures = reader.embedded_signatures #Extrae las firmas incrustadas del PDF
@@ -141,7 +184,8 @@ if __name__ == "__main__":
 
     try:
         next_field = f"Signature{current_count + 1}" #Define el nombre del campo de firma para la siguiente firma
-        sign_pdf_inplace(pdf_file, key_file, cert_file, passphrase=pwd, field_name=next_field) #Firma el PDF con la clave y el certificado
+        prepared = has_empty_field(pdf_file, next_field) #Comprueba si el campo fue pre-asignado al fijar el límite
+        sign_pdf_inplace(pdf_file, key_file, cert_file, passphrase=pwd, field_name=next_field, existing_fields_only=prepared, precheck=False) #Firma el PDF con la clave y el certificado (el pre-chequeo ya se hizo arriba)
         print(f"✅ PDF firmado exitosamente por el firmante {current_count + 1}: '{pdf_file}'") #Si la firma se realiza correctamente lanza un mensaje de éxito
     except Exception as e: #Analiza los errores que ocurran al intentar firmar el PDF
         print(f"❌ Error al firmar el PDF: {e}") #Si ocurre un error al firmar el PDF lanza un mensaje de error
@@ -0,0 +1,87 @@
+// Idempotencia en memoria para rutas que el frontend reintenta (ver python_signing_service/idempotency.py)
+//
+// - Un duplicado que llega mientras la solicitud original sigue en curso espera esa misma promesa.
+// - Uno que llega después recibe el resultado guardado (TTL, acotado por número de entradas y por bytes:
+//   IDEMPOTENCY_MAX_BYTES, 64 MB por omisión). Un resultado mayor que una cuarta parte de ese límite
+//   (un PDF grande) no se guarda: solo se comparte con los duplicados que llegan mientras está en curso.
+// - Reusar una clave con otra solicitud (otra huella) lanza IdempotencyConflictError.
+// - Los resultados con status >= 500, 408 o 429 no se guardan: el reintento vuelve a intentarlo.
+//
+// El estado vive en el proceso del servidor de Next.js.
+
+export interface IdempotentOutcome {
+  status: number
+  body: Buffer | string
+  contentType: string
+}
+
+interface StoredOutcome {
+  fingerprint: string
+  expires: number
+  size: number
+  outcome: IdempotentOutcome
+}
+
+const DEFAULT_TTL_MS = 60 * 60 * 1000
+const DEFAULT_MAX_ENTRIES = 1000
+// Los resultados pueden ser PDFs completos: la memoria del proceso se acota por bytes, no por entradas
+const DEFAULT_MAX_BYTES = Number(process.env.IDEMPOTENCY_MAX_BYTES) || 64 * 1024 * 1024
+const RETRYABLE_STATUS = new Set([408, 429])
+
+const results = new Map<string, StoredOutcome>()
+let storedBytes = 0
+const inFlight = new Map<string, { fingerprint: string; promise: Promise<IdempotentOutcome> }>()
+
+export class IdempotencyConflictError extends Error {
+  constructor() {
+    super("La Idempotency-Key ya se usó con una solicitud distinta")
+  }
+}
+
+function forget(key: string) {
+  const stored = results.get(key)
+  if (stored) {
+    storedBytes -= stored.size
+    results.delete(key)
+  }
+}
+
+export async function runIdempotent(
+  key: string,
+  fingerprint: string,
+  compute: () => Promise<IdempotentOutcome>,
+  { ttlMs = DEFAULT_TTL_MS, maxEntries = DEFAULT_MAX_ENTRIES, maxBytes = DEFAULT_MAX_BYTES } = {},
+): Promise<{ outcome: IdempotentOutcome; replayed: boolean }> {
+  const stored = results.get(key)
+  if (stored && stored.expires > Date.now()) {
+    if (stored.fingerprint !== fingerprint) throw new IdempotencyConflictError()
+    // Map conserva el orden de inserción: reinsertar la deja como la más reciente
+    results.delete(key)
+    results.set(key, stored)
+    return { outcome: stored.outcome, replayed: true }
+  }
+  forget(key)
+
+  const running = inFlight.get(key)
+  if (running) {
+    if (running.fingerprint !== fingerprint) throw new IdempotencyConflictError()
+    return { outcome: await running.promise, replayed: true }
+  }
+
+  const promise = compute()
+    .then((outcome) => {
+      const size = Buffer.byteLength(outcome.body)
+      if (outcome.status < 500 && !RETRYABLE_STATUS.has(outcome.status) && size <= maxBytes / 4) {
+        results.set(key, { fingerprint, expires: Date.now() + ttlMs, size, outcome })
+        storedBytes += size
+        // Map conserva el orden de inserción: se descartan primero los usados hace más tiempo
+        while (results.size > maxEntries || storedBytes > maxBytes) {
+          forget(results.keys().next().value as string)
+        }
+      }
+      return outcome
+    })
+    .finally(() => inFlight.delete(key))
+  inFlight.set(key, { fingerprint, promise })
+  return { outcome: await promise, replayed: false }
+}
@@ -0,0 +1,297 @@
+"""
+Control de admisión del servicio de firma.
+
+Cada solicitud de firma o verificación pasa por tres filtros antes de ocupar
+memoria o CPU:
+
+1. Cubeta de tokens por (usuario, carril): un usuario que excede su tasa se
+   rechaza al instante con 429 y `Retry-After`.
+2. Límite global de concurrencia: como mucho `max_concurrency` solicitudes se
+   procesan a la vez; el resto espera en la cola de su carril.
+3. Carriles con planificación justa ponderada: "interactive" (una firma desde
+   la interfaz) y "bulk" (lotes). Cuando se libera un lugar se despacha el
+   carril con menor tiempo virtual, que avanza 1/peso por cada solicitud
+   despachada, así que un lote de cientos de documentos nunca deja sin turno a
+   las firmas interactivas. Una cola llena o una espera que excede
+   `max_wait` se rechaza con 503 y `Retry-After`.
+
+El carril lo decide el servidor: el `lane` del cliente solo puede pedir
+"bulk". Un usuario con `interactive_per_user` solicitudes interactivas ya en
+curso o en cola (una persona en la interfaz firma de a una) manda las
+siguientes al carril bulk, así que un lote que no se declara como tal no
+ocupa el carril interactivo. La identidad (`user_id`) la fija el llamador
+del lado del servidor (la ruta de Next.js, con la sesión de Supabase): el
+servicio no debe quedar expuesto a los navegadores.
+
+Todo el estado vive en el event loop del proceso: no hace falta ningún lock.
+"""
+
+import asyncio
+import collections
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Tuple
+
+import metrics
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+# Cubetas inactivas (llenas) que se descartan cuando hay más de este número de usuarios
+MAX_TRACKED_BUCKETS = 10000
+# Suavizado del tiempo de servicio promedio usado para estimar Retry-After
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+class AdmissionRejected(Exception):
+    """Solicitud rechazada sin procesarla: 429 por tasa de usuario, 503 por saturación."""
+
+    def __init__(self, status_code: int, reason: str, retry_after: float, lane: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.lane = lane
+
+    def headers(self) -> Dict[str, str]:
+        return {"Retry-After": str(self.retry_after)}
+
+
+class TokenBucket:
+    """Cubeta de tokens: `rate` tokens por segundo con capacidad `burst`."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """Consume un token; devuelve 0 si lo había, o los segundos que faltan para el siguiente."""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class Lane:
+    def __init__(self, name: str, weight: float, max_queue: int, max_wait: float,
+                 user_rate: float, user_burst: float):
+        self.name = name
+        self.weight = weight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.waiters = collections.deque()
+        self.virtual_time = 0.0
+
+
+class AdmissionController:
+    """Límite global de concurrencia con colas por carril y cubetas por usuario."""
+
+    def __init__(self, max_concurrency: int, lanes: Dict[str, Lane], clock=time.monotonic,
+                 interactive_per_user: int = 2):
+        self.max_concurrency = max_concurrency
+        self.lanes = lanes
+        self.clock = clock
+        self.interactive_per_user = interactive_per_user
+        self.in_flight = 0
+        self._interactive_active: Dict[str, int] = {}  # Solicitudes interactivas en curso o en cola por usuario
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._virtual_clock = 0.0
+        self._service_time = 1.0
+
+    # --- Estado ---
+    def queued(self) -> int:
+        return sum(len(lane.waiters) for lane in self.lanes.values())
+
+    def snapshot(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "lanes": {name: {"queued": len(lane.waiters), "weight": lane.weight} for name, lane in self.lanes.items()},
+        }
+
+    def _publish(self):
+        metrics.ADMISSION_IN_FLIGHT.set(self.in_flight)
+        for name, lane in self.lanes.items():
+            metrics.ADMISSION_QUEUE_DEPTH.set(len(lane.waiters), lane=name)
+
+    def _retry_after(self) -> float:
+        """Estimación del tiempo hasta que haya lugar, a partir del tiempo de servicio promedio."""
+        return (self.queued() + 1) * self._service_time / self.max_concurrency
+
+    def _reject(self, lane: Lane, status_code: int, reason: str, retry_after: float):
+        metrics.ADMISSION_REJECTED.inc(lane=lane.name, reason=reason)
+        raise AdmissionRejected(status_code, reason, retry_after, lane.name)
+
+    # --- Cubetas por usuario ---
+    def _take_user_token(self, user: str, lane: Lane, now: float) -> float:
+        key = (user, lane.name)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= MAX_TRACKED_BUCKETS:
+                for stale in [k for k, b in self._buckets.items() if b.is_full(now)]:
+                    del self._buckets[stale]
+            bucket = self._buckets[key] = TokenBucket(lane.user_rate, lane.user_burst, now)
+        return bucket.take(now)
+
+    # --- Planificación ---
+    def _grant(self, lane: Lane):
+        lane.virtual_time = max(lane.virtual_time, self._virtual_clock)
+        self._virtual_clock = lane.virtual_time
+        lane.virtual_time += 1.0 / lane.weight
+        self.in_flight += 1
+
+    def _dispatch(self):
+        """Despacha esperas mientras haya lugar: siempre el carril con menor tiempo virtual."""
+        while self.in_flight < self.max_concurrency:
+            pending = [lane for lane in self.lanes.values() if lane.waiters]
+            if not pending:
+                break
+            lane = min(pending, key=lambda candidate: max(candidate.virtual_time, self._virtual_clock))
+            future = lane.waiters.popleft()
+            if future.done():
+                continue  # Expiró o el cliente se desconectó
+            self._grant(lane)
+            future.set_result(None)
+        self._publish()
+
+    async def acquire(self, user: str, lane_name: str) -> float:
+        """Espera un lugar para `user` en el carril; devuelve los segundos de espera o lanza AdmissionRejected."""
+        lane = self.lanes.get(lane_name) or self.lanes[INTERACTIVE]
+        now = self.clock()
+
+        wait_for_token = self._take_user_token(user, lane, now)
+        if wait_for_token > 0:
+            self._reject(lane, 429, "user_rate", wait_for_token)
+
+        # Sin cola y con lugar: se admite sin ceder el event loop
+        if self.in_flight < self.max_concurrency and not self.queued():
+            self._grant(lane)
+            self._publish()
+            metrics.ADMISSION_WAIT_SECONDS.observe(0.0, lane=lane.name)
+            return 0.0
+
+        if len(lane.waiters) >= lane.max_queue:
+            self._reject(lane, 503, "queue_full", self._retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        lane.waiters.append(future)
+        self._publish()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), lane.max_wait)
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                self._discard(lane, future)
+                self._reject(lane, 503, "wait_timeout", self._retry_after())
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # Se otorgó el lugar justo cuando el cliente se fue
+            else:
+                future.cancel()
+                self._discard(lane, future)
+            raise
+        waited = self.clock() - now
+        metrics.ADMISSION_WAIT_SECONDS.observe(waited, lane=lane.name)
+        return waited
+
+    def _discard(self, lane: Lane, future):
+        try:
+            lane.waiters.remove(future)
+        except ValueError:
+            pass
+        self._publish()
+
+    def release(self, service_time: Optional[float] = None):
+        self.in_flight -= 1
+        if service_time is not None:
+            self._service_time += SERVICE_TIME_SMOOTHING * (service_time - self._service_time)
+        self._dispatch()
+
+    # --- Clasificación ---
+    def classify(self, user: str, requested: Optional[str]) -> str:
+        """Carril de la solicitud: bulk si se pide o si el usuario ya tiene su cupo interactivo ocupado."""
+        if requested == BULK:
+            return BULK
+        if self._interactive_active.get(user, 0) >= self.interactive_per_user:
+            metrics.ADMISSION_RECLASSIFIED.inc(lane=BULK)
+            return BULK
+        return INTERACTIVE
+
+    @asynccontextmanager
+    async def admit(self, user: Optional[str], lane_name: Optional[str]):
+        """Contexto que ocupa un lugar durante todo el procesamiento de la solicitud."""
+        user = user or "anonymous"
+        lane_name = self.classify(user, lane_name)
+        interactive = lane_name == INTERACTIVE
+        if interactive:
+            self._interactive_active[user] = self._interactive_active.get(user, 0) + 1
+        try:
+            await self.acquire(user, lane_name)
+            metrics.ADMISSION_ADMITTED.inc(lane=lane_name)
+            started = self.clock()
+            try:
+                yield
+            finally:
+                self.release(self.clock() - started)
+        finally:
+            if interactive:
+                remaining = self._interactive_active[user] - 1
+                if remaining:
+                    self._interactive_active[user] = remaining
+                else:
+                    del self._interactive_active[user]
+
+
+class _Unlimited:
+    """Controlador nulo para ADMISSION_ENABLED=0 (comparaciones en la prueba de carga)."""
+
+    @asynccontextmanager
+    async def admit(self, user, lane_name):
+        yield
+
+    def snapshot(self) -> dict:
+        return {"enabled": False}
+
+
+def controller_from_env():
+    """Configuración por variables de entorno; los valores por omisión favorecen al carril interactivo."""
+    if os.getenv("ADMISSION_ENABLED", "1") == "0":
+        return _Unlimited()
+    lanes = {
+        INTERACTIVE: Lane(
+            INTERACTIVE,
+            weight=float(os.getenv("ADMISSION_INTERACTIVE_WEIGHT", "4")),
+            max_queue=int(os.getenv("ADMISSION_INTERACTIVE_MAX_QUEUE", "64")),
+            max_wait=float(os.getenv("ADMISSION_INTERACTIVE_MAX_WAIT", "15")),
+            user_rate=float(os.getenv("ADMISSION_INTERACTIVE_USER_RATE", "2")),
+            user_burst=float(os.getenv("ADMISSION_INTERACTIVE_USER_BURST", "10")),
+        ),
+        BULK: Lane(
+            BULK,
+            weight=float(os.getenv("ADMISSION_BULK_WEIGHT", "1")),
+            max_queue=int(os.getenv("ADMISSION_BULK_MAX_QUEUE", "256")),
+            max_wait=float(os.getenv("ADMISSION_BULK_MAX_WAIT", "120")),
+            user_rate=float(os.getenv("ADMISSION_BULK_USER_RATE", "20")),
+            user_burst=float(os.getenv("ADMISSION_BULK_USER_BURST", "100")),
+        ),
+    }
+    max_concurrency = int(os.getenv("ADMISSION_MAX_CONCURRENCY", str(os.cpu_count() or 1)))
+    interactive_per_user = int(os.getenv("ADMISSION_INTERACTIVE_PER_USER", "2"))
+    return AdmissionController(max_concurrency, lanes, interactive_per_user=interactive_per_user)
@@ -0,0 +1,182 @@
+"""
+Prueba de carga local del control de admisión (admission.py).
+
+Levanta un worker del servicio de firma y mide la latencia de firmas
+interactivas (una a la vez, como desde la interfaz) primero en reposo y luego
+mientras varios clientes de lote envían firmas "bulk" sin parar (respetando
+Retry-After). Con los carriles ponderados el p99 interactivo debe mantenerse
+casi igual; con --compare_disabled se repite la fase con ADMISSION_ENABLED=0
+para ver la diferencia.
+
+Uso: python admission_load_test.py --interactive_requests 40 --bulk_clients 16 --max_p99_ratio 3
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from scale_test import SERVICE_DIR, PFX_PASSWORD, _free_port, _serve_documents, _start, _wait_healthy, _write_pfx
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else None
+
+
+def _sign(url: str, documents_url: str, document_id: str, user_id: str, lane: str):
+    payload = {
+        "document_url": f"{documents_url}/documento.pdf",
+        "original_file_name": f"{document_id}.pdf",
+        "document_id": document_id,
+        "user_id": user_id,
+        "lane": lane,
+    }
+    started = time.perf_counter()
+    response = httpx.post(f"{url}/sign_document", json=payload, timeout=300)
+    return response, time.perf_counter() - started
+
+
+def _interactive_phase(url: str, documents_url: str, requests: int, interval: float, tag: str) -> dict:
+    latencies, errors = [], 0
+    for i in range(requests):
+        response, latency = _sign(url, documents_url, f"{tag}-interactive-{i}", f"ui-user-{i % 8}", "interactive")
+        if response.status_code == 200:
+            latencies.append(latency)
+        else:
+            errors += 1
+        time.sleep(interval)
+    return {
+        "requests": requests,
+        "errors": errors,
+        "p50_ms": round(_percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+        "p99_ms": round(_percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+    }
+
+
+def _bulk_clients(url: str, documents_url: str, clients: int, stop: threading.Event, tag: str) -> dict:
+    counts = {"signed": 0, "rejected": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def client(index: int):
+        sequence = 0
+        while not stop.is_set():
+            sequence += 1
+            response, _ = _sign(url, documents_url, f"{tag}-bulk-{index}-{sequence}", "bulk-user", "bulk")
+            with lock:
+                if response.status_code == 200:
+                    counts["signed"] += 1
+                elif response.status_code in (429, 503):
+                    counts["rejected"] += 1
+                else:
+                    counts["errors"] += 1
+            if response.status_code in (429, 503):
+                stop.wait(float(response.headers.get("retry-after", "1")))
+
+    pool = ThreadPoolExecutor(clients)
+    futures = [pool.submit(client, i) for i in range(clients)]
+    return counts, pool, futures
+
+
+def run_case(args, workdir: str, documents_url: str, admission_enabled: bool) -> dict:
+    tag = "on" if admission_enabled else "off"
+    env = {
+        **os.environ,
+        "PFX_FILE_PATH": os.path.join(workdir, "scale.pfx"),
+        "PFX_PASSPHRASE": PFX_PASSWORD,
+        "CONTENT_STORE_DIR": os.path.join(workdir, f"content-{tag}"),
+        "AUDIT_LOG_PATH": os.path.join(workdir, f"audit-{tag}.jsonl"),
+        "SIGNATURE_INDEX_PATH": os.path.join(workdir, f"index-{tag}.sqlite3"),
+        "ADMISSION_ENABLED": "1" if admission_enabled else "0",
+    }
+    if args.max_concurrency:
+        env["ADMISSION_MAX_CONCURRENCY"] = str(args.max_concurrency)
+    port = _free_port()
+    process = _start("main", port, env)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        _wait_healthy(url, path="/ready")
+        _sign(url, documents_url, f"{tag}-warmup", "warmup", "interactive")  # Calentamiento: PFX y conexiones
+
+        idle = _interactive_phase(url, documents_url, args.interactive_requests, args.interval, f"{tag}-idle")
+
+        stop = threading.Event()
+        bulk, pool, futures = _bulk_clients(url, documents_url, args.bulk_clients, stop, tag)
+        time.sleep(args.bulk_ramp)  # Que la cola del carril bulk se llene antes de medir
+        started = time.perf_counter()
+        loaded = _interactive_phase(url, documents_url, args.interactive_requests, args.interval, f"{tag}-loaded")
+        elapsed = time.perf_counter() - started
+        admission_state = httpx.get(f"{url}/admission", timeout=10).json()
+        stop.set()
+        for future in futures:
+            future.result()
+        pool.shutdown()
+
+        return {
+            "admission_enabled": admission_enabled,
+            "interactive_idle": idle,
+            "interactive_during_bulk": loaded,
+            "p99_ratio": round(loaded["p99_ms"] / idle["p99_ms"], 2) if idle["p99_ms"] and loaded["p99_ms"] else None,
+            "bulk": {**bulk, "signed_per_second": round(bulk["signed"] / elapsed, 2)},
+            "admission_state_during_bulk": admission_state,
+        }
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except Exception:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latencia interactiva del servicio de firma durante un lote")
+    parser.add_argument("--interactive_requests", type=int, default=40, help="Firmas interactivas por fase")
+    parser.add_argument("--interval", type=float, default=0.05, help="Pausa entre firmas interactivas (s)")
+    parser.add_argument("--bulk_clients", type=int, default=16, help="Clientes de lote concurrentes")
+    parser.add_argument("--bulk_ramp", type=float, default=2.0, help="Segundos de lote antes de medir")
+    parser.add_argument("--max_concurrency", type=int, help="ADMISSION_MAX_CONCURRENCY del worker (por omisión, núcleos)")
+    parser.add_argument("--pages", type=int, default=20, help="Páginas del PDF sintético")
+    parser.add_argument("--compare_disabled", action="store_true", help="Repetir con el control de admisión apagado")
+    parser.add_argument("--max_p99_ratio", type=float, default=0.0,
+                        help="Falla si p99 interactivo con lote / p99 en reposo supera este valor (ej. 3)")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.join(os.path.dirname(SERVICE_DIR), "scripts"))
+    from benchmark_signatures import make_synthetic_pdf
+
+    workdir = tempfile.mkdtemp(prefix="signing-admission-")
+    try:
+        _write_pfx(os.path.join(workdir, "scale.pfx"))
+        documents_dir = os.path.join(workdir, "documents")
+        os.makedirs(documents_dir)
+        with open(os.path.join(documents_dir, "documento.pdf"), "wb") as f:
+            f.write(make_synthetic_pdf(args.pages))
+        server = _serve_documents(documents_dir)
+        documents_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        cases = [run_case(args, workdir, documents_url, admission_enabled=True)]
+        if args.compare_disabled:
+            cases.append(run_case(args, workdir, documents_url, admission_enabled=False))
+        server.shutdown()
+
+        protected = cases[0]
+        ok = (
+            protected["interactive_during_bulk"]["errors"] == 0
+            and protected["bulk"]["errors"] == 0
+            and (not args.max_p99_ratio or (protected["p99_ratio"] or 0) <= args.max_p99_ratio)
+        )
+        print(json.dumps({"success": ok, "cpu_count": os.cpu_count(), "cases": cases}, indent=2))
+        sys.exit(0 if ok else 1)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
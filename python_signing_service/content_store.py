@@ -0,0 +1,177 @@
+"""
+Almacenamiento direccionado por contenido para los documentos firmados.
+
+Cada PDF firmado se guarda una sola vez bajo el SHA-256 de su contenido
+(`blobs/ab/abcdef….pdf`), y una tabla de mapeo relaciona (documento, revisión)
+con ese hash. Un reintento de la misma firma produce el mismo hash: la subida
+se omite y la revisión existente se reutiliza. Dos documentos con el mismo
+nombre ya no se sobrescriben entre sí.
+
+`LocalContentStore` usa la carpeta mock_storage como backend; un backend
+remoto (Supabase Storage, S3) solo necesita implementar los mismos métodos.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+HASH_CHUNK_SIZE = 1024 * 1024
+_HEX_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def sha256_file(path: str) -> str:
+    """SHA-256 hexadecimal de un archivo, leído por bloques."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def etag_for(content_hash: str) -> str:
+    """ETag fuerte: el hash del contenido identifica los bytes exactos del blob."""
+    return f'"{content_hash}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Evalúa un header `If-None-Match` (lista de ETags o `*`) contra `etag`.
+    Usa la comparación débil que pide el RFC 9110 para este header: `W/"x"` coincide con `"x"`.
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class LocalContentStore:
+    """Blobs en disco más una tabla SQLite (document_id, revision) -> content_hash."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.blobs_dir = os.path.join(root, "blobs")
+        self.db_path = os.path.join(root, "revisions.sqlite3")
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        with self._connect() as db:
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS document_revisions (
+                    document_id TEXT NOT NULL,
+                    revision INTEGER NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    file_name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at TEXT NOT NULL,
+                    PRIMARY KEY (document_id, revision)
+                )
+                """
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS idx_revisions_hash ON document_revisions (content_hash)")
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    # --- Blobs ---
+    def blob_path(self, content_hash: str) -> str:
+        if not _HEX_DIGEST_RE.match(content_hash):
+            raise ValueError(f"Hash de contenido inválido: {content_hash!r}")
+        return os.path.join(self.blobs_dir, content_hash[:2], f"{content_hash}.pdf")
+
+    def exists(self, content_hash: str) -> bool:
+        return os.path.exists(self.blob_path(content_hash))
+
+    def size(self, content_hash: str) -> int:
+        return os.path.getsize(self.blob_path(content_hash))
+
+    def put_file(self, local_path: str, content_hash: Optional[str] = None) -> Tuple[str, bool]:
+        """
+        Guarda `local_path` bajo su hash. Devuelve (hash, subido); `subido` es False
+        cuando el contenido ya existía y no se copió nada.
+        """
+        content_hash = content_hash or sha256_file(local_path)
+        destination = self.blob_path(content_hash)
+        if os.path.exists(destination):
+            return content_hash, False
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        # Copia a un temporal y renombra: un lector nunca ve un blob a medio escribir
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(destination), suffix=".partial")
+        os.close(fd)
+        try:
+            shutil.copyfile(local_path, temp_path)
+            os.replace(temp_path, destination)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return content_hash, True
+
+    # --- Tabla de mapeo ---
+    def record_revision(self, document_id: str, content_hash: str, file_name: str) -> dict:
+        """
+        Registra `content_hash` como la siguiente revisión de `document_id`.
+        Si la última revisión ya tiene ese hash (un reintento), se devuelve sin crear otra.
+        """
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            latest = db.execute(
+                "SELECT * FROM document_revisions WHERE document_id = ? ORDER BY revision DESC LIMIT 1",
+                (document_id,),
+            ).fetchone()
+            if latest is not None and latest["content_hash"] == content_hash:
+                db.execute("COMMIT")
+                return {**dict(latest), "created": False}
+            row = {
+                "document_id": document_id,
+                "revision": (latest["revision"] + 1) if latest is not None else 1,
+                "content_hash": content_hash,
+                "file_name": file_name,
+                "size": self.size(content_hash),
+                "created_at": datetime.now(timezone.utc).isoformat(),
+            }
+            db.execute(
+                "INSERT INTO document_revisions (document_id, revision, content_hash, file_name, size, created_at) "
+                "VALUES (:document_id, :revision, :content_hash, :file_name, :size, :created_at)",
+                row,
+            )
+            db.execute("COMMIT")
+            return {**row, "created": True}
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def resolve(self, document_id: str, revision: Optional[int] = None) -> Optional[dict]:
+        """Fila de la revisión pedida (o de la última) de un documento."""
+        with self._connect() as db:
+            if revision is None:
+                row = db.execute(
+                    "SELECT * FROM document_revisions WHERE document_id = ? ORDER BY revision DESC LIMIT 1",
+                    (document_id,),
+                ).fetchone()
+            else:
+                row = db.execute(
+                    "SELECT * FROM document_revisions WHERE document_id = ? AND revision = ?",
+                    (document_id, revision),
+                ).fetchone()
+        return dict(row) if row is not None else None
+
+    def revisions(self, document_id: str) -> List[dict]:
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT * FROM document_revisions WHERE document_id = ? ORDER BY revision",
+                (document_id,),
+            ).fetchall()
+        return [dict(row) for row in rows]
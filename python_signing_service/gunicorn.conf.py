@@ -0,0 +1,28 @@
+"""
+Despliegue multi-worker con precarga antes del fork.
+
+    cd python_signing_service && gunicorn main:app -c gunicorn.conf.py
+
+Con `preload_app` el maestro importa main una sola vez y, con SIGNING_PRELOAD=1,
+corre el calentamiento (warmup.py) antes de crear los workers: módulos de
+PyHanko, tablas criptográficas y firmantes PFX descifrados quedan en páginas
+compartidas por copy-on-write en lugar de duplicarse por worker. Cada worker
+confirma con su propio calentamiento (rápido) antes de responder 200 en /ready.
+"""
+
+import multiprocessing
+import os
+
+os.environ.setdefault("SIGNING_PRELOAD", "1")
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "300"))
+
+
+def when_ready(server):
+    # Se llama después de la precarga y antes de crear los workers
+    import warmup
+    warmup.freeze_for_fork()
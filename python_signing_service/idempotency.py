@@ -0,0 +1,190 @@
+"""
+Claves de idempotencia y coalescencia de solicitudes en curso para firma y verificación.
+
+El frontend reintenta cuando una solicitud tarda demasiado. Sin esta capa, un
+reintento de `/sign_document` repite la descarga y la firma y puede agregar
+una segunda firma al documento. Con ella:
+
+- Si el cliente manda `Idempotency-Key`, la clave (por acción y usuario)
+  identifica la solicitud. Un duplicado que llega mientras la original sigue
+  en curso se une a ese mismo cálculo en vez de empezar otro. Uno que llega
+  después recibe la respuesta guardada con `Idempotent-Replayed: true`, sin
+  pasar por admisión. Reusar la clave con otra solicitud da 422.
+- Sin header, la clave se deriva después de descargar el documento: acción,
+  usuario, firmante y SHA-256 del contenido. Firmar otra vez los mismos bytes
+  es un reintento; una firma legítima posterior llega sobre una revisión
+  nueva, con otro hash. La verificación no depende del usuario, así que se
+  indexa solo por contenido y con un TTL más corto (la revocación de un
+  certificado puede cambiar el resultado).
+
+Solo se guardan las respuestas definitivas: los errores 5xx, 408 y 429 no,
+para que el reintento vuelva a intentarlo. Cada cálculo corre en su propia
+tarea: si el cliente original se desconecta (la causa típica del
+reintento), el reintento se une a la firma que sigue en curso en vez de
+cancelarla y empezar otra.
+
+El estado vive en el event loop del proceso (como admission.py). El router
+envía cada documento al mismo worker, así que los duplicados llegan al mismo
+almacén.
+"""
+
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+
+import metrics
+
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+# TTL de las verificaciones indexadas por contenido (sin Idempotency-Key)
+VERIFY_TTL = float(os.getenv("IDEMPOTENCY_VERIFY_TTL", "300"))
+# Respuestas que un reintento debe volver a intentar, además de los 5xx
+_RETRYABLE_STATUS = {408, 429}
+
+
+class IdempotencyConflict(Exception):
+    """La misma Idempotency-Key llegó con una solicitud distinta (422)."""
+
+
+class _StoredResponse:
+    __slots__ = ("status_code", "body", "media_type", "fingerprint", "expires")
+
+    def __init__(self, result, fingerprint: Optional[str], expires: float):
+        if isinstance(result, Response):
+            self.status_code = result.status_code
+            self.body = bytes(result.body)
+            self.media_type = result.headers.get("content-type", "application/json")
+        else:
+            # Un modelo de respuesta: la misma serialización que aplica FastAPI con response_model
+            rendered = JSONResponse(jsonable_encoder(result))
+            self.status_code = rendered.status_code
+            self.body = bytes(rendered.body)
+            self.media_type = rendered.media_type
+        self.fingerprint = fingerprint
+        self.expires = expires
+
+    @property
+    def cacheable(self) -> bool:
+        return self.status_code < 500 and self.status_code not in _RETRYABLE_STATUS
+
+    def response(self, replayed: bool) -> Response:
+        headers = {REPLAYED_HEADER: "true"} if replayed else None
+        return Response(content=self.body, status_code=self.status_code, media_type=self.media_type, headers=headers)
+
+
+def request_fingerprint(payload, exclude=("lane",)) -> str:
+    """Huella del cuerpo de la solicitud; el carril no cambia el resultado."""
+    data = payload.model_dump(exclude=set(exclude)) if hasattr(payload, "model_dump") else payload
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def scoped_key(action: str, user: Optional[str], key: str) -> str:
+    """La clave del cliente vale dentro de su acción y su usuario: dos usuarios no chocan."""
+    if len(key) > MAX_KEY_LENGTH:
+        raise ValueError(f"Idempotency-Key excede {MAX_KEY_LENGTH} caracteres")
+    return f"{action}:{user or '-'}:key:{key}"
+
+
+def derived_key(action: str, *parts: Optional[str]) -> str:
+    return f"{action}:derived:" + hashlib.sha256("\x1f".join(p or "" for p in parts).encode()).hexdigest()
+
+
+class IdempotencyStore:
+    """Respuestas recientes por clave (TTL, LRU acotado) y cálculos en curso por clave."""
+
+    def __init__(self, ttl: float = 3600.0, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._results: "collections.OrderedDict[str, _StoredResponse]" = collections.OrderedDict()
+        self._in_flight: Dict[str, Tuple[asyncio.Task, Optional[str]]] = {}
+
+    @staticmethod
+    def _check(expected: Optional[str], fingerprint: Optional[str]):
+        if expected != fingerprint:
+            raise IdempotencyConflict("La Idempotency-Key ya se usó con una solicitud distinta")
+
+    def _lookup(self, key: str) -> Optional[_StoredResponse]:
+        stored = self._results.get(key)
+        if stored is None:
+            return None
+        if stored.expires <= time.monotonic():
+            del self._results[key]
+            return None
+        self._results.move_to_end(key)
+        return stored
+
+    def _remember(self, key: str, stored: _StoredResponse):
+        self._results[key] = stored
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+    async def run(self, key: str, compute: Callable[[], Awaitable], fingerprint: Optional[str] = None,
+                  ttl: Optional[float] = None) -> Response:
+        """
+        Devuelve la respuesta de `key`: la guardada, la del cálculo en curso o la de un cálculo
+        nuevo con `compute()`. Las excepciones de `compute` llegan a todos los que esperaban y
+        no se guardan.
+        """
+        stored = self._lookup(key)
+        if stored is not None:
+            self._check(stored.fingerprint, fingerprint)
+            metrics.IDEMPOTENCY_REQUESTS.inc(outcome="replayed")
+            return stored.response(replayed=True)
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            task, expected = in_flight
+            self._check(expected, fingerprint)
+            metrics.IDEMPOTENCY_REQUESTS.inc(outcome="joined")
+            return (await asyncio.shield(task)).response(replayed=True)
+
+        task = asyncio.ensure_future(self._compute(key, compute, fingerprint, self.ttl if ttl is None else ttl))
+        # Si nadie llega a esperar el resultado (todos se desconectaron), que el error no quede sin leer
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self._in_flight[key] = (task, fingerprint)
+        metrics.IDEMPOTENCY_REQUESTS.inc(outcome="computed")
+        try:
+            return (await asyncio.shield(task)).response(replayed=False)
+        except asyncio.CancelledError:
+            # El cálculo usa recursos de quien lo inició (archivos temporales, lock del
+            # documento): no se liberan hasta que termine para los que se unieron
+            if not task.done():
+                await asyncio.wait([task])
+            raise
+
+    async def _compute(self, key, compute, fingerprint, ttl) -> _StoredResponse:
+        try:
+            stored = _StoredResponse(await compute(), fingerprint, time.monotonic() + ttl)
+            if stored.cacheable:
+                self._remember(key, stored)
+            return stored
+        finally:
+            self._in_flight.pop(key, None)
+
+    def snapshot(self) -> dict:
+        return {"stored": len(self._results), "in_flight": len(self._in_flight)}
+
+
+class _Disabled(IdempotencyStore):
+    """IDEMPOTENCY_ENABLED=0: cada solicitud se calcula, sin guardar ni coalescer."""
+
+    async def run(self, key, compute, fingerprint=None, ttl=None) -> Response:
+        result = await compute()
+        return result if isinstance(result, Response) else _StoredResponse(result, None, 0).response(False)
+
+
+def store_from_env() -> IdempotencyStore:
+    if os.getenv("IDEMPOTENCY_ENABLED", "1") == "0":
+        return _Disabled()
+    return IdempotencyStore(
+        ttl=float(os.getenv("IDEMPOTENCY_TTL", "3600")),
+        max_entries=int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000")),
+    )
@@ -1,11 +1,34 @@
-from fastapi import FastAPI, HTTPException, Body, UploadFile, File
-from fastapi.responses import JSONResponse
+import time
+_IMPORT_STARTED = time.time()
+
+import asyncio
+
+from fastapi import FastAPI, HTTPException, Body, UploadFile, File, Request, Header
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response
+from starlette.concurrency import run_in_threadpool
 import httpx
 import tempfile
 import os
+import sys
+import json
+import mmap
 import shutil
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, List
+
+import metrics
+import warmup
+from admission import AdmissionRejected, controller_from_env
+from content_store import LocalContentStore, etag_for, etag_matches, sha256_file
+from idempotency import (IdempotencyConflict, VERIFY_TTL, derived_key, request_fingerprint, scoped_key,
+                         store_from_env as idempotency_from_env)
+
+# Módulos compartidos con los scripts CLI (pre-chequeo estructural de PDFs, etc.)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+from pdf_precheck import PdfPrechecker, PdfPrecheckError
+from pdf_io import MappedStream
+from audit_log import audit
+from signature_index import get_signature_index, index_signed_file
 
 # Importaciones de PyHanko (asegúrate de tenerlas configuradas)
 # from pyhanko.pdf_utils.reader import PdfFileReader
@@ -34,7 +57,10 @@ class SignerInfo(BaseModel):
 class SigningRequest(BaseModel):
     document_url: str
     original_file_name: str
+    document_id: Optional[str] = None # Clave del documento (revisiones, índice, auditoría); si falta se usa la URL sin query string
     signer_info: Optional[SignerInfo] = None
+    user_id: Optional[str] = None # Usuario que solicita la firma (cubeta de admisión); lo fija el llamador del lado del servidor. Si falta se usa signer_info.email
+    lane: Optional[str] = "interactive" # "bulk" para lotes; el servidor también manda a bulk a quien ya tiene su cupo interactivo ocupado (ver admission.py)
     # Aquí podrías añadir más campos, como:
     # signature_level: str = "PAdES-B-T" # Nivel de firma PAdES
     # certificate_alias: Optional[str] = None # Para seleccionar un certificado específico si tienes varios
@@ -43,24 +69,62 @@ class SigningResponse(BaseModel):
     message: str
     signed_document_url: Optional[str] = None
     new_file_name: Optional[str] = None
+    content_hash: Optional[str] = None
+    revision: Optional[int] = None
+    error_details: Optional[str] = None
+
+class VerificationRequest(BaseModel):
+    document_url: str
+    user_id: Optional[str] = None
+    lane: Optional[str] = "interactive"
+
+class SignatureStatus(BaseModel):
+    field_name: str
+    signer_name: Optional[str] = None
+    intact: bool = False
+    valid: bool = False
+    trusted: bool = False
+    error: Optional[str] = None
+
+class VerificationResponse(BaseModel):
+    message: str
+    signatures: List[SignatureStatus] = []
     error_details: Optional[str] = None
 
 # --- Configuración (Ejemplos - DEBES AJUSTAR ESTO) ---
 # Deberás configurar esto de forma segura, por ejemplo, usando variables de entorno
 CERTIFICATE_DIR = os.path.join(os.path.dirname(__file__), "certificates")
-PFX_FILE_PATH = os.path.join(CERTIFICATE_DIR, "tu_certificado.pfx") # Cambia esto
-PFX_PASSPHRASE = b"tu_contraseña_pfx"  # Cambia esto y usa variables de entorno
+PFX_FILE_PATH = os.getenv("PFX_FILE_PATH", os.path.join(CERTIFICATE_DIR, "tu_certificado.pfx")) # Cambia esto
+PFX_PASSPHRASE = os.getenv("PFX_PASSPHRASE", "tu_contraseña_pfx").encode()  # Cambia esto y usa variables de entorno
+# Alternativa al PFX: clave en un HSM/token PKCS#11 (ver scripts/pkcs11_signing.py para PKCS11_MODULE y el PIN)
+PKCS11_TOKEN_LABEL = os.getenv("PKCS11_TOKEN_LABEL")
+PKCS11_KEY_LABEL = os.getenv("PKCS11_KEY_LABEL")
+PKCS11_CERT_LABEL = os.getenv("PKCS11_CERT_LABEL")
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# URL pública con la que los clientes llegan a este servicio (o al router que lo reparte).
+# `signed_document_url` se construye con ella: `{SIGNED_DOCS_BASE_URL}/content/<sha256>`.
+SIGNED_DOCS_BASE_URL = os.getenv("SIGNED_DOCS_BASE_URL", "http://localhost:8000").rstrip("/")
 
-# URL base de tu Supabase Storage (o donde subirás los firmados)
-# Ejemplo: SUPABASE_STORAGE_BASE_URL = "https://<project_ref>.supabase.co/storage/v1/object/public/signed-documents"
-# Asegúrate de que el bucket "signed-documents" exista y tenga los permisos adecuados.
-# Esta URL se usará para construir la URL del documento firmado.
-# Necesitarás una forma de subir el archivo a este bucket (ej. usando la librería de Supabase para Python o su API HTTP).
-SIGNED_DOCS_BUCKET_URL = os.getenv("SIGNED_DOCS_BUCKET_URL", "http://localhost:8000/mock_storage/signed-documents")
+# Almacenamiento direccionado por contenido (SHA-256) de los documentos firmados. La carpeta
+# no se expone tal cual (contiene la base de revisiones): los documentos se sirven solo por
+# /content/<sha256> y /documents/<id>/content
+CONTENT_STORE_DIR = os.getenv("CONTENT_STORE_DIR", os.path.join(os.path.dirname(__file__), "mock_storage", "content"))
+content_store = LocalContentStore(CONTENT_STORE_DIR)
+CONTENT_CHUNK_SIZE = int(os.getenv("CONTENT_CHUNK_SIZE", 256 * 1024))  # Bloques al servir sin sendfile
+
+# Control de admisión: concurrencia global, cubetas por usuario y carriles interactive/bulk (ver admission.py)
+admission = controller_from_env()
+idempotency = idempotency_from_env()
 
 
 # --- Funciones Auxiliares (Simuladas/Ejemplos) ---
 
+async def run_blocking(function, *args, **kwargs):
+    """run_in_threadpool para el trabajo de una solicitud; si se está perfilando, el perfil incluye el hilo."""
+    return await run_in_threadpool(metrics.profile_call, function, *args, **kwargs)
+
 async def download_document(url: str, dest_folder: str) -> str:
     """Descarga un documento desde una URL a una carpeta temporal."""
     file_name = url.split("/")[-1].split("?")[0] # Intenta obtener un nombre de archivo
@@ -71,12 +135,25 @@ async def download_document(url: str, dest_folder: str) -> str:
     
     async with httpx.AsyncClient() as client:
         try:
-            response = await client.get(url, follow_redirects=True)
-            response.raise_for_status() # Lanza excepción para códigos 4xx/5xx
-            with open(local_path, "wb") as f:
-                f.write(response.content)
+            with metrics.stage("download"):
+                # Se escribe a disco por bloques: el documento nunca se mantiene completo en memoria
+                async with client.stream("GET", url, follow_redirects=True) as response:
+                    if response.is_error:
+                        await response.aread() # Necesario para incluir el cuerpo en el mensaje de error
+                    response.raise_for_status() # Lanza excepción para códigos 4xx/5xx
+                    # El pre-chequeo se alimenta mientras se descarga: un archivo que no es PDF o que
+                    # excede los límites se corta sin terminar la descarga ni llegar a PyHanko
+                    prechecker = PdfPrechecker()
+                    with open(local_path, "wb") as f:
+                        async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                            prechecker.feed(chunk)
+                            f.write(chunk)
+                    prechecker.finish(local_path)
             print(f"Documento descargado: {local_path}")
             return local_path
+        except PdfPrecheckError as e:
+            print(f"Documento rechazado por el pre-chequeo ({url}): {e.to_dict()}")
+            raise HTTPException(status_code=422, detail=e.to_dict())
         except httpx.HTTPStatusError as e:
             print(f"Error HTTP al descargar {url}: {e}")
             raise HTTPException(status_code=e.response.status_code, detail=f"Error al descargar el documento original: {e.response.text}")
@@ -96,18 +173,19 @@ def sign_pdf_with_pyhanko(input_pdf_path: str, output_pdf_path: str, signer_name
     - Uso de Timestamp Authority (TSA).
     """
     print(f"Intentando firmar: {input_pdf_path} -> {output_pdf_path}")
-    
+    with metrics.stage("sign") as span:
+        success = _sign_pdf_with_pyhanko(input_pdf_path, output_pdf_path, signer_name)
+        if not success:
+            span.outcome = "error"
+        return success
+
+def _sign_pdf_with_pyhanko(input_pdf_path: str, output_pdf_path: str, signer_name: Optional[str]) -> bool:
+    """Carga del firmante y firma propiamente dicha (medida como etapa "sign")."""
+
     # --- INICIO: Lógica de PyHanko (EJEMPLO BÁSICO CON PFX) ---
     # ¡¡¡ADVERTENCIA!!! Esto es solo un esqueleto. Necesitas implementar la carga
     # segura de certificados y la configuración detallada de PyHanko.
     try:
-        # Ejemplo de carga de PFX (NO USAR PASSPHRASE DIRECTAMENTE EN CÓDIGO EN PRODUCCIÓN)
-        # signer = SimpleSigner.load_pkcs12(
-        #     pfx_file=PFX_FILE_PATH,
-        #     passphrase=PFX_PASSPHRASE
-        # )
-        # print(f"Certificado PFX cargado desde: {PFX_FILE_PATH}")
-
         # Ejemplo con certificado y clave PEM (sin encriptar la clave, o desencriptar antes)
         # with open(os.path.join(CERTIFICATE_DIR, 'signer.crt.pem'), 'rb') as cert_file:
         #     signing_cert = load_cert_from_pemder(cert_file.read())
@@ -127,34 +205,48 @@ def sign_pdf_with_pyhanko(input_pdf_path: str, output_pdf_path: str, signer_name
         # )
         # print("Certificado y clave PEM cargados.")
 
+        if PKCS11_TOKEN_LABEL and PKCS11_KEY_LABEL:
+            # Sesiones PKCS#11 con login hecho una sola vez y reutilizadas entre firmas
+            from pkcs11_signing import get_registry
+            signer = get_registry().signer(PKCS11_TOKEN_LABEL, PKCS11_KEY_LABEL, PKCS11_CERT_LABEL)
+            print(f"Firmante PKCS#11 listo (token '{PKCS11_TOKEN_LABEL}', clave '{PKCS11_KEY_LABEL}')")
+        elif not os.path.exists(PFX_FILE_PATH):
+            # Sin certificado configurado: simulación, copia el archivo de entrada al de salida
+            shutil.copyfile(input_pdf_path, output_pdf_path)
+            print(f"SIMULACIÓN: Documento '{input_pdf_path}' copiado a '{output_pdf_path}' como si estuviera firmado.")
+            return True
 
-        # Simulación de firma: Copia el archivo de entrada al de salida
-        # REEMPLAZA ESTO CON LA LÓGICA REAL DE PYHANKO
+        from pyhanko.sign import signers
+        from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter
+
+        if not (PKCS11_TOKEN_LABEL and PKCS11_KEY_LABEL):
+            # El PFX se descifra (KDF lento) solo en la primera firma; luego sale de la caché del proceso
+            from pfx_cache import load_pkcs12_signer
+            try:
+                signer = load_pkcs12_signer(PFX_FILE_PATH, PFX_PASSPHRASE)
+            except ValueError as e:
+                print(f"Error: {e}")
+                return False
+
+        # Copia a nivel de kernel y luego solo se agrega la actualización incremental al final:
+        # la memoria usada no depende del tamaño del documento
         shutil.copyfile(input_pdf_path, output_pdf_path)
-        print(f"SIMULACIÓN: Documento '{input_pdf_path}' copiado a '{output_pdf_path}' como si estuviera firmado.")
-        # Ejemplo de cómo sería una firma real (muy simplificado):
-        # with open(input_pdf_path, 'rb') as doc_in:
-        #     w = IncrementalPdfFileWriter(doc_in)
-        #     with open(output_pdf_path, 'wb') as doc_out:
-        #         # Aquí puedes configurar SigFieldSpec para firmas visibles, metadatos, etc.
-        #         # mechanism = select_signature_mechanism(signer.signing_cert, signer.pkcs11_session_info is not None)
-        #         # pdf_signer = signers.PdfSigner(
-        #         #     pdf_timestamper=HTTPTimeStamper(url='URL_DE_TU_TSA_SI_USAS') if TSA_URL else None,
-        #         #     signature_meta=signers.PdfSignatureMetadata(
-        #         #         field_name='Signature1', # O un nombre de campo existente
-        #         #         name=signer_name or "Firmante Autorizado",
-        #         #         location="Oficina Central", # Ejemplo
-        #         #         reason="Aprobación del documento", # Ejemplo
-        #         #     ),
-        #         #     signer=signer,
-        #         #     # Para firmas visibles:
-        #         #     # sig_field_spec=SigFieldSpec(
-        #         #     #   sig_field_name='Signature1',
-        #         #     #   box=(x1, y1, x2, y2) # Coordenadas del campo de firma
-        #         #     # ),
-        #         # )
-        #         # pdf_signer.sign_pdf(w, output=doc_out)
-        # print(f"Documento firmado con PyHanko: {output_pdf_path}")
+        with open(output_pdf_path, "r+b") as doc:
+            w = IncrementalPdfFileWriter(doc)
+            field_name = f"Signature{len(w.prev.embedded_signatures) + 1}"
+            pdf_signer = signers.PdfSigner(
+                signers.PdfSignatureMetadata(
+                    field_name=field_name,
+                    name=signer_name or "Firmante Autorizado",
+                    location="Oficina Central", # Ejemplo
+                    reason="Aprobación del documento", # Ejemplo
+                ),
+                signer=signer,
+                # Para firmas visibles:
+                # new_field_spec=SigFieldSpec(sig_field_name=field_name, box=(x1, y1, x2, y2)),
+            )
+            pdf_signer.sign_pdf(w, in_place=True)
+        print(f"Documento firmado con PyHanko: {output_pdf_path}")
         return True
     except FileNotFoundError:
         print(f"Error: Archivo de certificado no encontrado en {PFX_FILE_PATH} o PEMs. Verifica la ruta y configuración.")
@@ -167,81 +259,244 @@ def sign_pdf_with_pyhanko(input_pdf_path: str, output_pdf_path: str, signer_name
         return False
     # --- FIN: Lógica de PyHanko ---
 
-async def upload_signed_document(local_signed_path: str, original_file_name: str) -> tuple[Optional[str], Optional[str]]:
+def document_key_for(document_id: Optional[str], document_url: str) -> str:
     """
-    Sube el documento firmado a un almacenamiento (ej. Supabase Storage)
-    y devuelve la URL pública y el nuevo nombre del archivo.
-    ESTA ES UNA IMPLEMENTACIÓN SIMULADA.
+    Clave de un documento para el lock, las revisiones, la auditoría y el índice de firmas:
+    `document_id` o, si falta, la URL sin query string (los tokens de una URL firmada cambian
+    en cada solicitud). Nunca el nombre del archivo: dos `contrato.pdf` distintos no comparten revisiones.
+    """
+    return document_id or document_url.split("?")[0]
+
+async def upload_signed_document(local_signed_path: str, original_file_name: str,
+                                 document_key: str) -> tuple[Optional[str], Optional[str], dict]:
+    """
+    Sube el documento firmado al almacenamiento direccionado por contenido y
+    registra la nueva revisión de `document_key`. Devuelve la URL absoluta, el nombre
+    del archivo y la fila de revisión (con `content_hash`).
+    Si el contenido ya existe (p. ej. un reintento), no se vuelve a subir nada.
     """
-    # Simulación:
-    # En un caso real, usarías la librería de Supabase para Python o su API HTTP
-    # para subir `local_signed_path` al bucket configurado.
-    
     new_file_name = f"signed_{original_file_name}"
     if not new_file_name.lower().endswith(".pdf"):
         new_file_name += ".pdf"
-        
-    # Simulación de subida: simplemente construye una URL ficticia
-    # signed_url = f"{SIGNED_DOCS_BUCKET_URL}/{new_file_name}"
-    
-    # Para probar localmente sin Supabase, podrías "subir" a una carpeta local servida por FastAPI
-    # (necesitarías configurar StaticFiles en FastAPI para esto)
-    mock_storage_dir = os.path.join(os.path.dirname(__file__), "mock_storage", "signed-documents")
-    os.makedirs(mock_storage_dir, exist_ok=True)
-    destination_path = os.path.join(mock_storage_dir, new_file_name)
-    shutil.copyfile(local_signed_path, destination_path)
-    
-    # La URL sería relativa a cómo sirves estos archivos estáticos.
-    # Si FastAPI sirve 'mock_storage' en la raíz:
-    signed_url = f"/mock_storage/signed-documents/{new_file_name}" # Ajusta si sirves desde otra ruta
-    
-    print(f"SIMULACIÓN: Documento firmado '{local_signed_path}' subido a '{destination_path}' (URL: {signed_url})")
-    return signed_url, new_file_name
 
+    with metrics.stage("upload"):
+        # Hashear y copiar el archivo y escribir en SQLite bloquean: fuera del event loop
+        content_hash, uploaded = await run_blocking(content_store.put_file, local_signed_path)
+        revision = await run_blocking(content_store.record_revision, document_key, content_hash, new_file_name)
+
+    signed_url = f"{SIGNED_DOCS_BASE_URL}/content/{content_hash}"
+    if uploaded:
+        print(f"Documento firmado '{local_signed_path}' guardado como {content_hash} (revisión {revision['revision']})")
+    else:
+        print(f"Contenido {content_hash} ya almacenado: subida omitida (revisión {revision['revision']})")
+    return signed_url, new_file_name, revision
+
+def _warmup_signers(fork_safe_only: bool) -> list:
+    """
+    Firmantes que el calentamiento deja cargados: el configurado (PFX o PKCS#11) y las
+    claves PKCS#11 usadas recientemente, listadas en WARMUP_PKCS11_KEYS como
+    `token:clave[:certificado]` separadas por comas. Las sesiones PKCS#11 no sobreviven
+    a un fork, así que en el maestro (`fork_safe_only`) solo se precarga el PFX.
+    """
+    loaded = []
+    if not (PKCS11_TOKEN_LABEL and PKCS11_KEY_LABEL) and os.path.exists(PFX_FILE_PATH):
+        from pfx_cache import load_pkcs12_signer
+        loaded.append(load_pkcs12_signer(PFX_FILE_PATH, PFX_PASSPHRASE))
+    if fork_safe_only:
+        return loaded
+    keys = [entry.split(":") for entry in os.getenv("WARMUP_PKCS11_KEYS", "").split(",") if entry.strip()]
+    if PKCS11_TOKEN_LABEL and PKCS11_KEY_LABEL:
+        keys.insert(0, [PKCS11_TOKEN_LABEL, PKCS11_KEY_LABEL, PKCS11_CERT_LABEL])
+    if keys:
+        from pkcs11_signing import get_registry
+        for token_label, key_label, *cert_label in keys:
+            loaded.append(get_registry().signer(token_label, key_label, (cert_label or [None])[0]))
+    return loaded
+
+def verify_pdf_with_pyhanko(pdf_path: str) -> List[SignatureStatus]:
+    """Valida todas las firmas incrustadas en un PDF y devuelve su estado."""
+    from pyhanko.pdf_utils.reader import PdfFileReader
+    from pyhanko.sign.validation import validate_pdf_signature
+
+    results = []
+    with metrics.stage("verify"):
+        # mmap de solo lectura: las páginas se cargan bajo demanda, sin copiar el documento a memoria
+        with open(pdf_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as stream:
+            reader = PdfFileReader(MappedStream(stream))
+            for sig in reader.embedded_signatures:
+                try:
+                    status = validate_pdf_signature(sig)
+                    results.append(SignatureStatus(
+                        field_name=sig.field_name,
+                        signer_name=status.signing_cert.subject.human_friendly,
+                        intact=status.intact,
+                        valid=status.valid,
+                        trusted=status.trusted,
+                    ))
+                except Exception as e:
+                    results.append(SignatureStatus(field_name=sig.field_name, error=str(e)))
+    return results
+
+
+# --- Métricas y perfilado ---
+# cProfile y pyinstrument instalan ganchos globales: las solicitudes perfiladas van de una en una
+_profile_lock = asyncio.Lock()
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    """Cuenta y mide cada solicitud; con el header X-Profile (y PROFILE_ENABLED=1) la perfila."""
+    profiler = None
+    if metrics.should_profile(request.headers):
+        await _profile_lock.acquire()
+        profiler = metrics.RequestProfiler()
+        profiler.start()
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        # La etiqueta es la plantilla de la ruta (/documents/{document_id}/content), no la ruta cruda:
+        # una ruta inventada (escáneres, 404) no crea series nuevas en /metrics
+        matched = request.scope.get("route")
+        route = getattr(matched, "path", None) or "unmatched"
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, route=route)
+        metrics.REQUESTS_TOTAL.inc(route=route, status=status_code)
+        if profiler is not None:
+            try:
+                profile_path = profiler.stop(route)
+            finally:
+                _profile_lock.release()
+            print(f"Perfil de {route} guardado en {profile_path}")
+    if profiler is not None:
+        response.headers["X-Profile-Output"] = os.path.basename(profile_path)
+    return response
+
+@app.on_event("startup")
+async def record_startup_time():
+    metrics.record_startup(metrics.process_start_time(_IMPORT_STARTED))
+
+@app.on_event("startup")
+async def start_warmup():
+    """El puerto abre de inmediato (/health); /ready responde 200 cuando termina el calentamiento."""
+    if os.getenv("WARMUP_ENABLED", "1") == "0":
+        warmup.skip()
+        return
+    app.state.warmup_task = asyncio.create_task(run_in_threadpool(warmup.run, _warmup_signers))
+
+@app.get("/health")
+async def health_route():
+    """Chequeo de vida usado por el router frontal y los balanceadores."""
+    return {"status": "ok"}
+
+@app.get("/ready")
+async def ready_route():
+    """Disponibilidad: 200 solo cuando el worker terminó su calentamiento (ver warmup.py)."""
+    snapshot = warmup.snapshot()
+    if not snapshot["ready"]:
+        return JSONResponse(status_code=503, content=snapshot, headers={"Retry-After": "1"})
+    return snapshot
+
+@app.get("/admission")
+async def admission_route():
+    """Estado actual del control de admisión (en proceso y en cola por carril)."""
+    return admission.snapshot()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_route():
+    """Exposición de métricas en formato de texto de Prometheus."""
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _detail_text(detail) -> str:
+    """Los errores estructurados (p. ej. del pre-chequeo) se devuelven como JSON."""
+    return json.dumps(detail, ensure_ascii=False) if isinstance(detail, dict) else str(detail)
+
+# Firmas del mismo documento en este proceso se serializan (el router envía cada documento
+# siempre al mismo worker, así que el orden de revisiones queda local). {clave: [lock, usuarios]}
+_document_locks = {}
+
+async def acquire_document_lock(document_key: str):
+    entry = _document_locks.setdefault(document_key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    await entry[0].acquire()
+
+def release_document_lock(document_key: str):
+    entry = _document_locks[document_key]
+    entry[0].release()
+    entry[1] -= 1
+    if entry[1] == 0:
+        del _document_locks[document_key]
+
+def _rejection_response(rejected: AdmissionRejected, response_model):
+    """Rechazo inmediato de admisión (429/503) con Retry-After."""
+    return JSONResponse(
+        status_code=rejected.status_code,
+        headers=rejected.headers(),
+        content=response_model(
+            message="Servicio de firma saturado, reintenta más tarde." if rejected.status_code == 503
+            else "Demasiadas solicitudes para este usuario, reintenta más tarde.",
+            error_details=rejected.reason
+        ).model_dump(exclude_none=True)
+    )
+
+def _idempotency_error_response(error: Exception, response_model):
+    """Idempotency-Key reutilizada con otra solicitud (422) o inválida (400)."""
+    return JSONResponse(
+        status_code=422 if isinstance(error, IdempotencyConflict) else 400,
+        content=response_model(message="Idempotency-Key no válida.", error_details=str(error)).model_dump(exclude_none=True)
+    )
 
 # --- Endpoint de Firma ---
 @app.post("/sign_document", response_model=SigningResponse)
-async def sign_document_route(payload: SigningRequest):
+async def sign_document_route(payload: SigningRequest, idempotency_key: Optional[str] = Header(None)):
     """
-    Endpoint para solicitar la firma de un documento.
+    Admite la solicitud (ver admission.py) y la procesa mientras ocupa su lugar.
+    Con `Idempotency-Key`, un reintento se une a la firma en curso o recibe la respuesta
+    guardada sin volver a pasar por admisión (ver idempotency.py).
+    """
+    user = payload.user_id or (payload.signer_info.email if payload.signer_info else None)
+
+    async def admitted():
+        try:
+            async with admission.admit(user, payload.lane):
+                return await sign_document(payload)
+        except AdmissionRejected as rejected:
+            return _rejection_response(rejected, SigningResponse)
+
+    if not idempotency_key:
+        return await admitted()
+    try:
+        return await idempotency.run(scoped_key("sign", user, idempotency_key), admitted, request_fingerprint(payload))
+    except (IdempotencyConflict, ValueError) as e:
+        return _idempotency_error_response(e, SigningResponse)
+
+async def sign_document(payload: SigningRequest):
+    """
+    Firma de un documento ya admitido.
     1. Descarga el documento desde `document_url`.
-    2. Firma el documento usando PyHanko (configuración de ejemplo).
-    3. Sube el documento firmado al almacenamiento.
-    4. Devuelve la URL del documento firmado.
+    2. Si esos mismos bytes ya se firmaron para este usuario, devuelve esa firma.
+    3. Firma el documento usando PyHanko (configuración de ejemplo).
+    4. Sube el documento firmado al almacenamiento y devuelve su URL.
     """
     temp_dir = tempfile.mkdtemp()
     downloaded_pdf_path = None
-    signed_pdf_path = None
+    document_key = document_key_for(payload.document_id, payload.document_url)
+    await acquire_document_lock(document_key)
 
     try:
         # 1. Descargar el documento
         print(f"Recibida solicitud para firmar: {payload.original_file_name} desde {payload.document_url}")
         downloaded_pdf_path = await download_document(payload.document_url, temp_dir)
         
-        # 2. Preparar para firmar
-        base_name, ext = os.path.splitext(os.path.basename(downloaded_pdf_path))
-        signed_pdf_path = os.path.join(temp_dir, f"{base_name}_signed{ext}")
-        
+        # 2. Mismo contenido, mismo usuario y mismo firmante: es un reintento y se responde
+        #    con la firma ya hecha en vez de agregar otra (ver idempotency.py)
         signer_display_name = payload.signer_info.name if payload.signer_info else "Firmante del Sistema"
-
-        # 3. Firmar con PyHanko
-        # Aquí deberías pasar la información del firmante y del certificado si es necesario
-        success = sign_pdf_with_pyhanko(downloaded_pdf_path, signed_pdf_path, signer_name=signer_display_name)
-        
-        if not success:
-            # El error específico ya se habrá impreso en sign_pdf_with_pyhanko
-            raise HTTPException(status_code=500, detail="Error durante el proceso de firma con PyHanko. Revisa los logs del servidor Python.")
-
-        # 4. Subir el documento firmado
-        signed_url, new_name = await upload_signed_document(signed_pdf_path, payload.original_file_name)
-        
-        if not signed_url:
-            raise HTTPException(status_code=500, detail="Error al subir el documento firmado.")
-
-        return SigningResponse(
-            message="Documento firmado y subido exitosamente (simulado).",
-            signed_document_url=signed_url,
-            new_file_name=new_name
+        user = payload.user_id or (payload.signer_info.email if payload.signer_info else None)
+        content_hash = await run_blocking(sha256_file, downloaded_pdf_path)
+        return await idempotency.run(
+            derived_key("sign", user, signer_display_name, document_key, content_hash),
+            lambda: _sign_downloaded(payload, document_key, downloaded_pdf_path, temp_dir, signer_display_name),
         )
 
     except HTTPException as http_exc: # Relanzar HTTPExceptions conocidas
@@ -249,7 +504,7 @@ async def sign_document_route(payload: SigningRequest):
             status_code=http_exc.status_code,
             content=SigningResponse(
                 message="Error en el proceso de firma.",
-                error_details=str(http_exc.detail)
+                error_details=_detail_text(http_exc.detail)
             ).model_dump(exclude_none=True)
         )
     except Exception as e:
@@ -264,6 +519,7 @@ async def sign_document_route(payload: SigningRequest):
             ).model_dump(exclude_none=True)
         )
     finally:
+        release_document_lock(document_key)
         # 5. Limpiar archivos temporales
         if os.path.exists(temp_dir):
             try:
@@ -272,11 +528,200 @@ async def sign_document_route(payload: SigningRequest):
             except Exception as e:
                 print(f"Error al limpiar directorio temporal {temp_dir}: {e}")
 
-# --- Para servir archivos estáticos de mock_storage (opcional, para pruebas locales) ---
-from fastapi.staticfiles import StaticFiles
-# Crea el directorio si no existe para que StaticFiles no falle al inicio
-os.makedirs(os.path.join(os.path.dirname(__file__), "mock_storage"), exist_ok=True)
-app.mount("/mock_storage", StaticFiles(directory=os.path.join(os.path.dirname(__file__), "mock_storage")), name="mock_storage")
+async def _sign_downloaded(payload: SigningRequest, document_key: str, downloaded_pdf_path: str, temp_dir: str,
+                           signer_display_name: str) -> SigningResponse:
+    """Pasos 3 y 4 de sign_document sobre el PDF ya descargado."""
+    base_name, ext = os.path.splitext(os.path.basename(downloaded_pdf_path))
+    signed_pdf_path = os.path.join(temp_dir, f"{base_name}_signed{ext}")
+    
+    # 3. Firmar con PyHanko
+    # Aquí deberías pasar la información del firmante y del certificado si es necesario
+    # En un hilo: pyhanko usa su propio event loop y la firma no debe bloquear el del servidor
+    success = await run_blocking(
+        sign_pdf_with_pyhanko, downloaded_pdf_path, signed_pdf_path, signer_name=signer_display_name
+    )
+    
+    if not success:
+        # El error específico ya se habrá impreso en sign_pdf_with_pyhanko
+        raise HTTPException(status_code=500, detail="Error durante el proceso de firma con PyHanko. Revisa los logs del servidor Python.")
+
+    # 4. Subir el documento firmado
+    signed_url, new_name, revision = await upload_signed_document(
+        signed_pdf_path, payload.original_file_name, document_key
+    )
+    
+    if not signed_url:
+        raise HTTPException(status_code=500, detail="Error al subir el documento firmado.")
+
+    audit("sign", document_id=document_key,
+          signer=signer_display_name, content_hash=revision["content_hash"], revision=revision["revision"])
+    # Resumen de firmas para los tableros (listarlas ya no requiere volver a validar el PDF)
+    await run_blocking(
+        index_signed_file, document_key, signed_pdf_path, revision["content_hash"]
+    )
+
+    return SigningResponse(
+        message="Documento firmado y subido exitosamente.",
+        signed_document_url=signed_url,
+        new_file_name=new_name,
+        content_hash=revision["content_hash"],
+        revision=revision["revision"]
+    )
+
+# --- Endpoint de Verificación ---
+@app.post("/verify_document", response_model=VerificationResponse)
+async def verify_document_route(payload: VerificationRequest, idempotency_key: Optional[str] = Header(None)):
+    """Admite la solicitud y verifica mientras ocupa su lugar; acepta `Idempotency-Key` como la firma."""
+    async def admitted():
+        try:
+            async with admission.admit(payload.user_id, payload.lane):
+                return await verify_document(payload)
+        except AdmissionRejected as rejected:
+            return _rejection_response(rejected, VerificationResponse)
+
+    if not idempotency_key:
+        return await admitted()
+    try:
+        return await idempotency.run(
+            scoped_key("verify", payload.user_id, idempotency_key), admitted, request_fingerprint(payload)
+        )
+    except (IdempotencyConflict, ValueError) as e:
+        return _idempotency_error_response(e, VerificationResponse)
+
+async def verify_document(payload: VerificationRequest):
+    """
+    Verificación de las firmas de un documento ya admitido.
+    1. Descarga el documento desde `document_url`.
+    2. Valida cada firma incrustada con PyHanko. Las verificaciones simultáneas o recientes
+       de los mismos bytes comparten un solo resultado (VERIFY_TTL, ver idempotency.py).
+    """
+    temp_dir = tempfile.mkdtemp()
+    try:
+        downloaded_pdf_path = await download_document(payload.document_url, temp_dir)
+        content_hash = await run_blocking(sha256_file, downloaded_pdf_path)
+        return await idempotency.run(
+            derived_key("verify", content_hash), lambda: _verify_downloaded(payload, downloaded_pdf_path, content_hash),
+            ttl=VERIFY_TTL
+        )
+    except HTTPException as http_exc:
+        return JSONResponse(
+            status_code=http_exc.status_code,
+            content=VerificationResponse(
+                message="Error en el proceso de verificación.",
+                error_details=_detail_text(http_exc.detail)
+            ).model_dump(exclude_none=True)
+        )
+    except Exception as e:
+        print(f"Error inesperado en /verify_document: {e}")
+        return JSONResponse(
+            status_code=500,
+            content=VerificationResponse(
+                message="Error interno del servidor en el servicio de verificación.",
+                error_details=str(e)
+            ).model_dump(exclude_none=True)
+        )
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+async def _verify_downloaded(payload: VerificationRequest, downloaded_pdf_path: str,
+                             content_hash: str) -> VerificationResponse:
+    signatures = await run_blocking(verify_pdf_with_pyhanko, downloaded_pdf_path)
+    # La bitácora es de solo anexado: sin query string, que en una URL firmada de Storage lleva el token
+    audit("verify", document_url=payload.document_url.split("?")[0], sha256=content_hash,
+          total_signatures=len(signatures), intact=all(s.intact for s in signatures))
+    return VerificationResponse(
+        message=f"Verificación completada. {len(signatures)} firma(s) encontradas.",
+        signatures=signatures
+    )
+
+# --- Lectura del almacenamiento direccionado por contenido ---
+# Un hash nunca cambia de contenido: el navegador y las CDN pueden guardarlo un año sin revalidar
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# "La última revisión" sí cambia: se revalida siempre, pero con el mismo ETag cuesta un 304
+LATEST_CACHE_CONTROL = "no-cache"
+
+
+async def _serve_blob(request: Request, content_hash: str, cache_control: str,
+                      file_name: Optional[str] = None, headers: Optional[dict] = None):
+    """
+    Respuesta para un blob del almacenamiento: ETag fuerte (el hash), 304 con `If-None-Match`
+    y `FileResponse`, que atiende `Range`/`If-Range` (el visor carga páginas a medida) y `HEAD`.
+    Sin `Range`, los servidores con la extensión ASGI `pathsend` (p. ej. Granian) envían el
+    archivo con sendfile; con los demás se lee por bloques fuera del event loop.
+    """
+    try:
+        path = content_store.blob_path(content_hash)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        stat_result = await run_blocking(os.stat, path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Contenido no encontrado.")
+
+    etag = etag_for(content_hash)
+    headers = {**(headers or {}), "ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response = FileResponse(path, media_type="application/pdf", headers=headers, stat_result=stat_result,
+                            filename=file_name, content_disposition_type="inline")
+    response.chunk_size = CONTENT_CHUNK_SIZE
+    return response
+
+@app.api_route("/content/{content_hash}", methods=["GET", "HEAD"])
+async def content_route(content_hash: str, request: Request):
+    """Sirve un documento firmado por su hash; es inmutable, así que se cachea indefinidamente."""
+    return await _serve_blob(request, content_hash, IMMUTABLE_CACHE_CONTROL)
+
+@app.api_route("/documents/{document_id}/content", methods=["GET", "HEAD"])
+async def document_content_route(document_id: str, request: Request, revision: Optional[int] = None):
+    """
+    Sirve una revisión del documento (`?revision=N`) o la última. Una revisión concreta es
+    inmutable; la última se revalida en cada apertura y responde 304 mientras no haya otra firma.
+    """
+    row = await run_blocking(content_store.resolve, document_id, revision)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Documento o revisión no encontrada.")
+    return await _serve_blob(
+        request, row["content_hash"], IMMUTABLE_CACHE_CONTROL if revision is not None else LATEST_CACHE_CONTROL,
+        file_name=row["file_name"], headers={"X-Document-Revision": str(row["revision"])},
+    )
+
+@app.get("/documents/{document_id}/revisions")
+async def document_revisions_route(document_id: str):
+    """Revisiones registradas de un documento (revisión -> hash de contenido)."""
+    revisions = await run_blocking(content_store.revisions, document_id)
+    if not revisions:
+        raise HTTPException(status_code=404, detail="Documento sin revisiones registradas.")
+    return {"document_id": document_id, "revisions": revisions}
+
+# --- Índice de firmas ---
+class SignatureQuery(BaseModel):
+    document_ids: Optional[List[str]] = None
+    signer: Optional[str] = None
+    since: Optional[str] = None
+    until: Optional[str] = None
+    limit: Optional[int] = None
+
+@app.get("/documents/{document_id}/signatures")
+async def document_signatures_route(document_id: str):
+    """Resumen de las firmas de un documento, leído del índice (sin abrir el PDF)."""
+    return {"document_id": document_id, "signatures": await run_blocking(get_signature_index().for_document, document_id)}
+
+@app.post("/signatures/query")
+async def signatures_query_route(query: SignatureQuery):
+    """
+    Firmas por documentos, firmante (CN o correo) y rango de fechas en una sola consulta indexada.
+    Los ids van en el cuerpo para poder listar cientos de documentos a la vez.
+    """
+    signatures = await run_blocking(
+        get_signature_index().query, query.document_ids, query.signer, query.since, query.until, query.limit
+    )
+    return {"signatures": signatures}
+
+# Precarga antes del fork (gunicorn --preload, ver gunicorn.conf.py): el maestro calienta una
+# vez y los workers heredan módulos y firmantes descifrados por copy-on-write
+if os.getenv("SIGNING_PRELOAD") == "1" and os.getenv("WARMUP_ENABLED", "1") != "0":
+    warmup.run(_warmup_signers, fork_safe_only=True)
 
 
 if __name__ == "__main__":
@@ -287,6 +732,6 @@ if __name__ == "__main__":
     print("Iniciando servidor FastAPI en http://localhost:8000")
     print(f"Coloca tus certificados en: {CERTIFICATE_DIR}")
     print(f"Asegúrate de que PFX_FILE_PATH ({PFX_FILE_PATH}) y PFX_PASSPHRASE estén configurados si usas PFX.")
-    print("Los documentos firmados (simulados) se guardarán en la carpeta 'python_signing_service/mock_storage/signed-documents'")
-    print("Y serán accesibles (simuladamente) en http://localhost:8000/mock_storage/signed-documents/<nombre_archivo>")
+    print(f"Los documentos firmados se guardarán por hash SHA-256 en '{CONTENT_STORE_DIR}'")
+    print("Y serán accesibles en http://localhost:8000/content/<sha256> y /documents/<id>/content (ETag y Range)")
     uvicorn.run(app, host="localhost", port=8000)
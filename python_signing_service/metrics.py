@@ -0,0 +1,319 @@
+"""
+Métricas del servicio de firma.
+
+Tramos (spans) de tiempo por etapa agregados en histogramas y contadores,
+expuestos en formato de texto de Prometheus, y un gancho opcional de
+perfilado por solicitud (cProfile o pyinstrument si está instalado).
+"""
+import os
+import re
+import sys
+import time
+import random
+import pstats
+import itertools
+import threading
+import cProfile
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+# Límites (segundos) de los buckets de los histogramas de latencia
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PROFILE_HEADER = "x-profile"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "1.0"))
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "0") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(__file__), "profiles"))
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return "\n".join(lines)
+
+
+class Gauge(Counter):
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = float(value)
+
+    def render(self) -> str:
+        return super().render().replace(f"# TYPE {self.name} counter", f"# TYPE {self.name} gauge")
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        # Por combinación de etiquetas: [conteos por bucket..., suma, total]
+        self._values: Dict[LabelKey, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, state in sorted(self._values.items()):
+                for i, bound in enumerate(self.buckets):
+                    lines.append(f"{self.name}_bucket{_format_labels(key, ('le', repr(bound)))} {state[i]}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {state[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {state[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {state[-1]}")
+        return "\n".join(lines)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "signing_stage_duration_seconds",
+    "Duración de cada etapa del flujo de firma/verificación.",
+))
+STAGE_TOTAL = REGISTRY.register(Counter(
+    "signing_stage_total",
+    "Ejecuciones de cada etapa por resultado.",
+))
+REQUESTS_TOTAL = REGISTRY.register(Counter(
+    "signing_requests_total",
+    "Solicitudes HTTP atendidas por ruta y código de estado.",
+))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "signing_request_duration_seconds",
+    "Duración total de las solicitudes HTTP por ruta.",
+))
+ADMISSION_IN_FLIGHT = REGISTRY.register(Gauge(
+    "signing_admission_in_flight",
+    "Solicitudes admitidas que se están procesando.",
+))
+ADMISSION_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "signing_admission_queue_depth",
+    "Solicitudes esperando lugar, por carril.",
+))
+ADMISSION_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "signing_admission_wait_seconds",
+    "Espera en la cola de admisión antes de procesar, por carril.",
+))
+ADMISSION_ADMITTED = REGISTRY.register(Counter(
+    "signing_admission_admitted_total",
+    "Solicitudes admitidas por carril.",
+))
+ADMISSION_REJECTED = REGISTRY.register(Counter(
+    "signing_admission_rejected_total",
+    "Solicitudes rechazadas por carril y motivo (user_rate, queue_full, wait_timeout).",
+))
+ADMISSION_RECLASSIFIED = REGISTRY.register(Counter(
+    "signing_admission_reclassified_total",
+    "Solicitudes interactivas enviadas a otro carril por el servidor (usuario con su cupo interactivo ocupado).",
+))
+IDEMPOTENCY_REQUESTS = REGISTRY.register(Counter(
+    "signing_idempotency_requests_total",
+    "Solicitudes con clave de idempotencia por resultado (computed, joined, replayed).",
+))
+WARMUP_SECONDS = REGISTRY.register(Gauge(
+    "signing_warmup_seconds",
+    "Duración de cada paso del calentamiento del proceso (imports, firmantes, firma de prueba).",
+))
+STARTUP_SECONDS = REGISTRY.register(Gauge(
+    "signing_process_startup_seconds",
+    "Tiempo desde el arranque del intérprete hasta que la app quedó lista.",
+))
+
+
+class Span:
+    """Tramo en curso; `outcome` puede marcarse como "error" sin lanzar excepción."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.outcome = "ok"
+
+
+@contextmanager
+def stage(name: str):
+    """Mide una etapa (download, sign, upload, ...) y la registra con su resultado."""
+    span = Span(name)
+    start = time.perf_counter()
+    try:
+        yield span
+    except BaseException:
+        span.outcome = "error"
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+        STAGE_TOTAL.inc(stage=name, outcome=span.outcome)
+
+
+def process_start_time(fallback: float) -> float:
+    """Momento (epoch) en que arrancó el proceso; en Linux se lee de /proc, si no se usa `fallback`."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return boot_time + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return fallback
+
+
+def record_startup(process_start: float):
+    """Registra el costo de arranque (intérprete + imports + inicialización de la app)."""
+    STARTUP_SECONDS.set(time.time() - process_start)
+
+
+def render_prometheus() -> str:
+    return REGISTRY.render()
+
+
+def should_profile(headers) -> bool:
+    """El perfilado se activa por solicitud con el header X-Profile, si está habilitado y cae en el muestreo."""
+    if not PROFILE_ENABLED or headers.get(PROFILE_HEADER) is None:
+        return False
+    return random.random() < PROFILE_SAMPLE_RATE
+
+
+# Perfil de la solicitud en curso; run_in_threadpool copia el contexto, así que los hilos lo ven
+_current_profiler: ContextVar[Optional["RequestProfiler"]] = ContextVar("current_profiler", default=None)
+_profile_counter = itertools.count(1)
+# Desde Python 3.12 cProfile usa sys.monitoring: un perfilador activo ya ve todos los hilos
+_CPROFILE_SEES_ALL_THREADS = sys.version_info >= (3, 12)
+
+
+class RequestProfiler:
+    """
+    Perfila una solicitud con pyinstrument (si está instalado) o cProfile y guarda el resultado en disco.
+
+    El perfilador del event loop solo ve la espera mientras la firma o la verificación corren en el
+    threadpool; ese trabajo se perfila en su hilo (ver `profile_call`) y se une al mismo archivo.
+    Ambos perfiladores instalan ganchos globales, así que quien llama debe perfilar una solicitud a la vez.
+    """
+
+    def __init__(self):
+        self.output_path: Optional[str] = None
+        self._token = None
+        self._thread_profiles = []
+        self._lock = threading.Lock()
+        try:
+            from pyinstrument import Profiler
+            self._profiler = Profiler(async_mode="enabled")
+            self._kind = "pyinstrument"
+        except ImportError:
+            self._profiler = cProfile.Profile()
+            self._kind = "cprofile"
+
+    def start(self):
+        self._token = _current_profiler.set(self)
+        if self._kind == "pyinstrument":
+            self._profiler.start()
+        else:
+            self._profiler.enable()
+
+    def run_in_thread(self, function, *args, **kwargs):
+        """Ejecuta `function` en el hilo actual perfilándola como parte de esta solicitud."""
+        if self._kind == "pyinstrument":
+            from pyinstrument import Profiler
+            profiler = Profiler(async_mode="disabled")
+            profiler.start()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                session = profiler.stop()
+                with self._lock:
+                    self._thread_profiles.append(session)
+        if _CPROFILE_SEES_ALL_THREADS:
+            return function(*args, **kwargs)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profiler.disable()
+            with self._lock:
+                self._thread_profiles.append(profiler)
+
+    def stop(self, label: str) -> str:
+        _current_profiler.reset(self._token)
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        # pid y contador: dos perfiles del mismo segundo no se sobrescriben
+        name = "_".join((
+            re.sub(r"[^A-Za-z0-9.-]+", "_", label).strip("_") or "root",
+            time.strftime("%Y%m%d_%H%M%S"), str(os.getpid()), str(next(_profile_counter)),
+        ))
+        if self._kind == "pyinstrument":
+            from pyinstrument.renderers import HTMLRenderer
+            from pyinstrument.session import Session
+            session = self._profiler.stop()
+            for thread_session in self._thread_profiles:
+                session = Session.combine(session, thread_session)
+            self.output_path = os.path.join(PROFILE_DIR, f"{name}.html")
+            with open(self.output_path, "w") as f:
+                f.write(HTMLRenderer().render(session))
+        else:
+            self._profiler.disable()
+            stats = pstats.Stats(self._profiler)
+            for profiler in self._thread_profiles:
+                stats.add(profiler)
+            self.output_path = os.path.join(PROFILE_DIR, f"{name}.prof")
+            stats.dump_stats(self.output_path)
+        return self.output_path
+
+
+def profile_call(function, *args, **kwargs):
+    """Ejecuta `function` (desde un hilo del pool); si la solicitud que la pidió se perfila, entra en su perfil."""
+    profiler = _current_profiler.get()
+    if profiler is None:
+        return function(*args, **kwargs)
+    return profiler.run_in_thread(function, *args, **kwargs)
@@ -0,0 +1,290 @@
+"""
+Proxy frontal con afinidad por documento para varias instancias del servicio de firma.
+
+Cada solicitud se envía a un worker elegido por hash consistente de su clave
+de enrutamiento: el id del documento al firmar/consultar revisiones, el id
+del usuario para material de certificados. Así las solicitudes de un mismo
+documento llegan siempre al mismo proceso (orden y serialización locales) y
+las cachés de firmantes/certificados de cada worker se mantienen calientes.
+
+Cuando un worker se une o muere, solo se reasignan las claves de su tramo
+del anillo. Los workers se configuran con ROUTER_WORKERS (URLs separadas por
+comas) y pueden unirse o salir en caliente con POST/DELETE /_router/workers.
+Los endpoints /_router/* exigen `Authorization: Bearer $ROUTER_ADMIN_TOKEN`;
+sin ese token configurado solo aceptan conexiones desde localhost.
+Un worker recibe tráfico solo cuando su /ready responde 200, es decir, cuando
+terminó su calentamiento (ver warmup.py).
+
+Uso: ROUTER_WORKERS=http://127.0.0.1:8001,http://127.0.0.1:8002 uvicorn router:app --port 8000
+"""
+
+import asyncio
+import bisect
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+import httpx
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+from starlette.background import BackgroundTask
+
+VIRTUAL_NODES = int(os.getenv("ROUTER_VIRTUAL_NODES", "128"))
+HEALTH_INTERVAL = float(os.getenv("ROUTER_HEALTH_INTERVAL", "2.0"))
+HEALTH_FAILURES_TO_EVICT = int(os.getenv("ROUTER_HEALTH_FAILURES", "2"))
+# /ready (no /health): un worker recién creado entra al anillo solo cuando terminó su calentamiento
+HEALTH_PATH = os.getenv("ROUTER_HEALTH_PATH", "/ready")
+FORWARD_TIMEOUT = float(os.getenv("ROUTER_FORWARD_TIMEOUT", "300"))
+# Token de administración de /_router/*; sin él, esos endpoints solo aceptan clientes locales
+ADMIN_TOKEN = os.getenv("ROUTER_ADMIN_TOKEN")
+_LOCAL_CLIENTS = {"127.0.0.1", "::1", "localhost"}
+
+# Headers que no se reenvían (hop-by-hop o recalculados por el cliente/servidor)
+_HOP_HEADERS = {"host", "connection", "keep-alive", "transfer-encoding", "te", "trailer",
+                "upgrade", "proxy-authorization", "proxy-authenticate"}
+# El Content-Length de la respuesta sí se conserva: los bytes se reenvían sin decodificar, y el
+# visor de PDF lo necesita (junto con Accept-Ranges) para pedir el documento por rangos
+_REQUEST_SKIP_HEADERS = _HOP_HEADERS | {"content-length"}
+
+
+def _point(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Anillo de hash consistente con nodos virtuales; seguro entre hilos."""
+
+    def __init__(self, nodes: Optional[List[str]] = None, virtual_nodes: int = VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self._points: List[int] = []
+        self._owners: Dict[int, str] = {}
+        self._nodes = set()
+        self._lock = threading.Lock()
+        for node in nodes or []:
+            self.add(node)
+
+    @property
+    def nodes(self) -> List[str]:
+        with self._lock:
+            return sorted(self._nodes)
+
+    def add(self, node: str) -> bool:
+        with self._lock:
+            if node in self._nodes:
+                return False
+            self._nodes.add(node)
+            for i in range(self.virtual_nodes):
+                point = _point(f"{node}#{i}")
+                self._owners[point] = node
+                bisect.insort(self._points, point)
+            return True
+
+    def remove(self, node: str) -> bool:
+        with self._lock:
+            if node not in self._nodes:
+                return False
+            self._nodes.discard(node)
+            removed = {point for point, owner in self._owners.items() if owner == node}
+            self._points = [point for point in self._points if point not in removed]
+            for point in removed:
+                del self._owners[point]
+            return True
+
+    def candidates(self, key: str) -> List[str]:
+        """Nodos distintos en orden de preferencia para `key` (el primero es el dueño)."""
+        with self._lock:
+            if not self._points:
+                return []
+            start = bisect.bisect(self._points, _point(key)) % len(self._points)
+            ordered = []
+            for index in itertools.chain(range(start, len(self._points)), range(0, start)):
+                owner = self._owners[self._points[index]]
+                if owner not in ordered:
+                    ordered.append(owner)
+                    if len(ordered) == len(self._nodes):
+                        break
+            return ordered
+
+
+# Rutas que operan sobre un documento: van al worker dueño del documento aunque traigan user_id
+DOCUMENT_ROUTES = ("/sign_document", "/verify_document")
+
+
+def routing_key(path: str, body: bytes) -> Optional[str]:
+    """
+    Clave de afinidad de una solicitud: documento para firmas/verificaciones/revisiones,
+    usuario para material de certificados. None si cualquier worker sirve.
+    """
+    if path.startswith("/documents/"):
+        return "document:" + path.split("/")[2]
+    if not body:
+        return None
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(payload, dict):
+        return None
+    if payload.get("document_id"):
+        return f"document:{payload['document_id']}"
+    if path in DOCUMENT_ROUTES:
+        # Misma clave que usa el worker (document_key_for en main.py): la URL sin query string.
+        # Nunca el usuario: dos firmantes del mismo documento deben compartir lock y revisiones
+        if payload.get("document_url"):
+            return "document:" + payload["document_url"].split("?")[0]
+        return None
+    if payload.get("user_id"):
+        return f"user:{payload['user_id']}"
+    return None
+
+
+class WorkerPool:
+    """Miembros conocidos, su salud y el anillo con los que están vivos."""
+
+    def __init__(self, workers: List[str]):
+        # Los workers entran al anillo con su primer chequeo de disponibilidad exitoso
+        self.known = set(workers)
+        self.failures: Dict[str, int] = {worker: 0 for worker in workers}
+        self.ring = HashRing()
+        self._round_robin = itertools.count()
+
+    def join(self, worker: str):
+        self.known.add(worker)
+        self.failures[worker] = 0
+
+    def leave(self, worker: str):
+        self.known.discard(worker)
+        self.failures.pop(worker, None)
+        self.ring.remove(worker)
+
+    def mark_failed(self, worker: str):
+        """Una falla de conexión al reenviar saca al worker del anillo hasta que vuelva a responder."""
+        self.failures[worker] = HEALTH_FAILURES_TO_EVICT
+        if self.ring.remove(worker):
+            print(f"Worker {worker} fuera del anillo (falla al reenviar)")
+
+    def record_health(self, worker: str, healthy: bool):
+        if worker not in self.known:
+            return
+        if healthy:
+            self.failures[worker] = 0
+            if self.ring.add(worker):
+                print(f"Worker {worker} de vuelta en el anillo")
+        else:
+            self.failures[worker] = self.failures.get(worker, 0) + 1
+            if self.failures[worker] >= HEALTH_FAILURES_TO_EVICT and self.ring.remove(worker):
+                print(f"Worker {worker} fuera del anillo (health check)")
+
+    def candidates(self, key: Optional[str]) -> List[str]:
+        if key is not None:
+            return self.ring.candidates(key)
+        nodes = self.ring.nodes
+        if not nodes:
+            return []
+        offset = next(self._round_robin) % len(nodes)
+        return nodes[offset:] + nodes[:offset]
+
+
+def _workers_from_env() -> List[str]:
+    return [url.strip().rstrip("/") for url in os.getenv("ROUTER_WORKERS", "").split(",") if url.strip()]
+
+
+app = FastAPI(title="Router del Servicio de Firma", version="0.1.0")
+pool = WorkerPool(_workers_from_env())
+_client: Optional[httpx.AsyncClient] = None
+
+
+async def _health_loop():
+    while True:
+        for worker in list(pool.known):
+            try:
+                response = await _client.get(f"{worker}{HEALTH_PATH}", timeout=HEALTH_INTERVAL)
+                pool.record_health(worker, response.status_code == 200)
+            except httpx.HTTPError:
+                pool.record_health(worker, False)
+        await asyncio.sleep(HEALTH_INTERVAL)
+
+
+@app.on_event("startup")
+async def start_router():
+    global _client
+    _client = httpx.AsyncClient(timeout=FORWARD_TIMEOUT, limits=httpx.Limits(max_connections=None, max_keepalive_connections=64))
+    app.state.health_task = asyncio.create_task(_health_loop())
+
+
+@app.on_event("shutdown")
+async def stop_router():
+    app.state.health_task.cancel()
+    await _client.aclose()
+
+
+class WorkerChange(BaseModel):
+    url: str
+
+
+def require_admin(request: Request, authorization: Optional[str] = Header(None)):
+    """
+    Registrar un worker le da todo el tráfico reenviado (headers y cuerpos incluidos):
+    solo con el token de administración, o desde localhost si no hay token configurado.
+    """
+    if ADMIN_TOKEN:
+        scheme, _, token = (authorization or "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            raise HTTPException(status_code=401, detail="Token de administración del router inválido.",
+                                headers={"WWW-Authenticate": "Bearer"})
+    elif request.client is None or request.client.host not in _LOCAL_CLIENTS:
+        raise HTTPException(status_code=403, detail="Administración del router solo desde localhost (o configura ROUTER_ADMIN_TOKEN).")
+
+
+@app.get("/_router/status", dependencies=[Depends(require_admin)])
+async def router_status():
+    return {"known": sorted(pool.known), "in_ring": pool.ring.nodes, "failures": pool.failures}
+
+
+@app.post("/_router/workers", dependencies=[Depends(require_admin)])
+async def join_worker(change: WorkerChange):
+    """Registra un worker; entra al anillo en cuanto responda 200 en /ready."""
+    pool.join(change.url.rstrip("/"))
+    return {"known": sorted(pool.known), "in_ring": pool.ring.nodes}
+
+
+@app.delete("/_router/workers", dependencies=[Depends(require_admin)])
+async def leave_worker(change: WorkerChange):
+    pool.leave(change.url.rstrip("/"))
+    return {"in_ring": pool.ring.nodes}
+
+
+@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE", "HEAD"])
+async def forward(path: str, request: Request):
+    """Reenvía al dueño de la clave; si no responde, al siguiente del anillo."""
+    body = await request.body()
+    key = routing_key(request.url.path, body)
+    headers = {name: value for name, value in request.headers.items() if name.lower() not in _REQUEST_SKIP_HEADERS}
+
+    for worker in pool.candidates(key):
+        upstream = _client.build_request(
+            request.method, f"{worker}{request.url.path}", params=request.query_params, headers=headers, content=body
+        )
+        try:
+            response = await _client.send(upstream, stream=True)
+        except (httpx.ConnectError, httpx.ConnectTimeout):
+            pool.mark_failed(worker)
+            continue
+        response_headers = {name: value for name, value in response.headers.items() if name.lower() not in _HOP_HEADERS}
+        response_headers["X-Routed-To"] = worker
+        return StreamingResponse(
+            response.aiter_raw(), status_code=response.status_code, headers=response_headers,
+            background=BackgroundTask(response.aclose)
+        )
+    return JSONResponse(status_code=503, content={"message": "No hay workers de firma disponibles."})
+
+
+if __name__ == "__main__":
+    import uvicorn
+    print(f"Router de firma con workers: {sorted(pool.known) or '(ninguno, usa POST /_router/workers)'}")
+    uvicorn.run(app, host="localhost", port=int(os.getenv("ROUTER_PORT", "8000")))
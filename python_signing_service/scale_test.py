@@ -0,0 +1,204 @@
+"""
+Prueba local de escalamiento: levanta N procesos del servicio de firma detrás
+del router (router.py) y mide el throughput de /sign_document con 1, 2, 4...
+workers. Con afinidad por documento el throughput debería crecer casi
+linealmente con el número de workers (hasta el número de núcleos).
+
+Uso: python scale_test.py --workers 1,2,4 --requests 200 --clients_per_worker 4
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(os.path.dirname(SERVICE_DIR), "scripts")
+sys.path.insert(0, SCRIPTS_DIR)
+
+PFX_PASSWORD = "scale-test"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _write_pfx(path: str):
+    """PFX de prueba para que los workers firmen de verdad (y no solo copien el archivo)."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.serialization import pkcs12
+    from cryptography import x509
+    from professional_signature_manager import generate_certificate_and_key
+
+    key_pem, cert_pem, _ = generate_certificate_and_key("Scale Test", "scale@casamonarca.org")
+    data = pkcs12.serialize_key_and_certificates(
+        b"scale-test",
+        serialization.load_pem_private_key(key_pem, password=None),
+        x509.load_pem_x509_certificate(cert_pem),
+        None,
+        serialization.BestAvailableEncryption(PFX_PASSWORD.encode()),
+    )
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _serve_documents(directory: str):
+    """Servidor HTTP local que hace de almacenamiento de origen de los PDFs."""
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=directory, **kwargs)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _wait_healthy(url: str, timeout: float = 60, path: str = "/health"):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}{path}", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} no respondió a tiempo")
+
+
+def _wait_in_ring(router_url: str, workers: int, timeout: float = 30):
+    """El router agrega cada worker al anillo con su primer /ready exitoso."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if len(httpx.get(f"{router_url}/_router/status", timeout=1).json()["in_ring"]) == workers:
+            return
+        time.sleep(0.2)
+    raise RuntimeError("El router no agregó a todos los workers al anillo a tiempo")
+
+
+def _start(module: str, port: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"{module}:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=SERVICE_DIR, env=env, stdout=subprocess.DEVNULL,
+    )
+
+
+def run_case(workers: int, requests: int, clients_per_worker: int, workdir: str, documents_url: str) -> dict:
+    router_port = _free_port()
+    router_url = f"http://127.0.0.1:{router_port}"
+    env = {
+        **os.environ,
+        "PFX_FILE_PATH": os.path.join(workdir, "scale.pfx"),
+        "PFX_PASSPHRASE": PFX_PASSWORD,
+        "CONTENT_STORE_DIR": os.path.join(workdir, f"content-{workers}"),
+        "AUDIT_LOG_PATH": os.path.join(workdir, f"audit-{workers}.jsonl"),
+        "SIGNED_DOCS_BASE_URL": router_url,  # Las URLs firmadas apuntan al router, no al worker
+    }
+    processes = []
+    try:
+        worker_urls = []
+        for _ in range(workers):
+            port = _free_port()
+            processes.append(_start("main", port, env))
+            worker_urls.append(f"http://127.0.0.1:{port}")
+        processes.append(_start("router", router_port, {**env, "ROUTER_WORKERS": ",".join(worker_urls)}))
+        for url in worker_urls:
+            _wait_healthy(url, path="/ready")
+        _wait_healthy(router_url)
+        _wait_in_ring(router_url, len(worker_urls))
+
+        def sign(i: int):
+            payload = {
+                "document_url": f"{documents_url}/documento.pdf",
+                "original_file_name": f"documento-{i}.pdf",
+                "document_id": f"scale-{i}",
+                "lane": "bulk",  # Un lote: no compite con el carril interactivo
+            }
+            started = time.perf_counter()
+            response = httpx.post(f"{router_url}/sign_document", json=payload, timeout=300)
+            return response.status_code, response.headers.get("x-routed-to"), time.perf_counter() - started
+
+        with ThreadPoolExecutor(clients_per_worker * workers) as pool:
+            list(pool.map(sign, range(min(workers * 2, requests))))  # Calentamiento: cachés PFX y conexiones
+            started = time.perf_counter()
+            results = list(pool.map(sign, range(requests)))
+            elapsed = time.perf_counter() - started
+
+        errors = sum(1 for status, _, _ in results if status != 200)
+        per_worker = {}
+        for _, routed_to, _ in results:
+            per_worker[routed_to] = per_worker.get(routed_to, 0) + 1
+        latencies = sorted(latency for _, _, latency in results)
+        return {
+            "workers": workers,
+            "requests": requests,
+            "errors": errors,
+            "elapsed_seconds": round(elapsed, 3),
+            "throughput_rps": round(requests / elapsed, 2),
+            "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+            "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 1),
+            "requests_per_worker": per_worker,
+        }
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Escalamiento del servicio de firma detrás del router")
+    parser.add_argument("--workers", default="1,2,4", help="Cantidades de workers a probar, separadas por comas")
+    parser.add_argument("--requests", type=int, default=200, help="Solicitudes de firma por caso")
+    parser.add_argument("--clients_per_worker", type=int, default=4, help="Clientes concurrentes por worker")
+    parser.add_argument("--pages", type=int, default=20, help="Páginas del PDF sintético")
+    parser.add_argument("--min_efficiency", type=float, default=0.0,
+                        help="Falla si throughput(N)/(N*throughput(1)) queda por debajo (ej. 0.7)")
+    args = parser.parse_args()
+
+    from benchmark_signatures import make_synthetic_pdf
+
+    workdir = tempfile.mkdtemp(prefix="signing-scale-")
+    try:
+        _write_pfx(os.path.join(workdir, "scale.pfx"))
+        documents_dir = os.path.join(workdir, "documents")
+        os.makedirs(documents_dir)
+        with open(os.path.join(documents_dir, "documento.pdf"), "wb") as f:
+            f.write(make_synthetic_pdf(args.pages))
+        server = _serve_documents(documents_dir)
+        documents_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        cases = [run_case(int(n), args.requests, args.clients_per_worker, workdir, documents_url)
+                 for n in args.workers.split(",")]
+        server.shutdown()
+
+        baseline = cases[0]["throughput_rps"] / cases[0]["workers"]
+        for case in cases:
+            case["speedup"] = round(case["throughput_rps"] / cases[0]["throughput_rps"], 2)
+            case["efficiency"] = round(case["throughput_rps"] / (case["workers"] * baseline), 2)
+        ok = all(case["errors"] == 0 and case["efficiency"] >= args.min_efficiency for case in cases)
+        print(json.dumps({"success": ok, "cpu_count": os.cpu_count(), "cases": cases}, indent=2))
+        sys.exit(0 if ok else 1)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
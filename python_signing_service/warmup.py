@@ -0,0 +1,184 @@
+"""
+Calentamiento del servicio de firma y estado de disponibilidad (`/ready`).
+
+Sin calentamiento, la primera solicitud de cada worker paga los imports de
+PyHanko, la inicialización de las primitivas criptográficas, el descifrado
+del PFX (KDF lento) y la apertura de sesiones PKCS#11. `run()` hace todo eso
+antes de declarar el proceso listo: importa los módulos, carga los firmantes
+configurados y firma y verifica un PDF diminuto incluido aquí mismo.
+
+Con gunicorn y `preload_app` (ver gunicorn.conf.py) el calentamiento corre
+una vez en el proceso maestro antes del fork: los módulos, las tablas
+criptográficas y los firmantes descifrados se comparten entre workers por
+copy-on-write. Cada worker repite después solo lo que no sobrevive a un fork
+(sesiones PKCS#11) y una firma de prueba, que ya es rápida.
+"""
+
+import io
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, List
+
+import metrics
+
+# Estados de `state["status"]`
+PENDING = "pending"
+WARMING = "warming"
+READY = "ready"
+FAILED = "failed"
+
+state = {
+    "status": PENDING,
+    "pid": os.getpid(),
+    "preloaded_in": None,  # pid del maestro si el calentamiento se heredó por fork
+    "steps": {},
+    "signers": 0,
+    "error": None,
+}
+_lock = threading.Lock()
+
+
+def _tiny_pdf() -> bytes:
+    """PDF mínimo válido de una página, con su tabla xref calculada."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 200 200] >>",
+    ]
+    out = bytearray(b"%PDF-1.7\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref_offset = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+    return bytes(out)
+
+
+TINY_PDF = _tiny_pdf()
+
+
+def _import_modules():
+    import pyhanko_certvalidator  # noqa: F401
+    from pyhanko.pdf_utils import incremental_writer, reader  # noqa: F401
+    from pyhanko.sign import fields, signers, validation  # noqa: F401
+    from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa  # noqa: F401
+    from cryptography.hazmat.primitives.serialization import pkcs12  # noqa: F401
+
+
+def _ephemeral_signer():
+    """Firmante autofirmado en memoria, para calentar el camino de firma sin certificado configurado."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+    from pyhanko.keys import load_certs_from_pemder_data, load_private_key_from_pemder_data
+    from pyhanko.sign import signers
+    from pyhanko_certvalidator.registry import SimpleCertificateStore
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "Warm-up")])
+    now = datetime.now(timezone.utc)
+    cert = (
+        x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+        .serial_number(x509.random_serial_number()).not_valid_before(now - timedelta(minutes=1))
+        .not_valid_after(now + timedelta(days=1)).sign(key, hashes.SHA256())
+    )
+    signing_cert = next(iter(load_certs_from_pemder_data(cert.public_bytes(serialization.Encoding.PEM))))
+    return signers.SimpleSigner(
+        signing_cert=signing_cert,
+        signing_key=load_private_key_from_pemder_data(
+            key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                              serialization.NoEncryption()),
+            passphrase=None,
+        ),
+        cert_registry=SimpleCertificateStore.from_certs([signing_cert]),
+    )
+
+
+def _sign_and_verify(signer):
+    """Firma el PDF diminuto en memoria y valida el resultado confiando en el propio certificado."""
+    from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter
+    from pyhanko.pdf_utils.reader import PdfFileReader
+    from pyhanko.sign import signers
+    from pyhanko.sign.validation import validate_pdf_signature
+    from pyhanko_certvalidator import ValidationContext
+
+    output = signers.PdfSigner(signers.PdfSignatureMetadata(field_name="Warmup"), signer=signer).sign_pdf(
+        IncrementalPdfFileWriter(io.BytesIO(TINY_PDF))
+    )
+    context = ValidationContext(trust_roots=[signer.signing_cert], allow_fetching=False)
+    sig = PdfFileReader(output).embedded_signatures[0]
+    status = validate_pdf_signature(sig, signer_validation_context=context)
+    if not (status.intact and status.valid):
+        raise RuntimeError(f"La firma de calentamiento no es válida: {status.summary()}")
+
+
+def _step(name: str, function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - started
+    state["steps"][name] = round(elapsed, 4)
+    metrics.WARMUP_SECONDS.set(elapsed, step=name)
+    return result
+
+
+def run(load_signers: Callable[[bool], List], fork_safe_only: bool = False) -> dict:
+    """
+    Calienta el proceso y lo marca listo. `load_signers(fork_safe_only)` devuelve los
+    firmantes a precargar; con `fork_safe_only` (maestro antes del fork) no debe abrir
+    recursos que no sobreviven a un fork, como sesiones PKCS#11.
+    """
+    with _lock:
+        inherited = state["status"] == READY and state["pid"] != os.getpid()
+        state.update(status=WARMING, error=None, steps={})
+        if inherited:
+            state["preloaded_in"] = state["pid"]
+        state["pid"] = os.getpid()
+        started = time.perf_counter()
+        try:
+            _step("imports", _import_modules)
+            loaded = _step("signers", load_signers, fork_safe_only)
+            state["signers"] = len(loaded)
+            probe = loaded[0] if loaded else _step("ephemeral_signer", _ephemeral_signer)
+            _step("sign_verify", _sign_and_verify, probe)
+        except Exception as e:
+            state.update(status=FAILED, error=str(e))
+            print(f"Error en el calentamiento: {e}")
+            return dict(state)
+        state["steps"]["total"] = round(time.perf_counter() - started, 4)
+        metrics.WARMUP_SECONDS.set(state["steps"]["total"], step="total")
+        # En el maestro (fork_safe_only) esto no basta: is_ready() exige que cada worker
+        # haya corrido su propio run(), que reutiliza lo heredado
+        state["status"] = READY
+        print(f"Calentamiento completo en {state['steps']['total']:.3f}s (pid {os.getpid()}): {state['steps']}")
+        return dict(state)
+
+
+def skip():
+    """WARMUP_ENABLED=0: el proceso se declara listo sin calentar."""
+    with _lock:
+        state.update(status=READY, pid=os.getpid(), steps={}, error=None)
+
+
+def is_ready() -> bool:
+    return state["status"] == READY and state["pid"] == os.getpid()
+
+
+def snapshot() -> dict:
+    return {**state, "ready": is_ready(), "steps": dict(state["steps"])}
+
+
+def freeze_for_fork():
+    """
+    Mueve los objetos vivos a la generación permanente del GC antes del fork: las
+    recolecciones de los workers no tocan sus cabeceras y las páginas se quedan compartidas.
+    """
+    import gc
+    gc.collect()
+    gc.freeze()
@@ -0,0 +1,446 @@
+"""
+Append-only, hash-chained audit log for signing events.
+
+Every sign, verify and certificate-issue event becomes one JSON line whose
+`hash` covers the previous line's hash, so any edit, removal or reordering
+breaks the chain (see verify_chain). `record()` only enqueues the event: a
+background writer thread group-commits batches with a single fsync, bounded
+by `flush_interval`, so the signing hot path never waits on the disk.
+
+A batch that cannot be written stays queued and is retried: events are
+never dropped. The failure is reported on stderr, and `flush()` and
+durable records raise AuditLogError until the log is writable again. A
+crash in the middle of a write leaves a torn last line; the next commit
+moves it to `<log>.torn`, truncates the log back to its last complete
+entry and records an `audit_log_recovered` event in the chain.
+
+A SQLite side index (`<log>.idx.sqlite3`, seq/document_id/offset keyed by
+document_id) finds a document's events without scanning the log. Writers
+in several processes (CLI runs, service workers) share the files under an
+exclusive flock and continue the same chain.
+"""
+
+import atexit
+import fcntl
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+GENESIS_HASH = "0" * 64
+DEFAULT_LOG_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "audit", "signing_audit.jsonl"
+)
+DEFAULT_FLUSH_INTERVAL = 0.05
+DEFAULT_MAX_BATCH = 512
+RETRY_INTERVAL = 1.0
+_TAIL_PROBE_BYTES = 64 * 1024
+
+
+class AuditLogError(RuntimeError):
+    """The audit log could not be written; the events stay queued and are retried."""
+
+
+def _canonical(entry):
+    return json.dumps(entry, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def chain_hash(prev_hash, entry):
+    """Hash of an entry (without its `hash` key) chained to the previous entry's hash."""
+    body = {key: value for key, value in entry.items() if key != "hash"}
+    return hashlib.sha256((prev_hash + _canonical(body)).encode("utf-8")).hexdigest()
+
+
+def _line_before(log_file, end):
+    """(offset, bytes) of the line that ends at `end` (exclusive, without its newline)."""
+    probe = _TAIL_PROBE_BYTES
+    while True:
+        start = max(0, end - probe)
+        log_file.seek(start)
+        data = log_file.read(end - start)
+        cut = data.rfind(b"\n")
+        if cut >= 0 or start == 0:
+            return start + cut + 1, data[cut + 1:]
+        probe *= 2
+
+
+def _parse_entry(line):
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return None
+    return entry if isinstance(entry, dict) and "seq" in entry and "hash" in entry else None
+
+
+def _recover_tail(log_file, size):
+    """
+    Last entry of the log and the size the log should have: bytes after the last newline
+    (a write cut short by a crash) and a final line that is not a valid entry are torn.
+    Anything worse than that is left for verify_chain and raises AuditLogError.
+    """
+    if size == 0:
+        return None, 0
+    log_file.seek(size - 1)
+    end = size if log_file.read(1) == b"\n" else _line_before(log_file, size)[0]
+    if end == 0:
+        return None, 0
+    start, line = _line_before(log_file, end - 1)
+    entry = _parse_entry(line)
+    if entry is not None:
+        return entry, end
+    if start == 0:
+        return None, 0
+    entry = _parse_entry(_line_before(log_file, start - 1)[1])
+    if entry is None:
+        raise AuditLogError("El registro de auditoría está dañado antes de su última línea; revísalo con verify_chain.")
+    return entry, start
+
+
+def _index_rows(log_file, start, end):
+    """(seq, document_id, offset) of the entries with a document in log bytes [start, end)."""
+    log_file.seek(start)
+    offset = start
+    while offset < end:
+        line = log_file.readline()
+        if not line:
+            break
+        entry = json.loads(line)
+        if entry.get("document_id") is not None:
+            yield entry["seq"], str(entry["document_id"]), offset
+        offset += len(line)
+
+
+def _connect_index(index_path):
+    db = sqlite3.connect(index_path, timeout=30, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS audit_index (
+            seq INTEGER PRIMARY KEY,
+            document_id TEXT NOT NULL,
+            offset INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS audit_index_document ON audit_index (document_id, seq);
+        CREATE TABLE IF NOT EXISTS audit_index_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            indexed_size INTEGER NOT NULL
+        );
+        """
+    )
+    return db
+
+
+def _indexed_size(db):
+    row = db.execute("SELECT indexed_size FROM audit_index_state").fetchone()
+    return row[0] if row else 0
+
+
+def _update_index(db, log_file, size, new_rows=(), new_from=None):
+    """
+    Brings the index up to log byte `size`. `new_rows` are the rows of the batch just
+    written at `new_from`; anything older that is not indexed yet (a previous index
+    failure, a truncated log) is read back from the log.
+    """
+    indexed = _indexed_size(db)
+    reset = indexed > size
+    if reset:
+        indexed = 0
+    rows = list(_index_rows(log_file, indexed, new_from if new_from is not None else size))
+    rows.extend(new_rows)
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        if reset:
+            db.execute("DELETE FROM audit_index")
+        db.executemany("INSERT OR REPLACE INTO audit_index (seq, document_id, offset) VALUES (?, ?, ?)", rows)
+        db.execute("INSERT OR REPLACE INTO audit_index_state (id, indexed_size) VALUES (1, ?)", (size,))
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    return len(rows)
+
+
+class _Waiter:
+    """Signals a caller of flush() or record(durable=True) when its batch is done."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise AuditLogError(f"El registro de auditoría no se pudo escribir: {self.error}") from self.error
+
+
+class AuditLog:
+    """Group-committing, hash-chained JSON-lines log. One instance per process is enough (see get_audit_log)."""
+
+    def __init__(self, path=DEFAULT_LOG_PATH, flush_interval=DEFAULT_FLUSH_INTERVAL, max_batch=DEFAULT_MAX_BATCH):
+        self.path = path
+        self.index_path = path + ".idx.sqlite3"
+        self.quarantine_path = path + ".torn"
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.last_error = None
+        self._queue = queue.Queue()
+        self._pending = []  # Entries of a failed commit, retried ahead of new ones
+        self._index_db = None
+        self._closed = False
+        self._pid = os.getpid()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._writer = threading.Thread(target=self._run, name="audit-log-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def record(self, event, document_id=None, durable=False, **fields):
+        """
+        Queues an event and returns immediately. With `durable=True` it waits until
+        the batch containing the event has been fsynced, and raises AuditLogError if
+        it could not be (the event stays queued).
+        """
+        if self._closed:
+            raise RuntimeError("El registro de auditoría ya está cerrado.")
+        entry = {
+            "ts": datetime.now(timezone.utc).isoformat(),
+            "event": event,
+            "document_id": document_id,
+            "pid": os.getpid(),
+            **fields,
+        }
+        committed = _Waiter() if durable else None
+        self._queue.put((entry, committed))
+        if committed is not None:
+            committed.wait()
+
+    def flush(self):
+        """Blocks until every event queued so far is on disk; raises AuditLogError if the write failed."""
+        committed = _Waiter()
+        self._queue.put((None, committed))
+        committed.wait()
+
+    def close(self):
+        if self._closed or self._pid != os.getpid():
+            return
+        try:
+            self.flush()
+        except AuditLogError as e:
+            print(f"❌ {len(self._pending)} evento(s) de auditoría sin escribir al cerrar: {e}", file=sys.stderr)
+        self._closed = True
+        self._queue.put(None)
+        self._writer.join()
+
+    def _run(self):
+        while True:
+            try:
+                # With events pending a retry, wake up even if nothing new arrives
+                item = self._queue.get(timeout=RETRY_INTERVAL if self._pending else None)
+            except queue.Empty:
+                item = (None, None)
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)  # Re-queued so the loop exits after this batch
+                    break
+                batch.append(item)
+            entries = self._pending + [entry for entry, _ in batch if entry is not None]
+            error = None
+            try:
+                self._commit(entries)
+            except Exception as e:
+                # Auditing must not take the signing path down, but nothing is dropped: the entries
+                # are retried and the failure is reported loudly (on stderr: the CLI scripts print
+                # their JSON result on stdout) and to whoever waits for them
+                error = e
+                if self.last_error is None:
+                    print(f"❌ Error escribiendo el registro de auditoría (se reintentará): {e}", file=sys.stderr)
+                self._pending, self.last_error = entries, e
+            else:
+                if self.last_error is not None:
+                    print(f"✅ Registro de auditoría escrito de nuevo ({len(entries)} evento(s) pendientes)", file=sys.stderr)
+                self._pending, self.last_error = [], None
+            for _, committed in batch:
+                if committed is not None:
+                    committed.error = error
+                    committed.event.set()
+
+    def _quarantine(self, log_file, start, end):
+        """Moves log bytes [start, end) to `<log>.torn` and truncates the log at `start`."""
+        log_file.seek(start)
+        torn = log_file.read(end - start)
+        with open(self.quarantine_path, "ab") as quarantine_file:
+            quarantine_file.write(torn + b"\n")
+            quarantine_file.flush()
+            os.fsync(quarantine_file.fileno())
+        log_file.truncate(start)
+        os.fsync(log_file.fileno())
+        print(
+            f"⚠️ Registro de auditoría: {len(torn)} byte(s) incompletos al final movidos a {self.quarantine_path}",
+            file=sys.stderr,
+        )
+        return {
+            "ts": datetime.now(timezone.utc).isoformat(),
+            "event": "audit_log_recovered",
+            "document_id": None,
+            "pid": os.getpid(),
+            "offset": start,
+            "quarantined_bytes": len(torn),
+            "quarantine_path": self.quarantine_path,
+        }
+
+    def _commit(self, entries):
+        if not entries:
+            return
+        with open(self.path, "a+b") as log_file:
+            fcntl.flock(log_file.fileno(), fcntl.LOCK_EX)
+            try:
+                size = os.fstat(log_file.fileno()).st_size
+                last, valid_size = _recover_tail(log_file, size)
+                if valid_size < size:
+                    entries = [self._quarantine(log_file, valid_size, size)] + entries
+                    size = valid_size
+                seq = last["seq"] if last else 0
+                prev_hash = last["hash"] if last else GENESIS_HASH
+
+                lines, index_rows = [], []
+                offset = size
+                for entry in entries:
+                    seq += 1
+                    entry = {**entry, "seq": seq, "prev_hash": prev_hash}
+                    entry["hash"] = prev_hash = chain_hash(prev_hash, entry)
+                    line = (_canonical(entry) + "\n").encode("utf-8")
+                    if entry.get("document_id") is not None:
+                        index_rows.append((seq, str(entry["document_id"]), offset))
+                    lines.append(line)
+                    offset += len(line)
+
+                try:
+                    log_file.write(b"".join(lines))
+                    log_file.flush()
+                    os.fsync(log_file.fileno())
+                except BaseException:
+                    # Nothing of a failed batch stays in the log, so its retry does not duplicate entries
+                    log_file.truncate(size)
+                    raise
+                try:
+                    # The index is derived data: written after the log is durable, and a failure here
+                    # is caught up by the next commit (or rebuild_index) instead of retrying the batch
+                    if self._index_db is None:
+                        self._index_db = _connect_index(self.index_path)
+                    _update_index(self._index_db, log_file, offset, index_rows, new_from=size)
+                except Exception as e:
+                    print(f"⚠️ Índice de auditoría sin actualizar (se pondrá al día): {e}", file=sys.stderr)
+            finally:
+                fcntl.flock(log_file.fileno(), fcntl.LOCK_UN)
+
+    # --- Lectura ---
+    def events_for_document(self, document_id):
+        """Events of `document_id` in log order, located through the index."""
+        self.flush()
+        document_id = str(document_id)
+        with open(self.path, "rb") as log_file:
+            size = os.fstat(log_file.fileno()).st_size
+            db = _connect_index(self.index_path)
+            try:
+                offsets = [row[0] for row in db.execute(
+                    "SELECT offset FROM audit_index WHERE document_id = ? ORDER BY seq", (document_id,)
+                )]
+                indexed = _indexed_size(db)
+            finally:
+                db.close()
+            # Entries the index has not caught up with yet (after an index failure)
+            offsets.extend(offset for _, doc, offset in _index_rows(log_file, indexed, size) if doc == document_id)
+            events = []
+            for offset in offsets:
+                log_file.seek(offset)
+                events.append(json.loads(log_file.readline()))
+        return events
+
+
+def verify_chain(path=DEFAULT_LOG_PATH):
+    """Recomputes the whole chain. Returns {"ok", "entries", "first_broken_seq"}."""
+    prev_hash, count = GENESIS_HASH, 0
+    with open(path, encoding="utf-8") as log_file:
+        for line in log_file:
+            entry = json.loads(line)
+            count += 1
+            if entry.get("prev_hash") != prev_hash or chain_hash(prev_hash, entry) != entry.get("hash"):
+                return {"ok": False, "entries": count, "first_broken_seq": entry.get("seq")}
+            prev_hash = entry["hash"]
+    return {"ok": True, "entries": count, "first_broken_seq": None}
+
+
+def rebuild_index(path=DEFAULT_LOG_PATH):
+    """Regenerates `<log>.idx.sqlite3` from the log."""
+    with open(path, "rb") as log_file:
+        fcntl.flock(log_file.fileno(), fcntl.LOCK_EX)
+        try:
+            db = _connect_index(path + ".idx.sqlite3")
+            try:
+                db.execute("DELETE FROM audit_index_state")
+                return _update_index(db, log_file, os.fstat(log_file.fileno()).st_size)
+            finally:
+                db.close()
+        finally:
+            fcntl.flock(log_file.fileno(), fcntl.LOCK_UN)
+
+
+_default_log = None
+_default_lock = threading.Lock()
+
+
+def get_audit_log():
+    """Process-wide log at AUDIT_LOG_PATH (default: audit/signing_audit.jsonl at the repository root)."""
+    global _default_log
+    with _default_lock:
+        # A forked child inherits the instance but not its writer thread
+        if _default_log is None or _default_log._pid != os.getpid():
+            _default_log = AuditLog(os.getenv("AUDIT_LOG_PATH", DEFAULT_LOG_PATH))
+        return _default_log
+
+
+def audit(event, document_id=None, **fields):
+    """Shortcut for get_audit_log().record(...)."""
+    get_audit_log().record(event, document_id=document_id, **fields)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect the signing audit log")
+    parser.add_argument("--action", required=True, choices=["verify_chain", "document", "rebuild_index"])
+    parser.add_argument("--log_path", default=os.getenv("AUDIT_LOG_PATH", DEFAULT_LOG_PATH))
+    parser.add_argument("--document_id", help="Document whose events to list (document)")
+    args = parser.parse_args()
+
+    if args.action == "verify_chain":
+        result = verify_chain(args.log_path)
+        print(json.dumps(result))
+        sys.exit(0 if result["ok"] else 1)
+    elif args.action == "rebuild_index":
+        print(json.dumps({"indexed": rebuild_index(args.log_path)}))
+    else:
+        if not args.document_id:
+            print(json.dumps({"error": "document_id is required."}))
+            sys.exit(1)
+        log = AuditLog(args.log_path)
+        print(json.dumps(log.events_for_document(args.document_id), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Signature Benchmark Suite for Casa Monarca
+Measures sign, verify and certificate generation paths on synthetic PDFs
+and reports throughput, latency percentiles and peak RSS as JSON.
+"""
+
+import argparse
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+import multiprocessing
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "scripts"))
+sys.path.insert(0, os.path.join(REPO_ROOT, "backend"))
+
+TARGETS = [
+    "manager_sign",
+    "backend_sign",
+    "backend_sign_encrypted",
+    "manager_verify",
+    "generate_certificate",
+    "sign_pdf_inplace",
+    "sign_document_endpoint",
+]
+KEY_TYPES = ["rsa2048", "rsa3072", "ec-p256"]
+
+
+def make_synthetic_pdf(pages: int) -> bytes:
+    """Builds a minimal, well-formed PDF with `pages` text pages."""
+    objects = []
+    page_ids = [3 + 2 * i for i in range(pages)]
+    objects.append(b"<< /Type /Catalog /Pages 2 0 R >>")
+    kids = b" ".join(b"%d 0 R" % pid for pid in page_ids)
+    objects.append(b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % pages)
+    font_id = 3 + 2 * pages
+    for i, page_id in enumerate(page_ids):
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>" % (font_id, page_id + 1)
+        )
+        content = b"BT /F1 12 Tf 72 720 Td (Casa Monarca - pagina %d) Tj ET" % (i + 1)
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for num, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % num + body + b"\nendobj\n")
+    xref_offset = out.tell()
+    out.write(b"xref\n0 %d\n" % (len(objects) + 1))
+    out.write(b"0000000000 65535 f \n")
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\n" % (len(objects) + 1))
+    out.write(b"startxref\n%d\n%%%%EOF\n" % xref_offset)
+    return out.getvalue()
+
+
+def generate_key_pair(key_type: str, common_name: str = "Benchmark", email: str = "bench@casamonarca.org"):
+    """Returns (private_key_pem, certificate_pem) for the given key type."""
+    from professional_signature_manager import generate_certificate_and_key
+
+    private_key_pem, certificate_pem, _ = generate_certificate_and_key(common_name, email, key_type=key_type)
+    return private_key_pem, certificate_pem
+
+
+def add_existing_signatures(pdf_bytes: bytes, count: int, key_type: str) -> bytes:
+    """Applies `count` incremental signatures so verify/sign run over signed revisions."""
+    if count == 0:
+        return pdf_bytes
+    from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter
+    from pyhanko.sign import signers
+
+    private_key_pem, certificate_pem = generate_key_pair(key_type, "Firmante Previo")
+    with tempfile.TemporaryDirectory() as tmp:
+        key_path, cert_path = _write_pems(tmp, private_key_pem, certificate_pem)
+        signer = signers.SimpleSigner.load(key_path, cert_path)
+
+    for i in range(count):
+        writer = IncrementalPdfFileWriter(io.BytesIO(pdf_bytes))
+        out = signers.sign_pdf(
+            writer,
+            signers.PdfSignatureMetadata(field_name=f"Previa{i + 1}"),
+            signer=signer,
+        )
+        pdf_bytes = out.getvalue()
+    return pdf_bytes
+
+
+def _write_pems(folder: str, private_key_pem: bytes, certificate_pem: bytes):
+    key_path = os.path.join(folder, "key.pem")
+    cert_path = os.path.join(folder, "cert.pem")
+    with open(key_path, "wb") as f:
+        f.write(private_key_pem)
+    with open(cert_path, "wb") as f:
+        f.write(certificate_pem)
+    return key_path, cert_path
+
+
+def _reset_peak_rss():
+    """Resets the kernel high-water mark so setup cost is not reported (Linux only)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_bytes():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def _serve_directory(folder: str):
+    """Serves `folder` over HTTP on an ephemeral port so /sign_document can download from it."""
+
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=folder, **kwargs)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _build_operation(case, workdir):
+    """Prepares inputs for a case and returns a zero-argument callable to time."""
+    target = case["target"]
+    key_type = case["key_type"]
+
+    if target == "generate_certificate":
+        from professional_signature_manager import generate_certificate_and_key
+
+        return lambda: generate_certificate_and_key("Benchmark", "bench@casamonarca.org", key_type=key_type)
+
+    pdf_bytes = add_existing_signatures(make_synthetic_pdf(case["pages"]), case["existing_signatures"], key_type)
+
+    if target == "manager_sign":
+        from digital_signature_manager import DigitalSignatureManager
+
+        manager = DigitalSignatureManager()
+        return lambda: manager.sign_pdf(pdf_bytes, "Benchmark", "bench@casamonarca.org")
+
+    if target in ("backend_sign", "backend_sign_encrypted"):
+        # DigitalSignatureManager over the in-memory Supabase stand-in; the encrypted variant stores
+        # the key envelope-encrypted under the KMS stand-in and pays its round trip on cache misses
+        os.environ["AUDIT_LOG_PATH"] = os.path.join(workdir, "audit.jsonl")
+        if target == "backend_sign_encrypted":
+            os.environ["KEY_KMS_STANDIN_DIR"] = os.path.join(workdir, "kms")
+        sys.stdout = sys.stderr  # The backend logs every step; this process only returns results
+        from digital_signature_backend import DigitalSignatureManager
+        from fake_supabase import FakeSupabaseClient
+
+        manager = DigitalSignatureManager(None, None, client=FakeSupabaseClient())
+        private_key_pem, certificate_pem = generate_key_pair(key_type)
+        certificate_id = manager.save_certificate_to_supabase("bench", "Benchmark", private_key_pem, certificate_pem, 1)
+        return lambda: manager.sign_pdf_with_certificate(pdf_bytes, "bench", certificate_id, "Benchmark")
+
+    if target == "manager_verify":
+        from digital_signature_manager import DigitalSignatureManager
+
+        manager = DigitalSignatureManager()
+        return lambda: manager.verify_signatures(pdf_bytes)
+
+    if target == "sign_pdf_inplace":
+        from firma_digital import sign_pdf_inplace
+
+        private_key_pem, certificate_pem = generate_key_pair(key_type)
+        key_path, cert_path = _write_pems(workdir, private_key_pem, certificate_pem)
+        counter = iter(range(1, 10 ** 9))
+
+        def run():
+            # Each run signs a fresh copy so every iteration sees the same input
+            n = next(counter)
+            pdf_path = os.path.join(workdir, f"inplace_{threading.get_ident()}_{n}.pdf")
+            with open(pdf_path, "wb") as f:
+                f.write(pdf_bytes)
+            sign_pdf_inplace(pdf_path, key_path, cert_path, field_name=f"Bench{n}")
+            os.remove(pdf_path)
+
+        return run
+
+    if target == "sign_document_endpoint":
+        file_name = "bench.pdf"
+        with open(os.path.join(workdir, file_name), "wb") as f:
+            f.write(pdf_bytes)
+        server = _serve_directory(workdir)
+        document_url = f"http://127.0.0.1:{server.server_address[1]}/{file_name}"
+        endpoint = case["service_url"].rstrip("/") + "/sign_document"
+        body = json.dumps({
+            "document_url": document_url,
+            "original_file_name": file_name,
+            "signer_info": {"name": "Benchmark", "email": "bench@casamonarca.org"},
+        }).encode("utf-8")
+
+        def run():
+            request = urllib.request.Request(endpoint, data=body, headers={"Content-Type": "application/json"})
+            with urllib.request.urlopen(request, timeout=300) as response:
+                response.read()
+
+        return run
+
+    raise ValueError(f"Unknown target: {target}")
+
+
+def run_case(case):
+    """Runs one benchmark case; executed in a fresh process so peak RSS is per case."""
+    with tempfile.TemporaryDirectory() as workdir:
+        operation = _build_operation(case, workdir)
+        for _ in range(case["warmup"]):
+            operation()
+
+        _reset_peak_rss()
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+
+        def timed():
+            start = time.perf_counter()
+            try:
+                operation()
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                return
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=case["clients"]) as pool:
+            for _ in range(case["iterations"]):
+                pool.submit(timed)
+        wall = time.perf_counter() - wall_start
+
+    latencies.sort()
+    to_ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        **{k: v for k, v in case.items() if k not in ("warmup", "service_url")},
+        "ok": len(latencies),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "wall_seconds": round(wall, 4),
+        "throughput_ops_per_sec": round(len(latencies) / wall, 3) if wall > 0 else None,
+        "latency_ms": {
+            "mean": to_ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": to_ms(_percentile(latencies, 50)),
+            "p95": to_ms(_percentile(latencies, 95)),
+            "p99": to_ms(_percentile(latencies, 99)),
+            "max": to_ms(latencies[-1] if latencies else None),
+        },
+        # For the endpoint target this is the client process; the service RSS is not visible here
+        "peak_rss_bytes": _peak_rss_bytes(),
+    }
+
+
+def build_cases(args):
+    cases = []
+    for target in args.targets:
+        for key_type in args.key_types:
+            for clients in args.clients:
+                if target == "generate_certificate":
+                    shapes = [(0, 0)]
+                else:
+                    shapes = [(p, s) for p in args.pages for s in args.existing_signatures]
+                for pages, existing in shapes:
+                    cases.append({
+                        "target": target,
+                        "key_type": key_type,
+                        "pages": pages,
+                        "existing_signatures": existing,
+                        "clients": clients,
+                        "iterations": args.iterations,
+                        "warmup": args.warmup,
+                        "service_url": args.service_url,
+                    })
+    return cases
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def _str_list(choices):
+    def parse(value):
+        items = [v for v in value.split(",") if v]
+        for item in items:
+            if item not in choices:
+                raise argparse.ArgumentTypeError(f"'{item}' is not one of {', '.join(choices)}")
+        return items
+    return parse
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark suite for signing, verification and certificate generation")
+    parser.add_argument("--targets", type=_str_list(TARGETS), default=[t for t in TARGETS if t != "sign_document_endpoint"],
+                        help=f"Comma separated targets ({', '.join(TARGETS)})")
+    parser.add_argument("--pages", type=_int_list, default=[1, 10, 100, 1000], help="Comma separated page counts")
+    parser.add_argument("--existing_signatures", type=_int_list, default=[0, 5, 20],
+                        help="Comma separated counts of pre-existing signatures")
+    parser.add_argument("--key_types", type=_str_list(KEY_TYPES), default=KEY_TYPES, help="Comma separated key types")
+    parser.add_argument("--clients", type=_int_list, default=[1, 8], help="Comma separated concurrent client counts")
+    parser.add_argument("--iterations", type=int, default=20, help="Timed operations per case")
+    parser.add_argument("--warmup", type=int, default=2, help="Untimed operations per case")
+    parser.add_argument("--service_url", default="http://localhost:8000", help="Base URL of python_signing_service")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = {
+        "started_at": datetime.utcnow().isoformat(),
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "cpu_count": os.cpu_count(),
+        "results": [],
+    }
+
+    context = multiprocessing.get_context("spawn")
+    for case in build_cases(args):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            try:
+                result = pool.submit(run_case, case).result()
+            except Exception as e:
+                result = {"target": case["target"], "key_type": case["key_type"], "pages": case["pages"],
+                          "existing_signatures": case["existing_signatures"], "clients": case["clients"],
+                          "error": str(e)}
+        report["results"].append(result)
+        print(f"{result['target']} {result['key_type']} pages={result['pages']} "
+              f"sigs={result['existing_signatures']} clients={result['clients']}: "
+              f"{result.get('throughput_ops_per_sec')} ops/s", file=sys.stderr)
+
+    report["finished_at"] = datetime.utcnow().isoformat()
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Bulk offline verification of signed PDFs for audits.
+
+Walks a directory (or reads a manifest of paths), verifies every document in
+a process pool through read-only memory maps, and streams one JSON line per
+document with each signature's field name, signer CN, intact/valid/trusted
+flags and timing. Completed paths are appended to a checkpoint file, so an
+interrupted run resumes where it stopped. Throughput statistics are printed
+to stderr.
+
+Validation is offline: revocation information is never fetched.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+PROGRESS_EVERY = 1000
+CHECKPOINT_SYNC_EVERY = 100
+
+# Set in each worker by _init_worker
+_validation_context = None
+
+
+def iter_directory(root):
+    """Yields the PDF paths under `root` in a stable order, without listing the whole tree up front."""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+        except OSError as e:
+            print(f"Cannot list {directory}: {e}", file=sys.stderr)
+            continue
+        subdirectories = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.is_file() and entry.name.lower().endswith(".pdf"):
+                yield entry.path
+        stack.extend(reversed(subdirectories))
+
+
+def iter_manifest(manifest_path):
+    """Yields the paths listed in a manifest file, one per line (blank lines and # comments skipped)."""
+    with open(manifest_path, encoding="utf-8") as f:
+        for line in f:
+            path = line.strip()
+            if path and not path.startswith("#"):
+                yield path
+
+
+def load_checkpoint(checkpoint_path):
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path, encoding="utf-8") as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+
+def _init_worker(trusted_cert_paths):
+    global _validation_context
+    from pyhanko.keys import load_cert_from_pemder
+    from pyhanko_certvalidator import ValidationContext
+
+    # Untrusted self-signed certificates are expected offline; report them per record, not on stderr
+    logging.getLogger("pyhanko").setLevel(logging.CRITICAL)
+    trust_roots = [load_cert_from_pemder(path) for path in trusted_cert_paths]
+    _validation_context = ValidationContext(trust_roots=trust_roots or None, allow_fetching=False)
+
+
+def verify_document(pdf_path):
+    """Verifies every signature of one document. Never raises: failures are reported in the record."""
+    from pdf_io import mapped_pdf
+    from pdf_precheck import PdfPrecheckError
+    from pyhanko.pdf_utils.reader import PdfFileReader
+    from pyhanko.sign.validation import validate_pdf_signature
+
+    started = time.perf_counter()
+    record = {"path": pdf_path, "signatures": []}
+    try:
+        with mapped_pdf(pdf_path) as stream:
+            for sig in PdfFileReader(stream).embedded_signatures:
+                sig_started = time.perf_counter()
+                entry = {"field": str(sig.field_name)}
+                try:
+                    status = validate_pdf_signature(sig, signer_validation_context=_validation_context)
+                    entry.update(
+                        signer_cn=status.signing_cert.subject.native.get("common_name"),
+                        intact=bool(status.intact),
+                        valid=bool(status.valid),
+                        trusted=bool(status.trusted),
+                    )
+                except Exception as e:
+                    entry.update(intact=False, valid=False, trusted=False, error=str(e))
+                entry["seconds"] = round(time.perf_counter() - sig_started, 6)
+                record["signatures"].append(entry)
+    except PdfPrecheckError as e:
+        record["error"] = e.to_dict()
+    except Exception as e:
+        record["error"] = {"error": str(e)}
+    record["seconds"] = round(time.perf_counter() - started, 6)
+    return record
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run(paths, output, checkpoint_path, workers, trusted_cert_paths, progress_every=PROGRESS_EVERY):
+    """Verifies `paths` (skipping those in the checkpoint) and returns the statistics dict."""
+    done = load_checkpoint(checkpoint_path)
+    pending = (path for path in paths if path not in done)
+    checkpoint = open(checkpoint_path, "a", encoding="utf-8") if checkpoint_path else None
+
+    documents = signatures = failed_documents = invalid_signatures = 0
+    durations = []
+    started = time.perf_counter()
+    try:
+        with multiprocessing.Pool(
+            workers, initializer=_init_worker, initargs=(trusted_cert_paths,), maxtasksperchild=1000
+        ) as pool:
+            for record in pool.imap_unordered(verify_document, pending, chunksize=16):
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+                # The checkpoint line is written after the result, so a resumed run never loses a document
+                if checkpoint:
+                    checkpoint.write(record["path"] + "\n")
+                    checkpoint.flush()
+
+                documents += 1
+                durations.append(record["seconds"])
+                signatures += len(record["signatures"])
+                failed_documents += "error" in record
+                invalid_signatures += sum(1 for s in record["signatures"] if not (s.get("intact") and s.get("valid")))
+                if checkpoint and documents % CHECKPOINT_SYNC_EVERY == 0:
+                    os.fsync(checkpoint.fileno())
+                if documents % progress_every == 0:
+                    elapsed = time.perf_counter() - started
+                    print(f"{documents} documents, {documents / elapsed:.1f} docs/s", file=sys.stderr)
+    finally:
+        if checkpoint:
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+            checkpoint.close()
+
+    elapsed = time.perf_counter() - started
+    durations.sort()
+    return {
+        "skipped_from_checkpoint": len(done),
+        "documents": documents,
+        "signatures": signatures,
+        "failed_documents": failed_documents,
+        "invalid_signatures": invalid_signatures,
+        "elapsed_seconds": round(elapsed, 3),
+        "documents_per_second": round(documents / elapsed, 2) if elapsed else None,
+        "signatures_per_second": round(signatures / elapsed, 2) if elapsed else None,
+        "p50_document_seconds": _percentile(durations, 0.50),
+        "p95_document_seconds": _percentile(durations, 0.95),
+        "p99_document_seconds": _percentile(durations, 0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify the signatures of every PDF in a directory or manifest")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--directory", help="Directory to walk recursively for *.pdf")
+    source.add_argument("--manifest", help="File listing one PDF path per line")
+    parser.add_argument("--output", default="-", help="JSON-lines results file (appended), or - for stdout")
+    parser.add_argument("--checkpoint", help="Checkpoint file of completed paths; rerun with the same file to resume")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Verification processes")
+    parser.add_argument("--trusted_cert", action="append", default=[], help="PEM/DER trust root (repeatable)")
+    parser.add_argument("--progress_every", type=int, default=PROGRESS_EVERY, help="Print progress every N documents")
+    args = parser.parse_args()
+
+    paths = iter_directory(args.directory) if args.directory else iter_manifest(args.manifest)
+    output = sys.stdout if args.output == "-" else open(args.output, "a", encoding="utf-8")
+    try:
+        stats = run(paths, output, args.checkpoint, args.workers, args.trusted_cert, args.progress_every)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(json.dumps(stats), file=sys.stderr)
+    sys.exit(1 if stats["failed_documents"] or stats["invalid_signatures"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Background renewal of user certificates ahead of expiry.
+
+Certificates are issued for 365 days, so a department onboarded with
+bulk_issue_certificates would expire on the same day: a keygen storm, and
+failed signatures for whoever is not renewed in time. This job renews them
+early and spread out instead:
+
+- Each active certificate is due at `expires_at - lead - jitter`, where the
+  jitter is a stable fraction of the renewal window derived from its id. A
+  cohort that expires together is renewed evenly across the window, and
+  since each replacement is valid for 365 days from its own renewal, the
+  next year's expiries are already spread.
+- Due certificates are found through the active-expiry index
+  (create-certificate-renewal.sql), in pages ordered by expiry.
+- Renewals run only during low-traffic hours (RENEWAL_HOURS in
+  RENEWAL_TIMEZONE), in batches with a pause between them. Key generation
+  runs in a small pool of lowered-priority processes. Certificates within
+  `urgent_days` of expiry are renewed at any hour.
+- The replacement is uploaded first and then switched in with the
+  activate_renewed_certificate RPC, which deactivates the old row and inserts
+  the new one in a single transaction. Signing never generates keys and
+  always finds exactly one active certificate. A certificate id held by a
+  client during the switch resolves to its replacement
+  (see DigitalSignatureManager.get_user_certificate).
+
+Run it as its own process (`--action run`), never inside the signing service.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from audit_log import audit
+from pkcs11_signing import uses_pkcs11
+
+DEFAULT_LEAD_DAYS = 30
+DEFAULT_WINDOW_DAYS = 21
+DEFAULT_HOURS = "1-5"
+DEFAULT_TIMEZONE = "America/Mexico_City"
+PAGE_SIZE = 500
+
+
+def _parse_time(value):
+    parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _parse_hours(value):
+    """"1-5" -> (1, 5): from 01:00 up to 04:59; "22-4" wraps around midnight."""
+    start, end = (int(part) for part in value.split("-"))
+    return start % 24, end % 24
+
+
+def _low_priority():
+    """Process pool initializer: key generation yields the CPU to the signing service."""
+    if hasattr(os, "nice"):
+        with contextlib.suppress(OSError):
+            os.nice(10)
+
+
+def _generate(user):
+    from digital_signature_backend import _generate_for_user
+    return _generate_for_user(user)
+
+
+def _subject_of(certificate_pem):
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+
+    subject = x509.load_pem_x509_certificate(bytes(certificate_pem)).subject
+    common_name = subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+    email = subject.get_attributes_for_oid(NameOID.EMAIL_ADDRESS)
+    return (common_name[0].value if common_name else None), (email[0].value if email else None)
+
+
+class CertificateRenewalScheduler:
+    def __init__(self, manager, lead_days=DEFAULT_LEAD_DAYS, window_days=DEFAULT_WINDOW_DAYS,
+                 hours=DEFAULT_HOURS, tz=DEFAULT_TIMEZONE, batch_size=20, batch_pause=30.0,
+                 max_per_run=500, workers=1, urgent_days=3, clock=None):
+        from zoneinfo import ZoneInfo
+
+        self.manager = manager
+        self.supabase = manager.supabase
+        self.lead = timedelta(days=lead_days)
+        self.window = timedelta(days=window_days)
+        self.hours = _parse_hours(hours)
+        self.tz = ZoneInfo(tz)
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.max_per_run = max_per_run
+        self.workers = workers
+        self.urgent = timedelta(days=urgent_days)
+        self.clock = clock or (lambda: datetime.now(timezone.utc))
+
+    # --- Planning ---
+    def due_at(self, certificate):
+        """Renewal time: a stable point of the window before `expires_at - lead`, chosen by the certificate id."""
+        fraction = int(hashlib.sha256(str(certificate["id"]).encode()).hexdigest()[:8], 16) / 2 ** 32
+        return _parse_time(certificate["expires_at"]) - self.lead - self.window * fraction
+
+    def scan(self, horizon):
+        """Active certificates expiring before `horizon`, by expiry (served by the active-expiry index)."""
+        rows, offset = [], 0
+        while True:
+            page = (
+                self.supabase.table("user_certificates").select("*")
+                .eq("is_active", True).lte("expires_at", horizon.isoformat()).order("expires_at")
+                .range(offset, offset + PAGE_SIZE - 1).execute().data or []
+            )
+            rows.extend(row for row in page if row.get("expires_at"))
+            if len(page) < PAGE_SIZE:
+                return rows
+            offset += PAGE_SIZE
+
+    def in_quiet_hours(self, now):
+        start, end = self.hours
+        hour = now.astimezone(self.tz).hour
+        return start <= hour < end if start <= end else hour >= start or hour < end
+
+    def plan(self, days=None):
+        """Renewals per day over the coming `days` (default: lead + window), to check the spread."""
+        now = self.clock()
+        horizon = now + (timedelta(days=days) if days else self.lead + self.window) + self.lead + self.window
+        per_day = Counter()
+        for certificate in self.scan(horizon):
+            if not uses_pkcs11(certificate):
+                per_day[max(self.due_at(certificate), now).date().isoformat()] += 1
+        return {"per_day": dict(sorted(per_day.items())), "max_per_day": max(per_day.values(), default=0)}
+
+    # --- Renewal ---
+    def run_once(self, force=False):
+        """
+        Renews what is due now: everything due during quiet hours (or with `force`),
+        otherwise only certificates about to expire. Returns a report.
+        """
+        now = self.clock()
+        quiet = force or self.in_quiet_hours(now)
+        due, deferred, skipped = [], 0, 0
+        for certificate in self.scan(now + self.lead + self.window):
+            if uses_pkcs11(certificate):
+                skipped += 1  # Keys on an HSM/token are renewed with the token's own tooling
+            elif self.due_at(certificate) > now:
+                continue
+            elif quiet or _parse_time(certificate["expires_at"]) - now <= self.urgent:
+                due.append(certificate)
+            else:
+                deferred += 1
+        deferred += max(0, len(due) - self.max_per_run)
+        due = due[:self.max_per_run]
+
+        report = {"quiet_hours": quiet, "due": len(due), "deferred": deferred, "skipped_pkcs11": skipped,
+                  "renewed": [], "failed": []}
+        if not due:
+            return report
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_low_priority) as pool:
+            for start in range(0, len(due), self.batch_size):
+                if start:
+                    time.sleep(self.batch_pause)
+                self._renew_batch(due[start:start + self.batch_size], pool, report)
+        print(f"🔁 Renovación: {len(report['renewed'])} renovados, {len(report['failed'])} con error, "
+              f"{report['deferred']} pospuestos", file=sys.stderr)
+        return report
+
+    def _renew_batch(self, certificates, pool, report):
+        users, futures = {}, {}
+        for certificate in certificates:
+            try:
+                certificate_pem = self.supabase.storage.from_("certificates").download(certificate["certificate_path"])
+                user_name, email = _subject_of(certificate_pem)
+                users[certificate["id"]] = {"user_id": certificate["user_id"], "user_name": user_name, "email": email}
+                futures[certificate["id"]] = pool.submit(_generate, users[certificate["id"]])
+            except Exception as e:
+                report["failed"].append({"certificate_id": certificate["id"], "stage": "read", "error": str(e)})
+
+        for certificate in certificates:
+            future = futures.get(certificate["id"])
+            if future is None:
+                continue
+            try:
+                private_key_pem, certificate_pem, serial_number = future.result()
+            except Exception as e:
+                report["failed"].append({"certificate_id": certificate["id"], "stage": "generate", "error": str(e)})
+                continue
+            self._activate(certificate, users[certificate["id"]], private_key_pem, certificate_pem, serial_number, report)
+
+    def _activate(self, certificate, user, private_key_pem, certificate_pem, serial_number, report):
+        manager = self.manager
+        cert_path, key_path = manager._storage_paths(user["user_id"])
+        uploaded = []
+        try:
+            manager._upload_pem(cert_path, certificate_pem)
+            uploaded.append(cert_path)
+            manager._upload_private_key(key_path, user["user_id"], private_key_pem)
+            uploaded.append(key_path)
+            row = manager._certificate_row(user["user_id"], user["user_name"], cert_path, key_path, serial_number)
+            row["certificate_name"] = certificate.get("certificate_name") or row["certificate_name"]
+            new = self.supabase.rpc(
+                "activate_renewed_certificate", {"old_certificate_id": certificate["id"], "new_certificate": row}
+            ).execute().data[0]
+        except Exception as e:
+            # The old certificate stays active; the new files would be orphans
+            with contextlib.suppress(Exception):
+                if uploaded:
+                    self.supabase.storage.from_("certificates").remove(uploaded)
+            report["failed"].append({"certificate_id": certificate["id"], "stage": "activate", "error": str(e)})
+            return
+        audit("certificate_renew", user_id=user["user_id"], certificate_id=new["id"],
+              renewed_from=certificate["id"], serial_number=str(serial_number))
+        report["renewed"].append({"certificate_id": certificate["id"], "new_certificate_id": new["id"],
+                                  "expires_at": certificate["expires_at"], "new_expires_at": new["expires_at"]})
+
+    def run_forever(self, poll_interval=600.0, stop=None):
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                report = self.run_once()
+                if report["renewed"] or report["failed"]:
+                    print(json.dumps(report), flush=True)
+            except Exception as e:
+                print(f"❌ Error en la renovación de certificados: {e}", file=sys.stderr)
+            stop.wait(poll_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Renew user certificates ahead of expiry, spread over a window")
+    parser.add_argument("--action", required=True, choices=["plan", "run_once", "run"])
+    parser.add_argument("--lead_days", type=int, default=int(os.getenv("RENEWAL_LEAD_DAYS", DEFAULT_LEAD_DAYS)),
+                        help="Renew at least this many days before expiry")
+    parser.add_argument("--window_days", type=int, default=int(os.getenv("RENEWAL_WINDOW_DAYS", DEFAULT_WINDOW_DAYS)),
+                        help="Spread renewals over this many days before the lead")
+    parser.add_argument("--hours", default=os.getenv("RENEWAL_HOURS", DEFAULT_HOURS), help="Low-traffic hours, e.g. 1-5")
+    parser.add_argument("--timezone", default=os.getenv("RENEWAL_TIMEZONE", DEFAULT_TIMEZONE))
+    parser.add_argument("--batch_size", type=int, default=20)
+    parser.add_argument("--batch_pause", type=float, default=30.0, help="Seconds between batches")
+    parser.add_argument("--max_per_run", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=1, help="Key generation processes")
+    parser.add_argument("--urgent_days", type=int, default=3, help="Renew at any hour this close to expiry")
+    parser.add_argument("--poll_interval", type=float, default=600.0, help="Seconds between runs (run)")
+    parser.add_argument("--force", action="store_true", help="run_once: ignore the low-traffic hours")
+    parser.add_argument("--supabase_url", default=os.getenv("SUPABASE_URL"))
+    parser.add_argument("--supabase_key", default=os.getenv("SUPABASE_SERVICE_ROLE_KEY"))
+    args = parser.parse_args()
+
+    from digital_signature_backend import DigitalSignatureManager
+
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            scheduler = CertificateRenewalScheduler(
+                DigitalSignatureManager(args.supabase_url, args.supabase_key),
+                lead_days=args.lead_days, window_days=args.window_days, hours=args.hours, tz=args.timezone,
+                batch_size=args.batch_size, batch_pause=args.batch_pause, max_per_run=args.max_per_run,
+                workers=args.workers, urgent_days=args.urgent_days,
+            )
+        if args.action == "plan":
+            print(json.dumps(scheduler.plan()))
+        elif args.action == "run_once":
+            with contextlib.redirect_stdout(sys.stderr):
+                report = scheduler.run_once(force=args.force)
+            print(json.dumps({"success": not report["failed"], **report}))
+        else:
+            scheduler.run_forever(args.poll_interval)
+    except Exception as e:
+        print(json.dumps({"error": str(e)}))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
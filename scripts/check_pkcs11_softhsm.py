@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+End-to-end check of the PKCS#11 signing backend against SoftHSM.
+Creates a throwaway SoftHSM token, imports a freshly generated key and
+certificate, signs synthetic PDFs concurrently through the pooled signer and
+validates every signature. Needs softhsm2-util and pyhanko[pkcs11].
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+TOKEN_LABEL = "casa-monarca-check"
+KEY_LABEL = "signer"
+USER_PIN = "1234"
+SO_PIN = "123456"
+MODULE_CANDIDATES = [
+    "/usr/lib/softhsm/libsofthsm2.so",
+    "/usr/lib/x86_64-linux-gnu/softhsm/libsofthsm2.so",
+    "/usr/local/lib/softhsm/libsofthsm2.so",
+    "/usr/lib64/pkcs11/libsofthsm2.so",
+]
+
+
+def find_module():
+    module = os.getenv("PKCS11_MODULE")
+    if module:
+        return module
+    for candidate in MODULE_CANDIDATES:
+        if os.path.exists(candidate):
+            return candidate
+    raise RuntimeError("libsofthsm2.so not found; set PKCS11_MODULE")
+
+
+def generate_key_and_cert(workdir):
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "PKCS11 Check")])
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(datetime.utcnow() - timedelta(minutes=5))
+        .not_valid_after(datetime.utcnow() + timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    key_path = os.path.join(workdir, "key.pem")
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        ))
+    return key_path, cert.public_bytes(serialization.Encoding.DER)
+
+
+def init_token(module, workdir):
+    """Initializes a token in a private SoftHSM directory and imports the key and certificate."""
+    import pkcs11
+    from pkcs11 import Attribute, CertificateType, ObjectClass
+
+    token_dir = os.path.join(workdir, "tokens")
+    os.makedirs(token_dir)
+    conf_path = os.path.join(workdir, "softhsm2.conf")
+    with open(conf_path, "w") as f:
+        f.write(f"directories.tokendir = {token_dir}\nobjectstore.backend = file\n")
+    os.environ["SOFTHSM2_CONF"] = conf_path
+
+    subprocess.run(["softhsm2-util", "--init-token", "--free", "--label", TOKEN_LABEL,
+                    "--pin", USER_PIN, "--so-pin", SO_PIN], check=True, capture_output=True)
+    key_path, cert_der = generate_key_and_cert(workdir)
+    subprocess.run(["softhsm2-util", "--import", key_path, "--token", TOKEN_LABEL, "--label", KEY_LABEL,
+                    "--id", "01", "--pin", USER_PIN], check=True, capture_output=True)
+
+    token = pkcs11.lib(module).get_token(token_label=TOKEN_LABEL)
+    with token.open(rw=True, user_pin=USER_PIN) as session:
+        session.create_object({
+            Attribute.CLASS: ObjectClass.CERTIFICATE,
+            Attribute.CERTIFICATE_TYPE: CertificateType.X_509,
+            Attribute.TOKEN: True,
+            Attribute.LABEL: KEY_LABEL,
+            Attribute.ID: b"\x01",
+            Attribute.VALUE: cert_der,
+        })
+    return cert_der
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sign and verify through SoftHSM with the pooled PKCS#11 backend")
+    parser.add_argument("--documents", type=int, default=20, help="PDFs to sign")
+    parser.add_argument("--threads", type=int, default=4, help="Concurrent signing threads")
+    parser.add_argument("--sessions", type=int, default=1, help="Logged-in sessions per slot")
+    args = parser.parse_args()
+
+    if not shutil.which("softhsm2-util"):
+        print(json.dumps({"success": False, "error": "softhsm2-util not found (apt install softhsm2)"}))
+        sys.exit(1)
+
+    from asn1crypto import x509 as asn1_x509
+    from pyhanko.pdf_utils.reader import PdfFileReader
+    from pyhanko.sign import signers
+    from pyhanko.sign.validation import validate_pdf_signature
+    from pyhanko_certvalidator import ValidationContext
+
+    from benchmark_signatures import make_synthetic_pdf
+    from pdf_io import sign_append_only
+    from pkcs11_signing import Pkcs11SignerRegistry
+
+    workdir = tempfile.mkdtemp(prefix="softhsm-check-")
+    try:
+        module = find_module()
+        cert_der = init_token(module, workdir)
+        os.environ["PKCS11_USER_PIN"] = USER_PIN
+        registry = Pkcs11SignerRegistry(module_path=module, sessions_per_slot=args.sessions)
+
+        pdf_bytes = make_synthetic_pdf(2)
+        paths = []
+        for i in range(args.documents):
+            path = os.path.join(workdir, f"doc{i}.pdf")
+            with open(path, "wb") as f:
+                f.write(pdf_bytes)
+            paths.append(path)
+
+        def make_pdf_signer(field_name):
+            signer = registry.signer(TOKEN_LABEL, KEY_LABEL)
+            return signers.PdfSigner(signers.PdfSignatureMetadata(field_name=field_name), signer=signer)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.threads) as pool:
+            list(pool.map(lambda path: sign_append_only(make_pdf_signer, path), paths))
+        elapsed = time.perf_counter() - started
+
+        context = ValidationContext(trust_roots=[asn1_x509.Certificate.load(cert_der)], allow_fetching=False)
+        failures = []
+        for path in paths:
+            with open(path, "rb") as f:
+                status = validate_pdf_signature(PdfFileReader(f).embedded_signatures[0], context)
+                if not (status.intact and status.valid and status.trusted):
+                    failures.append(path)
+
+        sessions_opened = registry.pool(TOKEN_LABEL).sessions_opened
+        result = {
+            "success": not failures and sessions_opened <= args.sessions,
+            "documents": args.documents,
+            "signing_seconds": round(elapsed, 3),
+            "documents_per_second": round(args.documents / elapsed, 2),
+            "sessions_opened": sessions_opened,
+            "failures": failures,
+        }
+        registry.close()
+        print(json.dumps(result, indent=2))
+        sys.exit(0 if result["success"] else 1)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
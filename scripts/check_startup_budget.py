@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Startup Budget Check for the signature CLI scripts
+Runs each action under `python -X importtime` and fails when the action loads
+modules it must not need, or when its import cost exceeds a budget relative to
+a baseline measured on the same machine in the same run: importing only the
+modules the action legitimately requires. Wall-clock import times move with
+machine load by tens of percent; the ratio does not.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Each check: script, CLI arguments, top-level packages that must not load, the
+# modules the action needs (the baseline) and the allowed import-time ratio to it
+CHECKS = [
+    {
+        "name": "professional_signature_manager.generate_certificate",
+        "script": "professional_signature_manager.py",
+        "args": ["--action", "generate_certificate", "--user_name", "Budget", "--email", "budget@casamonarca.org"],
+        "forbidden": ["pyhanko", "asn1crypto", "PyPDF2"],
+        "required": [
+            "argparse", "json", "base64", "cryptography.x509", "cryptography.hazmat.primitives.serialization",
+            "cryptography.hazmat.primitives.asymmetric.rsa", "cryptography.hazmat.primitives.asymmetric.ec", "audit_log",
+        ],
+        "max_ratio": 1.25,
+    },
+    {
+        "name": "digital_signature_manager.verify",
+        "script": "digital_signature_manager.py",
+        # Empty PDF payload: the action fails fast after importing what verify needs
+        "args": ["--action", "verify", "--pdf_base64", ""],
+        "forbidden": ["supabase"],
+        "required": [
+            "argparse", "json", "base64", "hashlib", "audit_log", "pdf_io", "pdf_precheck", "signature_fields",
+            "signature_index", "pyhanko.pdf_utils.reader",
+        ],
+        "max_ratio": 1.25,
+    },
+]
+
+
+def parse_importtime(stderr: str):
+    """Returns ({module: self_us}, total_self_us) from `-X importtime` output."""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, _cumulative_us, name = line[len("import time:"):].split("|")
+            modules[name.strip()] = int(self_us.strip())
+        except ValueError:
+            continue
+    return modules, sum(modules.values())
+
+
+def measure(arguments, python=sys.executable):
+    """Returns ({module: self_us}, total_self_us) for one `python -X importtime` run from SCRIPTS_DIR."""
+    completed = subprocess.run([python, "-X", "importtime"] + arguments, capture_output=True, text=True, cwd=SCRIPTS_DIR)
+    return parse_importtime(completed.stderr)
+
+
+def run_check(check, repeat=5, python=sys.executable):
+    """
+    Alternates action and baseline runs `repeat` times and compares the medians,
+    so both sides see the same machine load.
+    """
+    action = [os.path.join(SCRIPTS_DIR, check["script"])] + check["args"]
+    baseline = ["-c", "; ".join(f"import {name}" for name in check["required"])]
+    action_us, baseline_us = [], []
+    for _ in range(repeat):
+        modules, total_us = measure(action, python)
+        action_us.append(total_us)
+        baseline_us.append(measure(baseline, python)[1])
+    loaded_forbidden = sorted(
+        name for name in modules
+        for forbidden in check["forbidden"]
+        if name == forbidden or name.startswith(forbidden + ".")
+    )
+    import_ms = statistics.median(action_us) / 1000
+    baseline_ms = statistics.median(baseline_us) / 1000
+    ratio = import_ms / baseline_ms if baseline_ms else float("inf")
+    return {
+        "name": check["name"],
+        "import_ms": round(import_ms, 2),
+        "baseline_ms": round(baseline_ms, 2),
+        "ratio": round(ratio, 3),
+        "max_ratio": check["max_ratio"],
+        "modules_loaded": len(modules),
+        "forbidden_loaded": loaded_forbidden,
+        "ok": ratio <= check["max_ratio"] and not loaded_forbidden,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enforce the import-time budget of the signature CLI scripts")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply every allowed ratio")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per action and baseline; medians are compared")
+    args = parser.parse_args()
+
+    results = []
+    for check in CHECKS:
+        results.append(run_check({**check, "max_ratio": check["max_ratio"] * args.scale}, args.repeat))
+
+    print(json.dumps({"success": all(r["ok"] for r in results), "checks": results}, indent=2))
+    sys.exit(0 if all(r["ok"] for r in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
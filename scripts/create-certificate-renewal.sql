@@ -0,0 +1,50 @@
+-- Certificate renewal (scripts/certificate_renewal.py): the scheduler finds active
+-- certificates by expiry and replaces each one ahead of time, in one transaction,
+-- so signing always sees exactly one active certificate per renewal.
+ALTER TABLE user_certificates
+ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP WITH TIME ZONE,
+ADD COLUMN IF NOT EXISTS renewed_from_id UUID REFERENCES user_certificates(id);
+
+-- Renewal scan: active certificates ordered by expiry
+CREATE INDEX IF NOT EXISTS idx_user_certificates_active_expiry
+  ON user_certificates(expires_at) WHERE is_active;
+
+-- A certificate id held by a client when its renewal happened resolves to the replacement
+CREATE INDEX IF NOT EXISTS idx_user_certificates_renewed_from
+  ON user_certificates(renewed_from_id) WHERE renewed_from_id IS NOT NULL;
+
+-- Deactivate the old certificate and insert its replacement atomically.
+-- The row lock makes a second scheduler (or a retry) fail instead of renewing twice.
+CREATE OR REPLACE FUNCTION activate_renewed_certificate(old_certificate_id UUID, new_certificate JSONB)
+RETURNS SETOF user_certificates
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  PERFORM 1 FROM user_certificates WHERE id = old_certificate_id AND is_active FOR UPDATE;
+  IF NOT FOUND THEN
+    RAISE EXCEPTION 'certificate % is not active', old_certificate_id USING ERRCODE = 'P0002';
+  END IF;
+
+  UPDATE user_certificates SET is_active = FALSE, updated_at = NOW() WHERE id = old_certificate_id;
+
+  RETURN QUERY
+  INSERT INTO user_certificates (
+    user_id, certificate_name, certificate_path, private_key_path, serial_number,
+    is_active, expires_at, renewed_from_id
+  )
+  VALUES (
+    (new_certificate->>'user_id')::UUID,
+    new_certificate->>'certificate_name',
+    new_certificate->>'certificate_path',
+    new_certificate->>'private_key_path',
+    new_certificate->>'serial_number',
+    TRUE,
+    (new_certificate->>'expires_at')::TIMESTAMP WITH TIME ZONE,
+    old_certificate_id
+  )
+  RETURNING *;
+END;
+$$;
+
+-- Only the renewal job calls this, with the service role key
+REVOKE EXECUTE ON FUNCTION activate_renewed_certificate(UUID, JSONB) FROM PUBLIC, anon, authenticated;
@@ -0,0 +1,60 @@
+-- Signature summary index: one row per embedded signature, filled at sign time
+-- and by the backfill job (scripts/signature_index.py), so dashboards list
+-- signatures without downloading or re-validating the PDFs.
+CREATE TABLE IF NOT EXISTS signature_index (
+  document_id UUID NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+  field_name TEXT NOT NULL,
+  signer_cn TEXT,
+  signer_email TEXT,
+  signing_time TIMESTAMP WITH TIME ZONE,
+  reason TEXT,
+  location TEXT,
+  cert_sha256 TEXT,
+  byte_range BIGINT[],
+  intact BOOLEAN NOT NULL DEFAULT FALSE,
+  valid BOOLEAN NOT NULL DEFAULT FALSE,
+  trusted BOOLEAN NOT NULL DEFAULT FALSE,
+  content_hash TEXT,
+  indexed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (document_id, field_name)
+);
+
+-- Create indexes for the dashboard queries (by signer and by date range)
+CREATE INDEX IF NOT EXISTS idx_signature_index_signer_cn ON signature_index(signer_cn, signing_time);
+CREATE INDEX IF NOT EXISTS idx_signature_index_signer_email ON signature_index(signer_email, signing_time);
+CREATE INDEX IF NOT EXISTS idx_signature_index_signing_time ON signature_index(signing_time);
+
+-- Signatures of many documents in one call: the id list travels in the request body, not the URL
+CREATE OR REPLACE FUNCTION signature_index_for_documents(document_ids UUID[])
+RETURNS SETOF signature_index
+LANGUAGE sql STABLE
+AS $$
+  SELECT * FROM signature_index WHERE document_id = ANY(document_ids);
+$$;
+
+-- Enable RLS (the function runs with the caller's rights, so these policies apply to it too)
+ALTER TABLE signature_index ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY "Users can view signatures of documents they can access" ON signature_index
+  FOR SELECT USING (
+    EXISTS (
+      SELECT 1 FROM documents d
+      WHERE d.id = signature_index.document_id
+      AND (
+        d.uploaded_by = auth.uid()
+        OR EXISTS (
+          SELECT 1 FROM document_permissions p
+          WHERE p.document_id = d.id AND p.user_id = auth.uid()
+        )
+      )
+    )
+  );
+
+CREATE POLICY "System admins can view all signature index rows" ON signature_index
+  FOR SELECT USING (
+    EXISTS (
+      SELECT 1 FROM users WHERE id = auth.uid() AND role = 'system_admin'
+    )
+  );
+
+-- Rows are written only by the signing backend with the service role key, which bypasses RLS
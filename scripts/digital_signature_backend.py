@@ -1,27 +1,54 @@
 import os
 import io
+import sys
+import asyncio
+import csv
+import json
 import base64
 import hashlib
+import argparse
+import contextlib
+import functools
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
-from cryptography import x509
-from cryptography.x509.oid import NameOID
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import rsa
-from pyhanko import stamp
-from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter
-from pyhanko.sign import signers, fields
-from pyhanko.pdf_utils.reader import PdfFileReader
-import supabase
+
+from audit_log import audit
+from key_envelope import decrypt_private_key, encrypt_private_key, get_master_key, is_envelope
+from pdf_io import mapped_pdf, prepare_append_target, sign_append_only, sign_bytes
+from pdf_precheck import precheck_pdf_bytes
+from pkcs11_signing import get_registry as get_pkcs11_registry, uses_pkcs11
+from signature_fields import prepare_signature_fields_file
+from signature_index import SupabaseSignatureIndex, index_pdf_bytes, index_pdf_file
+from supabase_data import SupabaseDataAccess
+
+# supabase, cryptography y pyhanko se importan dentro de cada método para que
+# generar un certificado no cargue la pila PDF (y verificar no cargue el generador)
 
 class DigitalSignatureManager:
-    def __init__(self, supabase_url, supabase_key):
-        """Inicializar el gestor de firmas digitales"""
-        self.supabase = supabase.create_client(supabase_url, supabase_key)
+    def __init__(self, supabase_url, supabase_key, client=None):
+        """
+        Inicializar el gestor de firmas digitales (`client` permite inyectar un cliente Supabase, p. ej. uno falso).
+        `self.data` hace las operaciones de tablas y Storage sin bloquear (ver supabase_data.py): los métodos
+        `*_async` las esperan desde un servicio async y los métodos síncronos son envolturas para la CLI.
+        """
+        if client is None:
+            import supabase
+            self.data = SupabaseDataAccess(supabase_url, supabase_key)
+            client = supabase.create_client(supabase_url, supabase_key)
+        else:
+            self.data = SupabaseDataAccess(client=client)
+        self.supabase = client
         
-    def generate_certificate_and_key(self, user_name, email, user_id):
+    @staticmethod
+    def generate_certificate_and_key(user_name, email, user_id):
         """
         Generar par de claves y certificado digital para un usuario
         """
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID
+        from cryptography.hazmat.primitives import serialization, hashes
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
         print(f"🔐 Generando certificado para {user_name} ({email})")
         
         # Generar clave privada RSA
@@ -73,7 +100,7 @@ class DigitalSignatureManager:
         private_key_pem = private_key.private_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PrivateFormat.TraditionalOpenSSL,
-            encryption_algorithm=serialization.NoEncryption()  # En producción usar contraseña
+            encryption_algorithm=serialization.NoEncryption()  # Se cifra con envoltura al guardarla (ver key_envelope.py)
         )
         
         certificate_pem = certificate.public_bytes(serialization.Encoding.PEM)
@@ -88,75 +115,208 @@ class DigitalSignatureManager:
         """
         Guardar certificado y clave privada en Supabase Storage
         """
+        return self.data.run_sync(
+            self.save_certificate_to_supabase_async(user_id, user_name, private_key_pem, certificate_pem, serial_number)
+        )
+    
+    async def save_certificate_to_supabase_async(self, user_id, user_name, private_key_pem, certificate_pem, serial_number):
+        """
+        Versión async de save_certificate_to_supabase: el certificado y la clave se suben en paralelo
+        """
         print(f"💾 Guardando certificado en Supabase para usuario {user_id}")
         
         try:
-            # Crear nombres únicos para los archivos
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            cert_filename = f"{user_id}/certificate_{timestamp}.pem"
-            key_filename = f"{user_id}/private_key_{timestamp}.pem"
-            
-            # Subir certificado
-            cert_response = self.supabase.storage.from_('certificates').upload(
-                cert_filename, 
-                certificate_pem,
-                {"content-type": "application/x-pem-file"}
-            )
+            cert_filename, key_filename = self._storage_paths(user_id)
             
-            # Subir clave privada (en producción, cifrar antes)
-            key_response = self.supabase.storage.from_('certificates').upload(
-                key_filename, 
-                private_key_pem,
-                {"content-type": "application/x-pem-file"}
+            # Subir certificado y clave privada (cifrada con envoltura si hay llave maestra configurada)
+            results = await asyncio.gather(
+                self._upload_pem_async(cert_filename, certificate_pem),
+                self._upload_private_key_async(key_filename, user_id, private_key_pem),
+                return_exceptions=True
             )
+            errors = [result for result in results if isinstance(result, BaseException)]
+            if errors:
+                # Sin fila en user_certificates el archivo que sí se subió quedaría huérfano
+                uploaded = [path for path, result in zip((cert_filename, key_filename), results)
+                            if not isinstance(result, BaseException)]
+                if uploaded:
+                    with contextlib.suppress(Exception):
+                        await self.data.remove(uploaded)
+                raise errors[0]
             
             # Guardar metadatos en la tabla user_certificates
-            cert_data = {
-                "user_id": user_id,
-                "certificate_name": f"Certificado Digital - {user_name}",
-                "certificate_path": cert_filename,
-                "private_key_path": key_filename,
-                "serial_number": str(serial_number),
-                "is_active": True,
-                "expires_at": (datetime.utcnow() + timedelta(days=365)).isoformat()
-            }
+            cert_data = self._certificate_row(user_id, user_name, cert_filename, key_filename, serial_number)
             
-            db_response = self.supabase.table('user_certificates').insert(cert_data).execute()
+            inserted = await self.data.insert_certificates(cert_data)
+            audit("certificate_issue", user_id=user_id, certificate_id=inserted[0]['id'], serial_number=str(serial_number))
             
             print(f"✅ Certificado guardado exitosamente")
             print(f"📁 Certificado: {cert_filename}")
             print(f"🔑 Clave privada: {key_filename}")
             
-            return db_response.data[0]['id']
+            return inserted[0]['id']
             
         except Exception as e:
             print(f"❌ Error guardando certificado: {str(e)}")
             raise e
     
+    @staticmethod
+    def _storage_paths(user_id):
+        """Crear nombres únicos para los archivos de certificado y clave"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        key_suffix = ".enc" if get_master_key() else ""
+        return f"{user_id}/certificate_{timestamp}.pem", f"{user_id}/private_key_{timestamp}.pem{key_suffix}"
+    
+    def _upload_pem(self, path, pem_bytes):
+        return self.data.run_sync(self._upload_pem_async(path, pem_bytes))
+    
+    async def _upload_pem_async(self, path, pem_bytes):
+        return await self.data.upload(path, pem_bytes, "application/x-pem-file")
+    
+    def _upload_private_key(self, path, user_id, private_key_pem):
+        return self.data.run_sync(self._upload_private_key_async(path, user_id, private_key_pem))
+    
+    async def _upload_private_key_async(self, path, user_id, private_key_pem):
+        """
+        Subir la clave privada cifrada con envoltura (llave de datos propia, envuelta por la
+        llave maestra) y ligada al usuario. Sin llave maestra configurada se sube en claro.
+        """
+        master = get_master_key()
+        if master is None:
+            print("⚠️ Sin KEY_MASTER_KEYFILE ni KEY_KMS_STANDIN_DIR: la clave privada se guarda sin cifrar")
+            return await self._upload_pem_async(path, private_key_pem)
+        # Envolver la llave puede llamar al KMS: fuera del event loop
+        encrypted = await self.data.run_blocking(encrypt_private_key, private_key_pem, user_id, master)
+        return await self.data.upload(path, encrypted, "application/octet-stream")
+    
+    @staticmethod
+    def _certificate_row(user_id, user_name, cert_filename, key_filename, serial_number):
+        return {
+            "user_id": user_id,
+            "certificate_name": f"Certificado Digital - {user_name}",
+            "certificate_path": cert_filename,
+            "private_key_path": key_filename,
+            "serial_number": str(serial_number),
+            "is_active": True,
+            "expires_at": (datetime.utcnow() + timedelta(days=365)).isoformat()
+        }
+    
+    def bulk_issue_certificates(self, users, keygen_workers=None, upload_workers=8):
+        """
+        Emitir certificados para muchos usuarios a la vez (p. ej. un departamento completo).
+        - Genera las claves en un pool de procesos.
+        - Sube los pares certificado/clave en paralelo con un pool acotado de hilos.
+        - Inserta todas las filas de user_certificates en un solo insert.
+        `users` es una lista de dicts con user_id, user_name y email.
+        Devuelve un reporte por usuario.
+        """
+        print(f"🏭 Emisión masiva de certificados para {len(users)} usuarios")
+        
+        user_ids = [user['user_id'] for user in users]
+        if len(set(user_ids)) != len(user_ids):
+            raise ValueError("La lista de usuarios contiene user_id duplicados")
+        
+        report = {user['user_id']: {"user_id": user['user_id'], "status": "pending"} for user in users}
+        
+        # 1. Generar claves y certificados en paralelo (CPU)
+        generated = {}
+        with ProcessPoolExecutor(max_workers=keygen_workers) as pool:
+            futures = {pool.submit(_generate_for_user, user): user for user in users}
+            for future, user in futures.items():
+                try:
+                    generated[user['user_id']] = future.result()
+                except Exception as e:
+                    report[user['user_id']].update(status="error", stage="generate", error=str(e))
+        
+        # 2. Subir certificado y clave de cada usuario en paralelo (I/O, a lo más upload_workers a la vez)
+        to_upload = [user for user in users if user['user_id'] in generated]
+        rows = []
+        for user, result in zip(to_upload, self.data.run_sync(self._upload_pairs_async(to_upload, generated, upload_workers))):
+            if isinstance(result, BaseException):
+                report[user['user_id']].update(status="error", stage="upload", error=str(result))
+            else:
+                rows.append(result)
+        
+        # 3. Un solo insert por lotes en user_certificates
+        if rows:
+            try:
+                for row in self.data.run_sync(self.data.insert_certificates(rows)):
+                    audit("certificate_issue", user_id=row['user_id'], certificate_id=row['id'],
+                          serial_number=str(row['serial_number']), bulk=True)
+                    report[row['user_id']].update(
+                        status="issued",
+                        certificate_id=row['id'],
+                        serial_number=row['serial_number'],
+                        certificate_path=row['certificate_path']
+                    )
+            except Exception as e:
+                # Los archivos ya subidos quedan huérfanos; se reportan para limpieza manual
+                for row in rows:
+                    report[row['user_id']].update(
+                        status="error", stage="insert", error=str(e),
+                        orphaned_paths=[row['certificate_path'], row['private_key_path']]
+                    )
+        
+        issued = sum(1 for entry in report.values() if entry['status'] == "issued")
+        print(f"✅ Emisión masiva completada: {issued}/{len(users)} certificados emitidos")
+        
+        return list(report.values())
+    
+    async def _upload_pairs_async(self, users, generated, upload_workers):
+        """Subir los pares certificado/clave; devuelve por usuario la fila a insertar o la excepción"""
+        limit = asyncio.Semaphore(upload_workers)
+        
+        async def upload_pair(user):
+            private_key_pem, certificate_pem, serial_number = generated[user['user_id']]
+            cert_filename, key_filename = self._storage_paths(user['user_id'])
+            async with limit:
+                await self._upload_pem_async(cert_filename, certificate_pem)
+                await self._upload_private_key_async(key_filename, user['user_id'], private_key_pem)
+            return self._certificate_row(user['user_id'], user['user_name'], cert_filename, key_filename, serial_number)
+        
+        return await asyncio.gather(*(upload_pair(user) for user in users), return_exceptions=True)
+    
     def get_user_certificate(self, user_id, certificate_id=None):
         """
         Obtener certificado y clave privada de un usuario desde Supabase
         """
+        return self.data.run_sync(self.get_user_certificate_async(user_id, certificate_id))
+    
+    async def get_user_certificate_async(self, user_id, certificate_id=None):
+        """
+        Versión async de get_user_certificate: certificado y clave se descargan en paralelo
+        """
         try:
-            query = self.supabase.table('user_certificates').select('*').eq('user_id', user_id).eq('is_active', True)
+            rows = await self.data.select_certificates(user_id, certificate_id=certificate_id)
             
-            if certificate_id:
-                query = query.eq('id', certificate_id)
+            if not rows and certificate_id:
+                # El certificado pudo renovarse (certificate_renewal.py) entre que el cliente
+                # obtuvo su id y esta firma: se usa el que lo reemplazó
+                rows = await self.data.select_certificates(user_id, renewed_from_id=certificate_id)
             
-            result = query.execute()
-            
-            if not result.data:
+            if not rows:
                 raise Exception("No se encontró certificado activo para el usuario")
             
-            cert_info = result.data[0]
+            cert_info = rows[0]
+            
+            if uses_pkcs11(cert_info):
+                # La clave (y el certificado) viven en el token: no hay nada que descargar
+                return {
+                    'certificate_pem': None,
+                    'private_key_pem': None,
+                    'certificate_info': cert_info
+                }
             
             # Descargar archivos desde Supabase Storage
-            cert_response = self.supabase.storage.from_('certificates').download(cert_info['certificate_path'])
-            key_response = self.supabase.storage.from_('certificates').download(cert_info['private_key_path'])
+            cert_response, key_response = await asyncio.gather(
+                self.data.download(cert_info['certificate_path']),
+                self.data.download(cert_info['private_key_path'])
+            )
             
             return {
                 'certificate_pem': cert_response,
-                'private_key_pem': key_response,
+                # Las claves cifradas se descifran una vez y luego salen de la caché en memoria bloqueada
+                'private_key_pem': await self.data.run_blocking(decrypt_private_key, key_response, cert_info['user_id']),
                 'certificate_info': cert_info
             }
             
@@ -164,57 +324,90 @@ class DigitalSignatureManager:
             print(f"❌ Error obteniendo certificado: {str(e)}")
             raise e
     
-    def sign_pdf_with_certificate(self, pdf_bytes, user_id, certificate_id, signature_reason="Firma digital"):
+    @staticmethod
+    def _load_signer(private_key_pem, certificate_pem):
+        """Crear el firmante de pyhanko a partir de los PEM en memoria"""
+        from pyhanko.keys import load_certs_from_pemder_data, load_private_key_from_pemder_data
+        from pyhanko.sign import signers
+        from pyhanko_certvalidator.registry import SimpleCertificateStore
+        
+        signing_key = load_private_key_from_pemder_data(private_key_pem, passphrase=None)
+        signing_cert = next(iter(load_certs_from_pemder_data(certificate_pem)))
+        return signers.SimpleSigner(
+            signing_cert=signing_cert,
+            signing_key=signing_key,
+            cert_registry=SimpleCertificateStore.from_certs([signing_cert])
+        )
+    
+    def _pdf_signer_factory(self, cert_data, signature_reason):
         """
-        Firmar PDF usando el certificado del usuario
+        Devolver una función que arma el PdfSigner para el campo elegido con el certificado ya obtenido.
+        Los métodos de firma hacen el pre-chequeo del PDF antes de obtenerlo: un documento inválido
+        se rechaza sin descargar certificado ni clave.
         """
-        print(f"✍️ Firmando PDF para usuario {user_id}")
+        from pyhanko.sign import signers
         
-        try:
-            # Obtener certificado del usuario
-            cert_data = self.get_user_certificate(user_id, certificate_id)
-            
-            # Cargar clave privada y certificado
-            private_key = serialization.load_pem_private_key(
-                cert_data['private_key_pem'], 
-                password=None
-            )
-            
-            certificate = x509.load_pem_x509_certificate(cert_data['certificate_pem'])
-            
-            # Crear el firmante
-            signer = signers.SimpleSigner.load(
-                cert_data['private_key_pem'],
-                cert_data['certificate_pem'],
-                ca_chain_files=(),
-                key_passphrase=None
-            )
-            
-            # Leer el PDF
-            pdf_reader = PdfFileReader(io.BytesIO(pdf_bytes))
-            
-            # Crear writer incremental
-            output_buffer = io.BytesIO()
-            writer = IncrementalPdfFileWriter(output_buffer)
-            
-            # Configurar campo de firma
+        def make_pdf_signer(field_name):
+            # Crear el firmante: token PKCS#11 (sesiones reutilizadas) o PEM descargado
+            if uses_pkcs11(cert_data['certificate_info']):
+                signer = get_pkcs11_registry().signer_for_certificate(cert_data['certificate_info'])
+            else:
+                signer = self._load_signer(cert_data['private_key_pem'], cert_data['certificate_pem'])
+            
+            # Configurar campo de firma (un campo pre-asignado vacío si el documento fue preparado)
             signature_meta = signers.PdfSignatureMetadata(
-                field_name='Signature',
+                field_name=field_name,
                 reason=signature_reason,
                 location='Casa Monarca - Sistema Digital',
-                signer_name=cert_data['certificate_info']['certificate_name']
+                name=cert_data['certificate_info']['certificate_name']
             )
+            return signers.PdfSigner(signature_meta, signer=signer)
+        
+        return make_pdf_signer
+    
+    def _index_signatures(self, document_id, pdf_bytes=None, pdf_path=None, content_hash=None):
+        """
+        Registrar el resumen de firmas del documento en la tabla signature_index.
+        Es información derivada: si falla, la firma sigue siendo válida y el backfill la repara.
+        """
+        try:
+            index = SupabaseSignatureIndex(self.supabase)
+            if pdf_path:
+                index_pdf_file(index, document_id, pdf_path, content_hash)
+            else:
+                index_pdf_bytes(index, document_id, pdf_bytes, content_hash)
+        except Exception as e:
+            print(f"⚠️ No se pudo indexar las firmas del documento {document_id}: {str(e)}")
+    
+    def sign_pdf_with_certificate(self, pdf_bytes, user_id, certificate_id, signature_reason="Firma digital", document_id=None):
+        """
+        Firmar PDF usando el certificado del usuario.
+        Con `document_id` se actualiza el índice de firmas del documento.
+        """
+        return self.data.run_sync(self.sign_pdf_with_certificate_async(
+            pdf_bytes, user_id, certificate_id, signature_reason, document_id
+        ))
+    
+    async def sign_pdf_with_certificate_async(self, pdf_bytes, user_id, certificate_id, signature_reason="Firma digital", document_id=None):
+        """Versión async de sign_pdf_with_certificate; pre-chequeo, firma e indexado corren fuera del event loop"""
+        print(f"✍️ Firmando PDF para usuario {user_id}")
+        
+        try:
+            await self.data.run_blocking(precheck_pdf_bytes, pdf_bytes)
+            cert_data = await self.get_user_certificate_async(user_id, certificate_id)
+            make_pdf_signer = self._pdf_signer_factory(cert_data, signature_reason)
             
-            # Aplicar firma
-            fields.append_signature_field(
-                writer, 
-                signature_meta,
-                signer=signer
+            # Actualización incremental sobre el primer campo de firma libre
+            signed_pdf_bytes = await self.data.run_blocking(
+                functools.partial(sign_bytes, make_pdf_signer, pdf_bytes, precheck=False)
             )
-            
-            # Obtener PDF firmado
-            output_buffer.seek(0)
-            signed_pdf_bytes = output_buffer.getvalue()
+            content_hash = hashlib.sha256(signed_pdf_bytes).hexdigest()
+            audit("sign", document_id=document_id, user_id=user_id, certificate_id=certificate_id,
+                  reason=signature_reason, sha256=content_hash)
+            if document_id:
+                await self.data.run_blocking(
+                    functools.partial(self._index_signatures, document_id, pdf_bytes=signed_pdf_bytes, content_hash=content_hash)
+                )
             
             print(f"✅ PDF firmado exitosamente")
             print(f"📄 Tamaño original: {len(pdf_bytes)} bytes")
@@ -226,74 +419,216 @@ class DigitalSignatureManager:
             print(f"❌ Error firmando PDF: {str(e)}")
             raise e
     
-    def verify_pdf_signatures(self, pdf_bytes):
+    def sign_pdf_file_with_certificate(self, pdf_path, user_id, certificate_id, signature_reason="Firma digital", output_path=None, document_id=None):
         """
-        Verificar todas las firmas en un PDF
+        Firmar un PDF en disco sin cargarlo en memoria: solo se agrega la
+        actualización incremental al final del archivo original (o de una copia en `output_path`).
+        Pensado para expedientes escaneados grandes. Con `document_id` se actualiza el índice de firmas.
         """
-        print(f"🔍 Verificando firmas en PDF")
+        return self.data.run_sync(self.sign_pdf_file_with_certificate_async(
+            pdf_path, user_id, certificate_id, signature_reason, output_path, document_id
+        ))
+    
+    async def sign_pdf_file_with_certificate_async(self, pdf_path, user_id, certificate_id, signature_reason="Firma digital", output_path=None, document_id=None):
+        """Versión async de sign_pdf_file_with_certificate"""
+        print(f"✍️ Firmando PDF en disco para usuario {user_id}: {pdf_path}")
         
         try:
-            pdf_reader = PdfFileReader(io.BytesIO(pdf_bytes))
-            
-            # Obtener campos de firma
-            signature_fields = fields.enumerate_sig_fields(pdf_reader)
-            
-            signatures_info = []
-            
-            for field_name, sig_obj, sig_field in signature_fields:
-                try:
-                    # Verificar firma
-                    status = sig_obj.compute_integrity_info()
-                    
-                    # Obtener información del certificado
-                    cert_info = sig_obj.signer_info.signer_cert
-                    
-                    signature_info = {
-                        'field_name': field_name,
-                        'signer_name': cert_info.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value,
-                        'signer_email': cert_info.subject.get_attributes_for_oid(NameOID.EMAIL_ADDRESS)[0].value,
-                        'signing_time': sig_obj.signer_info.signing_time,
-                        'is_valid': status.intact,
-                        'reason': getattr(sig_obj, 'reason', 'No especificado'),
-                        'location': getattr(sig_obj, 'location', 'No especificado')
-                    }
-                    
-                    signatures_info.append(signature_info)
-                    
-                except Exception as e:
-                    print(f"⚠️ Error verificando firma {field_name}: {str(e)}")
+            original_size = os.path.getsize(pdf_path)
+            # Pre-chequeo (y copia a `output_path`) antes de descargar certificado y clave
+            target_path = await self.data.run_blocking(prepare_append_target, pdf_path, output_path)
+            cert_data = await self.get_user_certificate_async(user_id, certificate_id)
+            make_pdf_signer = self._pdf_signer_factory(cert_data, signature_reason)
+            await self.data.run_blocking(sign_append_only, make_pdf_signer, target_path)
+            audit("sign", document_id=document_id or target_path, user_id=user_id, certificate_id=certificate_id,
+                  reason=signature_reason)
+            if document_id:
+                await self.data.run_blocking(functools.partial(self._index_signatures, document_id, pdf_path=target_path))
             
-            print(f"✅ Verificación completada. {len(signatures_info)} firmas encontradas")
+            print(f"✅ PDF firmado exitosamente")
+            print(f"📄 Tamaño original: {original_size} bytes")
+            print(f"📄 Tamaño firmado: {os.path.getsize(target_path)} bytes")
             
-            return {
-                'total_signatures': len(signatures_info),
-                'signatures': signatures_info,
-                'verification_time': datetime.utcnow().isoformat()
-            }
+            return target_path
             
+        except Exception as e:
+            print(f"❌ Error firmando PDF: {str(e)}")
+            raise e
+    
+    def verify_pdf_signatures(self, pdf_bytes):
+        """
+        Verificar todas las firmas en un PDF
+        """
+        from pyhanko.pdf_utils.reader import PdfFileReader
+        
+        print(f"🔍 Verificando firmas en PDF")
+        
+        try:
+            precheck_pdf_bytes(pdf_bytes)
+            result = self._verify_reader(PdfFileReader(io.BytesIO(pdf_bytes)))
+            audit("verify", sha256=hashlib.sha256(pdf_bytes).hexdigest(), total_signatures=result['total_signatures'])
+            return result
         except Exception as e:
             print(f"❌ Error verificando PDF: {str(e)}")
             raise e
     
-    def set_pdf_signature_limit(self, document_id, max_signatures):
+    def verify_pdf_signatures_file(self, pdf_path):
         """
-        Establecer límite de firmas para un documento
+        Verificar todas las firmas de un PDF en disco a través de un mmap de solo lectura
         """
+        from pyhanko.pdf_utils.reader import PdfFileReader
+        
+        print(f"🔍 Verificando firmas en PDF: {pdf_path}")
+        
         try:
+            with mapped_pdf(pdf_path) as stream:
+                result = self._verify_reader(PdfFileReader(stream))
+            audit("verify", document_id=pdf_path, total_signatures=result['total_signatures'])
+            return result
+        except Exception as e:
+            print(f"❌ Error verificando PDF: {str(e)}")
+            raise e
+    
+    def _verify_reader(self, pdf_reader):
+        from pyhanko.sign.validation import validate_pdf_signature
+        
+        signatures_info = []
+        
+        for sig in pdf_reader.embedded_signatures:
+            field_name = sig.field_name
+            try:
+                # Verificar firma (integridad y firma criptográfica; la confianza no se exige)
+                status = validate_pdf_signature(sig)
+                
+                # Obtener información del certificado
+                subject = status.signing_cert.subject.native
+                
+                signature_info = {
+                    'field_name': field_name,
+                    'signer_name': subject.get('common_name'),
+                    'signer_email': subject.get('email_address'),
+                    'signing_time': status.signer_reported_dt or sig.self_reported_timestamp,
+                    'is_valid': status.intact,
+                    'reason': str(sig.sig_object.get('/Reason', '')) or 'No especificado',
+                    'location': str(sig.sig_object.get('/Location', '')) or 'No especificado'
+                }
+                
+                signatures_info.append(signature_info)
+                
+            except Exception as e:
+                print(f"⚠️ Error verificando firma {field_name}: {str(e)}")
+        
+        print(f"✅ Verificación completada. {len(signatures_info)} firmas encontradas")
+        
+        return {
+            'total_signatures': len(signatures_info),
+            'signatures': signatures_info,
+            'verification_time': datetime.utcnow().isoformat()
+        }
+    
+    def encrypt_stored_private_keys(self, page_size=200):
+        """
+        Migrar a cifrado con envoltura las claves privadas guardadas en claro: cada una se
+        sube cifrada junto a la original, se actualiza `private_key_path` y se borra la original.
+        Las ya cifradas y las de tokens PKCS#11 se omiten, así que se puede volver a ejecutar.
+        """
+        return self.data.run_sync(self.encrypt_stored_private_keys_async(page_size))
+    
+    async def encrypt_stored_private_keys_async(self, page_size=200):
+        """Versión async de encrypt_stored_private_keys; las claves de cada página se migran en paralelo"""
+        if get_master_key() is None:
+            raise ValueError("Configura KEY_MASTER_KEYFILE o KEY_KMS_STANDIN_DIR antes de cifrar las claves")
+        
+        report = {"encrypted": 0, "already_encrypted": 0, "skipped": 0, "failed": []}
+        
+        async def encrypt_row(row):
+            if uses_pkcs11(row) or not row.get('private_key_path'):
+                report["skipped"] += 1
+                return
+            try:
+                stored = await self.data.download(row['private_key_path'])
+                if is_envelope(stored):
+                    report["already_encrypted"] += 1
+                    return
+                encrypted_path = f"{row['private_key_path']}.enc"
+                await self._upload_private_key_async(encrypted_path, row['user_id'], stored)
+                await self.data.update_certificate(row['id'], {'private_key_path': encrypted_path})
+                await self.data.remove([row['private_key_path']])
+                audit("private_key_encrypt", user_id=row['user_id'], certificate_id=row['id'])
+                report["encrypted"] += 1
+            except Exception as e:
+                report["failed"].append({"certificate_id": row['id'], "error": str(e)})
+        
+        offset = 0
+        while True:
+            rows = await self.data.select_certificate_page(offset, page_size)
+            await asyncio.gather(*(encrypt_row(row) for row in rows))
+            if len(rows) < page_size:
+                break
+            offset += page_size
+        
+        print(f"🔐 Claves cifradas: {report['encrypted']}, ya cifradas: {report['already_encrypted']}, "
+              f"omitidas: {report['skipped']}, con error: {len(report['failed'])}")
+        return report
+    
+    def set_pdf_signature_limit(self, document_id, max_signatures, pdf_path=None, normalize=False):
+        """
+        Establecer límite de firmas para un documento.
+        Si se pasa `pdf_path`, se crean una sola vez los `max_signatures` campos de firma vacíos,
+        para que cada firmante posterior solo llene un campo existente.
+        Con `normalize`, el PDF se normaliza antes (ver pdf_normalize); solo es posible sin firmas previas.
+        """
+        return self.data.run_sync(self.set_pdf_signature_limit_async(document_id, max_signatures, pdf_path, normalize))
+    
+    async def set_pdf_signature_limit_async(self, document_id, max_signatures, pdf_path=None, normalize=False):
+        """Versión async de set_pdf_signature_limit; el trabajo sobre el PDF corre fuera del event loop"""
+        try:
+            if pdf_path:
+                await self.data.run_blocking(self._prepare_limited_pdf, pdf_path, max_signatures, normalize)
+            
             update_data = {
                 'requires_signatures': max_signatures,
                 'updated_at': datetime.utcnow().isoformat()
             }
             
-            result = self.supabase.table('documents').update(update_data).eq('id', document_id).execute()
+            updated = await self.data.update_document(document_id, update_data)
+            audit("signature_limit", document_id=document_id, max_signatures=max_signatures)
             
             print(f"✅ Límite de firmas establecido: {max_signatures} para documento {document_id}")
             
-            return result.data[0] if result.data else None
+            return updated[0] if updated else None
             
         except Exception as e:
             print(f"❌ Error estableciendo límite de firmas: {str(e)}")
             raise e
+    
+    @staticmethod
+    def _prepare_limited_pdf(pdf_path, max_signatures, normalize):
+        if normalize:
+            from pdf_normalize import normalize_pdf_file
+            report = normalize_pdf_file(pdf_path)
+            print(f"🗜️ PDF normalizado: {report['original_size']} → {report['normalized_size']} bytes")
+        created = prepare_signature_fields_file(pdf_path, max_signatures)
+        print(f"🖊️ Campos de firma pre-asignados: {', '.join(created) or 'ninguno nuevo'}")
+
+def _generate_for_user(user):
+    """Trabajo del pool de procesos: generar el par de claves de un usuario (debe ser picklable)"""
+    with contextlib.redirect_stdout(sys.stderr):
+        return DigitalSignatureManager.generate_certificate_and_key(user['user_name'], user['email'], user['user_id'])
+
+def load_users_file(path):
+    """Leer la lista de usuarios desde un CSV (con encabezados) o un JSON (lista de objetos)"""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.lower().endswith('.json'):
+            users = json.load(f)
+        else:
+            users = list(csv.DictReader(f))
+    
+    for i, user in enumerate(users):
+        missing = [field for field in ('user_id', 'user_name', 'email') if not user.get(field)]
+        if missing:
+            raise ValueError(f"Usuario #{i + 1} sin campos requeridos: {', '.join(missing)}")
+    return users
 
 # Ejemplo de uso
 def demo_complete_workflow():
@@ -323,8 +658,9 @@ def demo_complete_workflow():
         user_id, user_name, private_key_pem, certificate_pem, serial_number
     )
     
-    # 3. Simular PDF (en la práctica vendría del frontend)
-    sample_pdf = b"%PDF-1.4\n1 0 obj\n<<\n/Type /Catalog\n/Pages 2 0 R\n>>\nendobj\n..."
+    # 3. Simular PDF (en la práctica vendría del frontend); debe ser un PDF completo para pasar el pre-chequeo
+    from benchmark_signatures import make_synthetic_pdf
+    sample_pdf = make_synthetic_pdf(pages=2)
     
     # 4. Firmar PDF
     signed_pdf = signature_manager.sign_pdf_with_certificate(
@@ -337,5 +673,47 @@ def demo_complete_workflow():
     print("🎉 Demostración completada exitosamente!")
     print(f"📊 Resultado de verificación: {verification_result}")
 
+def main():
+    parser = argparse.ArgumentParser(description="Gestor de firmas digitales con Supabase")
+    parser.add_argument("--action", default="demo", choices=["demo", "bulk_issue_certificates", "encrypt_private_keys"])
+    parser.add_argument("--users_file", help="CSV o JSON con user_id, user_name y email")
+    parser.add_argument("--keygen_workers", type=int, default=None, help="Procesos para generar claves")
+    parser.add_argument("--upload_workers", type=int, default=8, help="Subidas concurrentes a Storage")
+    parser.add_argument("--supabase_url", default=os.getenv("SUPABASE_URL"))
+    parser.add_argument("--supabase_key", default=os.getenv("SUPABASE_SERVICE_ROLE_KEY"))
+    args = parser.parse_args()
+    
+    if args.action == "demo":
+        demo_complete_workflow()
+        return
+    
+    if args.action == "encrypt_private_keys":
+        try:
+            with contextlib.redirect_stdout(sys.stderr):
+                report = DigitalSignatureManager(args.supabase_url, args.supabase_key).encrypt_stored_private_keys()
+            print(json.dumps({"success": not report["failed"], **report}))
+        except Exception as e:
+            print(json.dumps({"error": str(e)}))
+            sys.exit(1)
+        return
+    
+    try:
+        if not args.users_file:
+            raise ValueError("--users_file es requerido para bulk_issue_certificates")
+        users = load_users_file(args.users_file)
+        # Los logs van a stderr para que stdout sea solo el reporte JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            manager = DigitalSignatureManager(args.supabase_url, args.supabase_key)
+            report = manager.bulk_issue_certificates(users, args.keygen_workers, args.upload_workers)
+        print(json.dumps({
+            "success": all(entry['status'] == "issued" for entry in report),
+            "issued": sum(1 for entry in report if entry['status'] == "issued"),
+            "total": len(report),
+            "report": report
+        }))
+    except Exception as e:
+        print(json.dumps({"error": str(e)}))
+        sys.exit(1)
+
 if __name__ == "__main__":
-    demo_complete_workflow()
+    main()
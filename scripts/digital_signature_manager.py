@@ -1,17 +1,19 @@
-import os
 import io
+import sys
+import hashlib
 import json
 import base64
 import argparse
 from datetime import datetime, timedelta
-from cryptography import x509
-from cryptography.x509.oid import NameOID
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import rsa
-from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter
-from pyhanko.sign import signers, fields
-from pyhanko.pdf_utils.reader import PdfFileReader
-from pyhanko.sign.validation import validate_pdf_signature
+
+from audit_log import audit
+from pdf_io import mapped_pdf, prepare_append_target, sign_append_only, sign_bytes
+from pdf_precheck import PdfPrecheckError, precheck_pdf_bytes
+from signature_fields import prepare_signature_fields_file
+from signature_index import index_signed_bytes, index_signed_file
+
+# cryptography and pyhanko are imported inside the methods that use them, so a
+# verify invocation does not load the certificate builder and vice versa.
 
 class DigitalSignatureManager:
     """
@@ -20,6 +22,11 @@ class DigitalSignatureManager:
 
     def _generate_cert_and_key(self, user_name, email):
         """Generates a new RSA private key and a self-signed X.509 certificate."""
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID
+        from cryptography.hazmat.primitives import serialization, hashes
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
         private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
         subject = issuer = x509.Name([
             x509.NameAttribute(NameOID.COUNTRY_NAME, "MX"),
@@ -46,55 +53,122 @@ class DigitalSignatureManager:
         certificate_pem = certificate.public_bytes(serialization.Encoding.PEM)
         return private_key_pem, certificate_pem
 
-    def sign_pdf(self, pdf_bytes, user_name, email, reason="Firma de conformidad"):
-        """Applies a digital signature to a PDF document incrementally."""
-        private_key_pem, certificate_pem = self._generate_cert_and_key(user_name, email)
-        
-        signer = signers.SimpleSigner.load(
-            private_key_pem, certificate_pem, ca_chain_files=[], key_passphrase=None
+    @staticmethod
+    def _load_signer(private_key_pem, certificate_pem):
+        """Builds a pyhanko signer from in-memory PEM data."""
+        from pyhanko.keys import load_certs_from_pemder_data, load_private_key_from_pemder_data
+        from pyhanko.sign import signers
+        from pyhanko_certvalidator.registry import SimpleCertificateStore
+
+        signing_key = load_private_key_from_pemder_data(private_key_pem, passphrase=None)
+        signing_cert = next(iter(load_certs_from_pemder_data(certificate_pem)))
+        return signers.SimpleSigner(
+            signing_cert=signing_cert,
+            signing_key=signing_key,
+            cert_registry=SimpleCertificateStore.from_certs([signing_cert]),
         )
 
-        # Use IncrementalPdfFileWriter to add signatures without invalidating previous ones
-        w = IncrementalPdfFileWriter(io.BytesIO(pdf_bytes))
-        
-        signature_meta = signers.PdfSignatureMetadata(
-            field_name=f'Signature-{user_name.replace(" ", "")}',
-            reason=reason,
-            location='Sistema Digital Casa Monarca',
-            signer_name=user_name,
+    def _pdf_signer_factory(self, user_name, email, reason):
+        """
+        Returns a callable that builds the PdfSigner for the chosen signature field.
+        Key generation happens on that call, after the PDF passed its pre-check.
+        """
+        from pyhanko.sign import signers
+
+        def make_pdf_signer(field_name):
+            private_key_pem, certificate_pem = self._generate_cert_and_key(user_name, email)
+            signer = self._load_signer(private_key_pem, certificate_pem)
+            signature_meta = signers.PdfSignatureMetadata(
+                field_name=field_name,
+                reason=reason,
+                location='Sistema Digital Casa Monarca',
+                name=user_name,
+            )
+            return signers.PdfSigner(signature_meta, signer=signer)
+
+        return make_pdf_signer
+
+    @staticmethod
+    def _fallback_field_name(user_name):
+        # Only used for documents without pre-allocated (empty) signature fields
+        return f'Signature-{user_name.replace(" ", "")}'
+
+    def sign_pdf(self, pdf_bytes, user_name, email, reason="Firma de conformidad", document_id=None):
+        """
+        Applies a digital signature to a PDF document incrementally.
+        With `document_id`, the signature summary is recorded in the signature index.
+        """
+        # Incremental update: previous signatures stay valid
+        signed_pdf_bytes = sign_bytes(
+            self._pdf_signer_factory(user_name, email, reason), pdf_bytes, self._fallback_field_name(user_name)
         )
-        
-        fields.append_signature_field(w, sig_meta=signature_meta)
-        
-        output_buffer = io.BytesIO()
-        w.write(output_buffer, signer=signer, field_name=signature_meta.field_name)
-        output_buffer.seek(0)
-        
-        return output_buffer.getvalue()
+        content_hash = hashlib.sha256(signed_pdf_bytes).hexdigest()
+        audit("sign", document_id=document_id, signer=user_name, email=email, reason=reason, sha256=content_hash)
+        if document_id:
+            index_signed_bytes(document_id, signed_pdf_bytes, content_hash)
+        return signed_pdf_bytes
+
+    def sign_pdf_file(self, pdf_path, user_name, email, reason="Firma de conformidad", output_path=None, document_id=None):
+        """
+        Signs a PDF on disk without loading it into memory: only the incremental
+        update is appended, to the original file or to a copy at `output_path`.
+        The signature index keys it by `document_id`, or by the signed file's path.
+        """
+        target_path = prepare_append_target(pdf_path, output_path)
+        sign_append_only(
+            self._pdf_signer_factory(user_name, email, reason), target_path, self._fallback_field_name(user_name)
+        )
+        audit("sign", document_id=document_id or target_path, signer=user_name, email=email, reason=reason)
+        index_signed_file(document_id or target_path, target_path)
+        return target_path
+
+    def prepare_signature_fields(self, pdf_path, max_signers, normalize=False):
+        """
+        Creates all `max_signers` empty signature fields once, before the first signature.
+        With `normalize`, the document is first rewritten compactly (see pdf_normalize).
+        """
+        if normalize:
+            from pdf_normalize import normalize_pdf_file
+            normalize_pdf_file(pdf_path)
+        return prepare_signature_fields_file(pdf_path, max_signers)
 
     def verify_signatures(self, pdf_bytes):
         """Verifies all digital signatures in a PDF and returns their details."""
-        pdf_reader = PdfFileReader(io.BytesIO(pdf_bytes))
+        from pyhanko.pdf_utils.reader import PdfFileReader
+
+        precheck_pdf_bytes(pdf_bytes)
+        results = self._verify_reader(PdfFileReader(io.BytesIO(pdf_bytes)))
+        audit("verify", sha256=hashlib.sha256(pdf_bytes).hexdigest(), total_signatures=len(results))
+        return results
+
+    def verify_signatures_file(self, pdf_path):
+        """Verifies all digital signatures of a PDF on disk through a read-only memory map."""
+        from pyhanko.pdf_utils.reader import PdfFileReader
+
+        with mapped_pdf(pdf_path) as stream:
+            results = self._verify_reader(PdfFileReader(stream))
+        audit("verify", document_id=pdf_path, total_signatures=len(results))
+        return results
+
+    def _verify_reader(self, pdf_reader):
+        from pyhanko.sign.validation import validate_pdf_signature
+
         signatures = pdf_reader.embedded_signatures
         
         results = []
         for sig in signatures:
             try:
                 status = validate_pdf_signature(sig)
-                cert_info = status.signer_cert
                 
                 # Extract subject common name (signer's name)
-                signer_name = "N/A"
-                try:
-                    signer_name = cert_info.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value
-                except (IndexError, AttributeError):
-                    pass
+                signer_name = status.signing_cert.subject.native.get("common_name") or "N/A"
+                signing_time = status.signer_reported_dt or sig.self_reported_timestamp
 
                 results.append({
                     "signer_name": signer_name,
-                    "signing_time": status.signing_time.strftime("%Y-%m-%d %H:%M:%S %Z"),
-                    "reason": sig.reason or "No especificado",
-                    "location": sig.location or "No especificado",
+                    "signing_time": signing_time.strftime("%Y-%m-%d %H:%M:%S %Z") if signing_time else "N/A",
+                    "reason": str(sig.sig_object.get("/Reason", "")) or "No especificado",
+                    "location": str(sig.sig_object.get("/Location", "")) or "No especificado",
                     "valid": status.valid,
                     "intact": status.intact,
                     "trusted": status.trusted,
@@ -108,22 +182,62 @@ class DigitalSignatureManager:
 def main():
     """Main function to handle command-line arguments."""
     parser = argparse.ArgumentParser(description="Digital Signature Manager for PDFs.")
-    parser.add_argument("--action", required=True, choices=["sign", "verify"], help="Action to perform.")
-    parser.add_argument("--pdf_base64", required=True, help="Base64 encoded PDF content.")
+    parser.add_argument("--action", required=True, choices=["sign", "verify", "prepare_fields"], help="Action to perform.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--pdf_base64", help="Base64 encoded PDF content.")
+    source.add_argument("--pdf_path", help="Path to a PDF on disk (memory-mapped, signed append-only).")
+    parser.add_argument("--output_path", help="With --pdf_path: write the signed copy here instead of signing in place.")
     parser.add_argument("--user_name", help="User name for signing.")
     parser.add_argument("--email", help="User email for signing.")
     parser.add_argument("--reason", default="Firma de conformidad", help="Reason for signing.")
+    parser.add_argument("--document_id", help="Key of the document in the signature index (sign).")
+    parser.add_argument("--max_signers", type=int, help="Number of signature fields to pre-allocate (prepare_fields).")
+    parser.add_argument("--normalize", action="store_true", help="Normalize the PDF before pre-allocating fields (prepare_fields, requires pikepdf).")
     
     args = parser.parse_args()
     
+    try:
+        run_action(args)
+    except PdfPrecheckError as e:
+        # Malformed or oversized input rejected before full parsing
+        print(json.dumps(e.to_dict()))
+        sys.exit(1)
+
+def run_action(args):
+    """Dispatches the parsed command-line action."""
     manager = DigitalSignatureManager()
-    pdf_bytes = base64.b64decode(args.pdf_b64)
     
-    if args.action == "sign":
-        if not args.user_name or not args.email:
-            print(json.dumps({"error": "User name and email are required for signing."}))
+    if args.action == "sign" and (not args.user_name or not args.email):
+        print(json.dumps({"error": "User name and email are required for signing."}))
+        return
+    
+    if args.action == "prepare_fields":
+        if not args.pdf_path or not args.max_signers:
+            print(json.dumps({"error": "pdf_path and max_signers are required to prepare signature fields."}))
             return
-        signed_pdf_bytes = manager.sign_pdf(pdf_bytes, args.user_name, args.email, args.reason)
+        try:
+            created = manager.prepare_signature_fields(args.pdf_path, args.max_signers, args.normalize)
+        except (ValueError, RuntimeError) as e:
+            # Already signed (normalizing would invalidate it) or pikepdf missing
+            print(json.dumps({"error": str(e)}))
+            sys.exit(1)
+        print(json.dumps({"created_fields": created}))
+        return
+    
+    if args.pdf_path:
+        if args.action == "sign":
+            signed_path = manager.sign_pdf_file(
+                args.pdf_path, args.user_name, args.email, args.reason, args.output_path, args.document_id
+            )
+            print(json.dumps({"signed_pdf_path": signed_path}))
+        else:
+            print(json.dumps(manager.verify_signatures_file(args.pdf_path)))
+        return
+    
+    pdf_bytes = base64.b64decode(args.pdf_base64)
+    
+    if args.action == "sign":
+        signed_pdf_bytes = manager.sign_pdf(pdf_bytes, args.user_name, args.email, args.reason, args.document_id)
         print(json.dumps({"signed_pdf_base64": base64.b64encode(signed_pdf_bytes).decode('utf-8')}))
     
     elif args.action == "verify":
@@ -0,0 +1,461 @@
+"""
+In-process stand-in for the Supabase client.
+
+DigitalSignatureManager (digital_signature_backend.py) and the signature
+index only use a small slice of supabase-py: PostgREST-style table queries,
+`rpc()` and Storage buckets. FakeSupabaseClient implements that slice over
+in-memory dicts so the signing paths can be load- and soak-tested offline:
+
+    client = FakeSupabaseClient(latency=(0.005, 0.02), error_rate=0.01, seed=7)
+    manager = DigitalSignatureManager(None, None, client=client)
+
+Every call goes through one fault point that sleeps for the configured
+latency and may raise FakeSupabaseError, either at random (`error_rate`) or
+deterministically (`fail_next("storage.upload", 2)`), so retry and cleanup
+paths run as well. Storage keeps Supabase's semantics where the code
+depends on them: uploading to an existing path fails unless the upsert
+option is set, and downloading a missing object fails.
+"""
+
+import copy
+import fnmatch
+import random
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+
+class FakeSupabaseError(Exception):
+    """Raised by the fake where supabase-py would raise an APIError or a StorageException."""
+
+    def __init__(self, message, code=None, status=None):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+        self.status = status
+
+
+class FakeResponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+def _now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _compare(value, op, expected):
+    if op == "is":
+        return value is None if expected in (None, "null") else value == expected
+    if value is None:
+        return False
+    if op == "eq":
+        return value == expected or str(value) == str(expected)
+    if op == "neq":
+        return not (value == expected or str(value) == str(expected))
+    if op == "in":
+        return value in expected or str(value) in {str(item) for item in expected}
+    if op in ("gt", "gte", "lt", "lte"):
+        if isinstance(value, (int, float)) and not isinstance(expected, (int, float)):
+            expected = type(value)(expected)
+        elif not isinstance(value, (int, float)):
+            value, expected = str(value), str(expected)
+        return {"gt": value > expected, "gte": value >= expected,
+                "lt": value < expected, "lte": value <= expected}[op]
+    if op in ("like", "ilike"):
+        pattern = str(expected).replace("%", "*")
+        return fnmatch.fnmatchcase(str(value).lower(), pattern.lower()) if op == "ilike" \
+            else fnmatch.fnmatchcase(str(value), pattern)
+    raise ValueError(f"Unsupported filter operator: {op}")
+
+
+def _parse_or(expression):
+    """
+    `a.eq.1,b.eq."x, y"` (PostgREST `or=(...)`) -> [(column, op, value)]. Double-quoted
+    values may contain `,` `.` `(` `)` and escape `"` and `\\` with a backslash.
+    """
+    parts, current, quoted, escaped = [], [], False, False
+    for char in expression:
+        if escaped:
+            current.append(char)
+            escaped = False
+        elif quoted and char == "\\":
+            escaped = True
+        elif char == '"':
+            quoted = not quoted
+        elif char == "," and not quoted:
+            parts.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+    parts.append("".join(current))
+    conditions = []
+    for part in parts:
+        column, op, value = part.split(".", 2)
+        conditions.append((column, op, value))
+    return conditions
+
+
+class _Negation:
+    """`query.not_.in_(...)`: the next filter is negated."""
+
+    def __init__(self, query):
+        self._query = query
+
+    def __getattr__(self, name):
+        method = getattr(self._query, name)
+
+        def negated(*args, **kwargs):
+            self._query._negate_next = True
+            return method(*args, **kwargs)
+        return negated
+
+
+class _Query:
+    """Chainable query over one table (or over rows returned by an RPC)."""
+
+    def __init__(self, client, table, action="select", payload=None, rpc=None, **options):
+        self._client = client
+        self._table = table
+        self._action = action
+        self._payload = payload
+        self._rpc = rpc  # (function, params): the RPC runs at execute(), like the real request
+        self._options = options
+        self._filters = []
+        self._order = []
+        self._limit = None
+        self._range = None
+        self._columns = "*"
+        self._negate_next = False
+
+    # --- Actions ---
+    def select(self, columns="*", count=None):
+        if self._action == "select":
+            self._columns = columns
+        self._options["count"] = count
+        return self
+
+    def insert(self, rows, **options):
+        return _Query(self._client, self._table, "insert", rows, **options)
+
+    def upsert(self, rows, on_conflict=None, **options):
+        return _Query(self._client, self._table, "upsert", rows, on_conflict=on_conflict, **options)
+
+    def update(self, values, **options):
+        return _Query(self._client, self._table, "update", values, **options)
+
+    def delete(self, **options):
+        return _Query(self._client, self._table, "delete", **options)
+
+    # --- Filters ---
+    def _filter(self, column, op, value):
+        self._filters.append((self._negate_next, [(column, op, value)]))
+        self._negate_next = False
+        return self
+
+    @property
+    def not_(self):
+        return _Negation(self)
+
+    def eq(self, column, value):
+        return self._filter(column, "eq", value)
+
+    def neq(self, column, value):
+        return self._filter(column, "neq", value)
+
+    def gt(self, column, value):
+        return self._filter(column, "gt", value)
+
+    def gte(self, column, value):
+        return self._filter(column, "gte", value)
+
+    def lt(self, column, value):
+        return self._filter(column, "lt", value)
+
+    def lte(self, column, value):
+        return self._filter(column, "lte", value)
+
+    def like(self, column, pattern):
+        return self._filter(column, "like", pattern)
+
+    def ilike(self, column, pattern):
+        return self._filter(column, "ilike", pattern)
+
+    def is_(self, column, value):
+        return self._filter(column, "is", value)
+
+    def in_(self, column, values):
+        return self._filter(column, "in", list(values))
+
+    def or_(self, expression):
+        self._filters.append((self._negate_next, _parse_or(expression)))
+        self._negate_next = False
+        return self
+
+    # --- Modifiers ---
+    def order(self, column, desc=False):
+        self._order.append((column, desc))
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def range(self, start, end):
+        self._range = (start, end)
+        return self
+
+    def _matches(self, row):
+        for negated, conditions in self._filters:
+            matched = any(_compare(row.get(column), op, value) for column, op, value in conditions)
+            if matched == negated:
+                return False
+        return True
+
+    def _shape(self, rows):
+        for column, desc in reversed(self._order):
+            rows.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+        if self._range is not None:
+            rows = rows[self._range[0]:self._range[1] + 1]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        if self._columns.strip() != "*":
+            columns = [column.strip() for column in self._columns.split(",")]
+            rows = [{column: row.get(column) for column in columns} for row in rows]
+        return rows
+
+    def execute(self):
+        if self._rpc is not None:
+            return self._client._call(f"rpc.{self._table}", self._run_rpc)
+        return self._client._call(f"table.{self._action}", getattr(self, f"_{self._action}"))
+
+    def _run_rpc(self):
+        function, params = self._rpc
+        return self._select_from(function(self._client, params))
+
+    def _select_from(self, rows):
+        matched = [row for row in rows if self._matches(row)]
+        count = len(matched) if self._options.get("count") else None
+        return FakeResponse(copy.deepcopy(self._shape(matched)), count)
+
+    def _select(self):
+        return self._select_from(self._client.tables[self._table])
+
+    def _insert(self):
+        rows = self._payload if isinstance(self._payload, list) else [self._payload]
+        stored = self._client.tables[self._table]
+        prepared = [self._client._prepare_row(row) for row in rows]
+        existing = {row["id"] for row in stored}
+        for row in prepared:
+            if row["id"] in existing:
+                raise FakeSupabaseError(f'duplicate key value violates unique constraint "{self._table}_pkey"',
+                                        code="23505", status=409)
+            existing.add(row["id"])
+        stored.extend(prepared)
+        return FakeResponse(copy.deepcopy(prepared))
+
+    def _upsert(self):
+        rows = self._payload if isinstance(self._payload, list) else [self._payload]
+        keys = [key.strip() for key in (self._options.get("on_conflict") or "id").split(",")]
+        stored = self._client.tables[self._table]
+        result = []
+        for row in rows:
+            current = next((r for r in stored if all(str(r.get(k)) == str(row.get(k)) for k in keys)), None)
+            if current is None:
+                current = self._client._prepare_row(row)
+                stored.append(current)
+            else:
+                current.update(copy.deepcopy(row))
+            result.append(copy.deepcopy(current))
+        return FakeResponse(result)
+
+    def _update(self):
+        updated = []
+        for row in self._client.tables[self._table]:
+            if self._matches(row):
+                row.update(copy.deepcopy(self._payload))
+                updated.append(copy.deepcopy(row))
+        return FakeResponse(updated)
+
+    def _delete(self):
+        stored = self._client.tables[self._table]
+        removed = [row for row in stored if self._matches(row)]
+        stored[:] = [row for row in stored if not self._matches(row)]
+        return FakeResponse(removed)
+
+
+class _Bucket:
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def _objects(self):
+        return self._client.buckets[self._name]
+
+    def upload(self, path, file, file_options=None):
+        if isinstance(file, (bytes, bytearray)):
+            data = file
+        else:
+            with open(file, "rb") as f:
+                data = f.read()
+        options = {key.lower(): str(value).lower() for key, value in (file_options or {}).items()}
+        upsert = options.get("upsert", options.get("x-upsert")) == "true"
+
+        def store():
+            objects = self._objects()
+            if path in objects and not upsert:
+                raise FakeSupabaseError("The resource already exists", code="Duplicate", status=409)
+            objects[path] = bytes(data)
+            return FakeResponse({"path": path, "fullPath": f"{self._name}/{path}"})
+        return self._client._call("storage.upload", store)
+
+    def update(self, path, file, file_options=None):
+        return self.upload(path, file, {**(file_options or {}), "upsert": "true"})
+
+    def download(self, path):
+        def fetch():
+            try:
+                return self._objects()[path]
+            except KeyError:
+                raise FakeSupabaseError("Object not found", code="not_found", status=404)
+        return self._client._call("storage.download", fetch)
+
+    def remove(self, paths):
+        def delete():
+            objects = self._objects()
+            return [{"name": path} for path in paths if objects.pop(path, None) is not None]
+        return self._client._call("storage.remove", delete)
+
+    def list(self, path=None, options=None):
+        prefix = f"{path.rstrip('/')}/" if path else ""
+
+        def listing():
+            names = sorted(name[len(prefix):] for name in self._objects() if name.startswith(prefix))
+            return [{"name": name} for name in names]
+        return self._client._call("storage.list", listing)
+
+
+class _Storage:
+    def __init__(self, client):
+        self._client = client
+
+    def from_(self, bucket):
+        return _Bucket(self._client, bucket)
+
+
+def _signature_index_for_documents(client, params):
+    """Builtin for the RPC of create-signature-index-table.sql."""
+    wanted = {str(document_id) for document_id in params.get("document_ids") or []}
+    return [row for row in client.tables["signature_index"] if str(row.get("document_id")) in wanted]
+
+
+def _activate_renewed_certificate(client, params):
+    """Builtin for the RPC of create-certificate-renewal.sql: runs under the client lock, so the switch is atomic."""
+    old_id = str(params["old_certificate_id"])
+    rows = client.tables["user_certificates"]
+    old = next((row for row in rows if str(row.get("id")) == old_id and row.get("is_active")), None)
+    if old is None:
+        raise FakeSupabaseError(f"certificate {old_id} is not active", code="P0002", status=400)
+    new = client._prepare_row({**params["new_certificate"], "is_active": True, "renewed_from_id": old_id})
+    old["is_active"] = False
+    old["updated_at"] = _now_iso()
+    rows.append(new)
+    return [new]
+
+
+class FakeSupabaseClient:
+    """
+    Thread-safe in-memory Supabase client with latency and error injection.
+
+    latency: seconds added to every call, a number or a (min, max) range.
+    error_rate: probability that a call raises FakeSupabaseError.
+    fail_only: operation names eligible for random errors (default all), e.g.
+        {"storage.upload", "table.insert"}.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, fail_only=None, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fail_only = set(fail_only) if fail_only else None
+        self.tables = defaultdict(list)
+        self.buckets = defaultdict(dict)
+        self.calls = Counter()
+        self.injected_errors = Counter()
+        self.storage = _Storage(self)
+        self._rpc = {
+            "signature_index_for_documents": _signature_index_for_documents,
+            "activate_renewed_certificate": _activate_renewed_certificate,
+        }
+        self._forced = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+
+    # --- Supabase API ---
+    def table(self, name):
+        return _Query(self, name)
+
+    from_ = table
+
+    def rpc(self, name, params=None):
+        if name not in self._rpc:
+            raise FakeSupabaseError(f"Could not find the function public.{name}", code="PGRST202", status=404)
+        return _Query(self, name, rpc=(self._rpc[name], params or {}))
+
+    # --- Test controls ---
+    def register_rpc(self, name, function):
+        """`function(client, params)` returns the rows of the RPC; they can be filtered like a table."""
+        self._rpc[name] = function
+
+    def fail_next(self, operation, times=1):
+        """Make the next `times` calls of `operation` (e.g. "storage.download") fail."""
+        with self._lock:
+            self._forced[operation] += times
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": dict(self.calls),
+                "injected_errors": dict(self.injected_errors),
+                "rows": {name: len(rows) for name, rows in self.tables.items()},
+                "objects": {name: len(objects) for name, objects in self.buckets.items()},
+                "stored_bytes": sum(len(data) for objects in self.buckets.values() for data in objects.values()),
+            }
+
+    def reset(self):
+        with self._lock:
+            self.tables.clear()
+            self.buckets.clear()
+            self.calls.clear()
+            self.injected_errors.clear()
+            self._forced.clear()
+
+    # --- Internals ---
+    def _prepare_row(self, row):
+        row = copy.deepcopy(row)
+        row.setdefault("id", str(uuid.uuid4()))
+        row.setdefault("created_at", _now_iso())
+        return row
+
+    def _delay(self):
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            with self._lock:
+                latency = self._random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+
+    def _call(self, operation, function, *args):
+        self._delay()  # Outside the lock: concurrent callers overlap like real requests
+        with self._lock:
+            self.calls[operation] += 1
+            forced = self._forced[operation] > 0
+            if forced:
+                self._forced[operation] -= 1
+            eligible = self.fail_only is None or operation in self.fail_only
+            if forced or (eligible and self.error_rate and self._random.random() < self.error_rate):
+                self.injected_errors[operation] += 1
+                raise FakeSupabaseError(f"Injected failure in {operation}", code="injected", status=503)
+            return function(*args)
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Envelope encryption for stored private keys, with a decrypted-key cache.
+
+Each private key is encrypted with its own random data key (AES-256-GCM,
+bound to a context such as the user id), and the data key is wrapped by a
+master key that never leaves its holder:
+
+- LocalKeyfileMaster: 32 random bytes in a local file (KEY_MASTER_KEYFILE),
+  wrapping with AES key wrap (RFC 3394).
+- KmsStandInMaster: a local stand-in for a cloud KMS (KEY_KMS_STANDIN_DIR).
+  Wrap/unwrap are "remote" calls with a configurable round-trip latency, and
+  keys are versioned so they can be rotated without re-encrypting anything.
+
+There is no password KDF anywhere, but unwrapping through a KMS still costs a
+round trip, so decrypt_private_key() keeps unwrapped keys in a bounded,
+TTL-limited cache (PRIVATE_KEY_CACHE_SIZE, PRIVATE_KEY_CACHE_TTL). Entries
+live in anonymous mmaps that are mlock()ed where the platform and
+RLIMIT_MEMLOCK allow it (never swapped), excluded from core dumps, and
+zeroed on eviction, expiry, purge() and exit. Plaintext PEM keys stored
+before encryption was enabled are still accepted (see is_envelope).
+"""
+
+import argparse
+import atexit
+import base64
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import mmap
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+ENVELOPE_MAGIC = b"CMKEYENV1\n"
+DATA_KEY_BYTES = 32
+DEFAULT_CACHE_SIZE = 128
+DEFAULT_CACHE_TTL = 300.0
+
+
+# --- Locked memory ---
+
+def _libc():
+    if not sys.platform.startswith(("linux", "darwin", "freebsd")):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.mlock.argtypes = libc.munlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+_LIBC = _libc()
+
+
+class LockedBuffer:
+    """Secret bytes in an anonymous mapping, locked in RAM when possible and wiped on close()."""
+
+    def __init__(self, data):
+        self.size = len(data)
+        self._map = mmap.mmap(-1, max(self.size, 1))
+        if hasattr(mmap, "MADV_DONTDUMP"):
+            self._map.madvise(mmap.MADV_DONTDUMP)
+        view = ctypes.c_char.from_buffer(self._map)
+        self._address = ctypes.addressof(view)
+        del view  # A live export would keep the mapping from being closed
+        self.locked = bool(_LIBC) and _LIBC.mlock(self._address, len(self._map)) == 0
+        self._map[:self.size] = data
+
+    def read(self):
+        return bytes(self._map[:self.size])
+
+    def close(self):
+        if self._map.closed:
+            return
+        self._map[:] = bytes(len(self._map))
+        if self.locked:
+            _LIBC.munlock(self._address, len(self._map))
+        self._map.close()
+
+
+class DecryptedKeyCache:
+    """Bounded LRU of decrypted keys with a TTL; every entry is a LockedBuffer."""
+
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()  # key -> (LockedBuffer, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            buffer, expires_at = entry
+            if self.clock() >= expires_at:
+                self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return buffer.read()
+
+    def put(self, key, data):
+        if self.max_entries <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            now = self.clock()
+            for stale in [k for k, (_, expires_at) in self._entries.items() if now >= expires_at]:
+                self._drop(stale)
+            while len(self._entries) >= self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+            self._entries[key] = (LockedBuffer(data), now + self.ttl)
+
+    def purge(self, key=None):
+        """Wipes one entry, or every entry when `key` is None."""
+        with self._lock:
+            for stale in ([key] if key is not None else list(self._entries)):
+                if stale in self._entries:
+                    self._drop(stale)
+
+    def _drop(self, key):
+        buffer, _ = self._entries.pop(key)
+        buffer.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "locked": sum(1 for buffer, _ in self._entries.values() if buffer.locked),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+            }
+
+
+# --- Master keys ---
+
+def create_keyfile(path):
+    """Writes a new random master key readable only by its owner; refuses to overwrite one."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(os.urandom(DATA_KEY_BYTES))
+    return path
+
+
+class LocalKeyfileMaster:
+    """Master key in a local keyfile; wraps data keys with AES key wrap."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._key = f.read()
+        if len(self._key) != DATA_KEY_BYTES:
+            raise ValueError(f"The master keyfile {path} must contain exactly {DATA_KEY_BYTES} bytes")
+        self.key_id = "local:" + hashlib.sha256(self._key).hexdigest()[:16]
+
+    def wrap(self, data_key):
+        from cryptography.hazmat.primitives.keywrap import aes_key_wrap
+        return self.key_id, aes_key_wrap(self._key, data_key)
+
+    def unwrap(self, key_id, wrapped):
+        from cryptography.hazmat.primitives.keywrap import aes_key_unwrap
+        if key_id != self.key_id:
+            raise ValueError(f"Data key wrapped by {key_id}, but the configured master key is {self.key_id}")
+        return aes_key_unwrap(self._key, wrapped)
+
+
+class KmsStandInMaster:
+    """
+    Local stand-in for a cloud KMS. Key versions live in `directory` as
+    `<alias>.v<N>.key` (created on first use, like a KMS key); wrap always uses
+    the newest version, unwrap the version recorded in the envelope. Each call
+    sleeps `latency` seconds to model the network round trip.
+    """
+
+    def __init__(self, directory, alias="signing-keys", latency=0.02):
+        self.directory = directory
+        self.alias = alias
+        self.latency = latency
+        self.calls = 0
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.created = not self._versions()
+        if self.created:
+            self.rotate()
+
+    def _versions(self):
+        prefix = f"{self.alias}.v"
+        return sorted(
+            int(name[len(prefix):-len(".key")])
+            for name in os.listdir(self.directory)
+            if name.startswith(prefix) and name.endswith(".key")
+        )
+
+    def _key(self, version):
+        with open(os.path.join(self.directory, f"{self.alias}.v{version}.key"), "rb") as f:
+            return f.read()
+
+    def rotate(self):
+        """Creates a new key version; envelopes wrapped by older versions still unwrap."""
+        version = (self._versions() or [0])[-1] + 1
+        create_keyfile(os.path.join(self.directory, f"{self.alias}.v{version}.key"))
+        return f"kms:{self.alias}/v{version}"
+
+    def current_key_id(self):
+        return f"kms:{self.alias}/v{self._versions()[-1]}"
+
+    def _remote_call(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def wrap(self, data_key):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        self._remote_call()
+        key_id = self.current_key_id()
+        nonce = os.urandom(12)
+        key = self._key(int(key_id.rsplit("/v", 1)[1]))
+        return key_id, nonce + AESGCM(key).encrypt(nonce, data_key, key_id.encode())
+
+    def unwrap(self, key_id, wrapped):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        self._remote_call()
+        alias, _, version = key_id[len("kms:"):].partition("/v")
+        if not key_id.startswith("kms:") or alias != self.alias:
+            raise ValueError(f"Data key wrapped by {key_id}, not by KMS key {self.alias}")
+        return AESGCM(self._key(int(version))).decrypt(wrapped[:12], wrapped[12:], key_id.encode())
+
+
+# --- Envelopes ---
+
+def is_envelope(blob):
+    return bytes(blob[:len(ENVELOPE_MAGIC)]) == ENVELOPE_MAGIC
+
+
+def encrypt_private_key(private_key_pem, context, master):
+    """Encrypts `private_key_pem` under a fresh data key wrapped by `master`; `context` must match on decrypt."""
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    data_key = AESGCM.generate_key(bit_length=DATA_KEY_BYTES * 8)
+    nonce = os.urandom(12)
+    ciphertext = AESGCM(data_key).encrypt(nonce, private_key_pem, str(context).encode())
+    key_id, wrapped = master.wrap(data_key)
+    envelope = {
+        "alg": "A256GCM",
+        "kek": key_id,
+        "wrapped_key": base64.b64encode(wrapped).decode(),
+        "nonce": base64.b64encode(nonce).decode(),
+        "ciphertext": base64.b64encode(ciphertext).decode(),
+    }
+    return ENVELOPE_MAGIC + json.dumps(envelope, sort_keys=True).encode()
+
+
+def decrypt_private_key(blob, context, master=None, cache=None):
+    """
+    Returns the plaintext PEM of an envelope (or `blob` itself if it is a legacy plaintext
+    key). Repeated calls for the same envelope and context are served from `cache`
+    (the process-wide cache by default) without unwrapping again.
+    """
+    if not is_envelope(blob):
+        return blob
+    cache = get_key_cache() if cache is None else cache
+    cache_key = hashlib.sha256(bytes(blob) + b"\0" + str(context).encode()).digest()
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    master = master or get_master_key()
+    if master is None:
+        raise ValueError("Encrypted private key, but no master key is configured (KEY_MASTER_KEYFILE or KEY_KMS_STANDIN_DIR)")
+    envelope = json.loads(bytes(blob[len(ENVELOPE_MAGIC):]))
+    data_key = master.unwrap(envelope["kek"], base64.b64decode(envelope["wrapped_key"]))
+    private_key_pem = AESGCM(data_key).decrypt(
+        base64.b64decode(envelope["nonce"]), base64.b64decode(envelope["ciphertext"]), str(context).encode()
+    )
+    cache.put(cache_key, private_key_pem)
+    return private_key_pem
+
+
+# --- Process-wide configuration ---
+
+_master = None
+_cache = None
+_config_lock = threading.Lock()
+
+
+def get_master_key():
+    """Master key from the environment, or None when encryption is not configured."""
+    global _master
+    with _config_lock:
+        if _master is None:
+            if os.getenv("KEY_MASTER_KEYFILE"):
+                _master = LocalKeyfileMaster(os.getenv("KEY_MASTER_KEYFILE"))
+            elif os.getenv("KEY_KMS_STANDIN_DIR"):
+                _master = KmsStandInMaster(
+                    os.getenv("KEY_KMS_STANDIN_DIR"),
+                    alias=os.getenv("KEY_KMS_KEY_ALIAS", "signing-keys"),
+                    latency=float(os.getenv("KEY_KMS_LATENCY", "0.02")),
+                )
+        return _master
+
+
+def get_key_cache():
+    global _cache
+    with _config_lock:
+        if _cache is None:
+            _cache = DecryptedKeyCache(
+                max_entries=int(os.getenv("PRIVATE_KEY_CACHE_SIZE", str(DEFAULT_CACHE_SIZE))),
+                ttl=float(os.getenv("PRIVATE_KEY_CACHE_TTL", str(DEFAULT_CACHE_TTL))),
+            )
+            atexit.register(_cache.purge)
+        return _cache
+
+
+def purge_cache():
+    """Wipes every decrypted key held by this process (e.g. after revoking certificates)."""
+    if _cache is not None:
+        _cache.purge()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Master keys for envelope-encrypted private keys")
+    parser.add_argument("--action", required=True, choices=["create_keyfile", "rotate_kms_key"])
+    parser.add_argument("--keyfile", default=os.getenv("KEY_MASTER_KEYFILE"), help="Path of the local master keyfile")
+    parser.add_argument("--kms_dir", default=os.getenv("KEY_KMS_STANDIN_DIR"), help="Directory of the KMS stand-in")
+    parser.add_argument("--kms_alias", default=os.getenv("KEY_KMS_KEY_ALIAS", "signing-keys"))
+    args = parser.parse_args()
+
+    try:
+        if args.action == "create_keyfile":
+            if not args.keyfile:
+                raise ValueError("--keyfile (or KEY_MASTER_KEYFILE) is required")
+            create_keyfile(args.keyfile)
+            print(json.dumps({"success": True, "keyfile": args.keyfile,
+                              "key_id": LocalKeyfileMaster(args.keyfile).key_id}))
+        else:
+            if not args.kms_dir:
+                raise ValueError("--kms_dir (or KEY_KMS_STANDIN_DIR) is required")
+            master = KmsStandInMaster(args.kms_dir, args.kms_alias, latency=0)
+            key_id = master.current_key_id() if master.created else master.rotate()
+            print(json.dumps({"success": True, "key_id": key_id}))
+    except Exception as e:
+        print(json.dumps({"error": str(e)}))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
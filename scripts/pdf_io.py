@@ -0,0 +1,118 @@
+"""
+File-backed PDF input/output helpers shared by the signature scripts.
+
+Large documents (200 MB scanned case files) must not be read into `bytes`
+and copied into `io.BytesIO` buffers. Readers get a read-only mmap of the
+file instead, and signing appends only the incremental update to the
+original file (or to a kernel-side copy of it).
+"""
+
+import io
+import os
+import mmap
+import shutil
+from contextlib import contextmanager
+
+from pdf_precheck import precheck_pdf_bytes, precheck_pdf_file
+from signature_fields import choose_signature_field
+
+
+class MappedStream(io.RawIOBase):
+    """
+    Read-only, seekable binary stream over an mmap. The mmap object lacks
+    `readinto`, which pyhanko's reader relies on; copies are limited to the
+    bytes actually requested.
+    """
+
+    def __init__(self, mapped):
+        super().__init__()
+        self._mapped = mapped
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast("B")
+        count = max(0, min(len(view), len(self._mapped) - self._position))
+        view[:count] = self._mapped[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._mapped)
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+
+@contextmanager
+def mapped_pdf(pdf_path):
+    """
+    Yields a read-only memory map of `pdf_path` usable as a seekable binary
+    stream by PdfFileReader / IncrementalPdfFileWriter. Pages are loaded on
+    demand from the page cache, so RSS does not grow with document size.
+    The file is structurally pre-checked first (see pdf_precheck).
+    """
+    precheck_pdf_file(pdf_path)
+    with open(pdf_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError(f"Empty PDF file: {pdf_path}")
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield MappedStream(mapped)
+        finally:
+            mapped.close()
+
+
+def prepare_append_target(input_path, output_path=None):
+    """
+    Returns the file the incremental update should be appended to.
+    Without `output_path` the original file is signed in place; otherwise the
+    original is copied first (copy_file_range/sendfile on Linux, no userspace buffer).
+    The input is structurally pre-checked before anything is written.
+    """
+    precheck_pdf_file(input_path)
+    if not output_path or os.path.abspath(output_path) == os.path.abspath(input_path):
+        return input_path
+    shutil.copyfile(input_path, output_path)
+    return output_path
+
+
+def sign_append_only(make_pdf_signer, target_path, fallback_field_name=None):
+    """
+    Signs `target_path` by appending only the incremental update to the end of the file.
+    `make_pdf_signer(field_name)` builds the PdfSigner once the field is chosen
+    (a pre-allocated empty field when available, see signature_fields).
+    """
+    from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter
+
+    with open(target_path, "r+b") as pdf_file:
+        writer = IncrementalPdfFileWriter(pdf_file)
+        field_name, existing_only = choose_signature_field(writer.prev, fallback_field_name)
+        make_pdf_signer(field_name).sign_pdf(writer, existing_fields_only=existing_only, in_place=True)
+    return target_path
+
+
+def sign_bytes(make_pdf_signer, pdf_bytes, fallback_field_name=None, precheck=True):
+    """
+    In-memory counterpart of sign_append_only for small documents sent as bytes.
+    `precheck=False` when the caller already pre-checked these bytes.
+    """
+    from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter
+
+    if precheck:
+        precheck_pdf_bytes(pdf_bytes)
+    writer = IncrementalPdfFileWriter(io.BytesIO(pdf_bytes))
+    field_name, existing_only = choose_signature_field(writer.prev, fallback_field_name)
+    return make_pdf_signer(field_name).sign_pdf(writer, existing_fields_only=existing_only).getvalue()
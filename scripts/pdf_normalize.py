@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Upload-time PDF normalization.
+
+Documents from scanners and office suites often carry classic xref tables,
+uncompressed objects, duplicated images/fonts and damaged cross-reference
+sections that force pyhanko into slow recovery on every sign and verify.
+Normalizing once, before the first signature, rewrites the file with
+compressed object streams and an xref stream, repairs the xref, and drops
+duplicate resources, so every later incremental pass runs over a smaller,
+well-formed file.
+
+Requires pikepdf (qpdf). Normalization rewrites the whole file, so it is
+refused on documents that already carry signatures.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+from pdf_precheck import PdfPrecheckError, precheck_pdf_file
+
+# Structural problems that normalization is meant to repair
+REPAIRABLE_PRECHECK_CODES = {"missing_startxref", "bad_startxref"}
+
+RESOURCE_CATEGORIES = ("/XObject", "/Font", "/ExtGState", "/ColorSpace", "/Pattern", "/Shading")
+
+
+def _import_pikepdf():
+    try:
+        import pikepdf
+    except ImportError as e:
+        raise RuntimeError("pikepdf is required to normalize PDFs (pip install pikepdf)") from e
+    return pikepdf
+
+
+def _has_signatures(pdf):
+    acroform = pdf.Root.get("/AcroForm")
+    if acroform is None:
+        return False
+    pending = list(acroform.get("/Fields", []))
+    while pending:
+        field = pending.pop()
+        if field.get("/FT") == "/Sig" and field.get("/V") is not None:
+            return True
+        pending.extend(field.get("/Kids", []))
+    return False
+
+
+def _fingerprint(pikepdf, obj):
+    """Content key of a resource: its dictionary plus, for streams, a hash of the raw data."""
+    digest = hashlib.sha256(obj.unparse(resolved=True))
+    if isinstance(obj, pikepdf.Stream):
+        digest.update(obj.read_raw_bytes())
+    return digest.hexdigest()
+
+
+def dedupe_resources(pdf):
+    """Points every page resource at one canonical copy of identical objects; returns how many were replaced."""
+    pikepdf = _import_pikepdf()
+    canonical = {}
+    replaced = 0
+    for page in pdf.pages:
+        resources = page.obj.get("/Resources")
+        if not isinstance(resources, pikepdf.Dictionary):
+            continue
+        for category in RESOURCE_CATEGORIES:
+            group = resources.get(category)
+            if not isinstance(group, pikepdf.Dictionary):
+                continue
+            for name in list(group.keys()):
+                obj = group[name]
+                if not obj.is_indirect:
+                    continue
+                first = canonical.setdefault((category, _fingerprint(pikepdf, obj)), obj)
+                if first.objgen != obj.objgen:
+                    group[name] = first
+                    replaced += 1
+    return replaced
+
+
+def normalize_pdf_file(input_path, output_path=None, dedupe=True):
+    """
+    Rewrites `input_path` (in place, or to `output_path`) with compressed
+    object and xref streams, a repaired cross-reference section and without
+    duplicate resources. Returns a report dict.
+    """
+    try:
+        precheck_pdf_file(input_path)
+    except PdfPrecheckError as e:
+        if e.code not in REPAIRABLE_PRECHECK_CODES:
+            raise
+
+    pikepdf = _import_pikepdf()
+    original_size = os.path.getsize(input_path)
+    target_path = output_path or input_path
+    temp_path = target_path + ".normalizing"
+
+    with pikepdf.open(input_path) as pdf:
+        if _has_signatures(pdf):
+            raise ValueError("El PDF ya está firmado: normalizarlo invalidaría las firmas existentes.")
+        repair_warnings = [str(w) for w in pdf.get_warnings()]
+        duplicates_removed = dedupe_resources(pdf) if dedupe else 0
+        for page in pdf.pages:
+            page.remove_unreferenced_resources()
+        pdf.save(
+            temp_path,
+            object_stream_mode=pikepdf.ObjectStreamMode.generate,
+            compress_streams=True,
+            recompress_flate=False,
+        )
+    os.replace(temp_path, target_path)
+
+    return {
+        "path": target_path,
+        "original_size": original_size,
+        "normalized_size": os.path.getsize(target_path),
+        "repaired": bool(repair_warnings),
+        "repair_warnings": repair_warnings,
+        "duplicates_removed": duplicates_removed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Normalize a PDF once at upload time, before the first signature")
+    parser.add_argument("--pdf_path", required=True, help="PDF to normalize")
+    parser.add_argument("--output_path", help="Write the normalized copy here instead of rewriting in place")
+    parser.add_argument("--keep_duplicates", action="store_true", help="Skip duplicate resource removal")
+    args = parser.parse_args()
+
+    try:
+        report = normalize_pdf_file(args.pdf_path, args.output_path, dedupe=not args.keep_duplicates)
+        print(json.dumps({"success": True, **report}))
+    except PdfPrecheckError as e:
+        print(json.dumps(e.to_dict()))
+        sys.exit(1)
+    except Exception as e:
+        print(json.dumps({"error": str(e)}))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
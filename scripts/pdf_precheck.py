@@ -0,0 +1,175 @@
+"""
+Fast structural pre-check for uploaded PDFs.
+
+Runs before pyhanko's full parser so truncated files, non-PDFs and hostile
+inputs are rejected cheaply: the header and the startxref/trailer are read
+from the first and last bytes only, and object/revision counts and size
+limits are enforced while streaming, without building any object graph.
+"""
+
+import os
+import re
+
+HEAD_BYTES = 1024
+TAIL_BYTES = 2048
+
+_HEADER_RE = re.compile(rb"%PDF-(\d)\.(\d)")
+_STARTXREF_RE = re.compile(rb"startxref\s+(\d{1,20})\s+%%EOF")
+_TRAILER_SIZE_RE = re.compile(rb"/Size\s+(\d{1,20})")
+_OBJ_RE = re.compile(rb"(?<![0-9])\d{1,10}[ \t\r\n\f\x00]+\d{1,5}[ \t\r\n\f\x00]+obj\b")
+_XREF_TARGET_RE = re.compile(rb"\s*(xref|\d{1,10}\s+\d{1,5}\s+obj)")
+_EOF_MARKER = b"%%EOF"
+_CARRY_BYTES = 40
+
+
+class PdfPrecheckError(ValueError):
+    """Structured rejection: `code` is stable for callers, `details` carries the measured values."""
+
+    def __init__(self, code, message, **details):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.details = details
+
+    def to_dict(self):
+        return {"error": self.message, "code": self.code, **self.details}
+
+
+class PrecheckLimits:
+    """Configurable limits; defaults can be overridden with environment variables."""
+
+    def __init__(self, max_bytes=None, max_objects=None, max_revisions=None):
+        self.max_bytes = max_bytes or int(os.getenv("PDF_MAX_BYTES", 256 * 1024 * 1024))
+        self.max_objects = max_objects or int(os.getenv("PDF_MAX_OBJECTS", 1000000))
+        self.max_revisions = max_revisions or int(os.getenv("PDF_MAX_REVISIONS", 200))
+
+
+def check_head_and_tail(head, tail, size, limits):
+    """
+    Validates the header and the trailer using only the first and last bytes.
+    Returns the startxref offset.
+    """
+    if size == 0:
+        raise PdfPrecheckError("empty", "El archivo está vacío.")
+    if size > limits.max_bytes:
+        raise PdfPrecheckError("too_large", "El PDF excede el tamaño máximo permitido.",
+                               size=size, max_bytes=limits.max_bytes)
+    if not _HEADER_RE.search(head[:HEAD_BYTES]):
+        raise PdfPrecheckError("not_pdf", "El archivo no tiene encabezado %PDF-.")
+    if _EOF_MARKER not in tail:
+        raise PdfPrecheckError("missing_eof", "El PDF está truncado: no termina con %%EOF.")
+
+    matches = list(_STARTXREF_RE.finditer(tail))
+    if not matches:
+        raise PdfPrecheckError("missing_startxref", "No se encontró startxref al final del PDF.")
+    startxref = int(matches[-1].group(1))
+    if startxref >= size:
+        raise PdfPrecheckError("bad_startxref", "startxref apunta fuera del archivo.",
+                               startxref=startxref, size=size)
+
+    declared = _TRAILER_SIZE_RE.findall(tail)
+    if declared and int(declared[-1]) > limits.max_objects:
+        raise PdfPrecheckError("too_many_objects", "El trailer declara demasiados objetos.",
+                               objects=int(declared[-1]), max_objects=limits.max_objects)
+    return startxref
+
+
+def check_xref_target(probe, startxref):
+    """`probe` are the bytes at the startxref offset: they must open an xref table or an xref stream object."""
+    if not _XREF_TARGET_RE.match(probe):
+        raise PdfPrecheckError("bad_startxref", "startxref no apunta a una tabla o stream de referencias cruzadas.",
+                               startxref=startxref)
+
+
+class PdfPrechecker:
+    """
+    Incremental checker fed chunk by chunk (e.g. while a download streams to
+    disk). Size, object and revision limits fail as soon as they are exceeded.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = limits or PrecheckLimits()
+        self.size = 0
+        self.objects = 0
+        self.revisions = 0
+        self._head = b""
+        self._tail = b""
+        self._carry = b""
+
+    def feed(self, chunk):
+        if not chunk:
+            return
+        self.size += len(chunk)
+        if self.size > self.limits.max_bytes:
+            raise PdfPrecheckError("too_large", "El PDF excede el tamaño máximo permitido.",
+                                   size=self.size, max_bytes=self.limits.max_bytes)
+        if len(self._head) < HEAD_BYTES:
+            self._head += chunk[:HEAD_BYTES - len(self._head)]
+            if len(self._head) >= 8 and not _HEADER_RE.search(self._head):
+                raise PdfPrecheckError("not_pdf", "El archivo no tiene encabezado %PDF-.")
+
+        # Matches that end inside the carried-over bytes were already counted in the previous chunk
+        data = self._carry + bytes(chunk)
+        carry_len = len(self._carry)
+        self.objects += sum(1 for m in _OBJ_RE.finditer(data) if m.end() > carry_len)
+        start = 0
+        while True:
+            index = data.find(_EOF_MARKER, start)
+            if index < 0:
+                break
+            if index + len(_EOF_MARKER) > carry_len:
+                self.revisions += 1
+            start = index + 1
+        self._carry = data[-_CARRY_BYTES:]
+        self._tail = (self._tail + bytes(chunk))[-TAIL_BYTES:]
+
+        if self.objects > self.limits.max_objects:
+            raise PdfPrecheckError("too_many_objects", "El PDF contiene demasiados objetos.",
+                                   objects=self.objects, max_objects=self.limits.max_objects)
+        if self.revisions > self.limits.max_revisions:
+            raise PdfPrecheckError("too_many_revisions", "El PDF contiene demasiadas revisiones.",
+                                   revisions=self.revisions, max_revisions=self.limits.max_revisions)
+
+    def finish(self, pdf_path=None):
+        """
+        Runs the header/trailer checks once all bytes were fed; returns a summary dict.
+        The startxref offset is only known at the end, so its target is checked by reading
+        64 bytes back from `pdf_path`, the file the fed bytes were written to.
+        """
+        startxref = check_head_and_tail(self._head, self._tail, self.size, self.limits)
+        if pdf_path is not None:
+            with open(pdf_path, "rb") as f:
+                f.seek(startxref)
+                check_xref_target(f.read(64), startxref)
+        return {"size": self.size, "objects": self.objects, "revisions": self.revisions, "startxref": startxref}
+
+
+def precheck_pdf_bytes(pdf_bytes, limits=None):
+    """Pre-checks an in-memory PDF. Garbage is rejected from the first/last bytes before any scanning."""
+    limits = limits or PrecheckLimits()
+    view = memoryview(pdf_bytes)
+    startxref = check_head_and_tail(bytes(view[:HEAD_BYTES]), bytes(view[-TAIL_BYTES:]), len(view), limits)
+    check_xref_target(bytes(view[startxref:startxref + 64]), startxref)
+    checker = PdfPrechecker(limits)
+    for offset in range(0, len(view), 1024 * 1024):
+        checker.feed(view[offset:offset + 1024 * 1024])
+    return checker.finish()
+
+
+def precheck_pdf_file(pdf_path, limits=None, chunk_size=1024 * 1024):
+    """Pre-checks a PDF on disk, reading the head and tail first and then streaming the body."""
+    limits = limits or PrecheckLimits()
+    size = os.path.getsize(pdf_path)
+    with open(pdf_path, "rb") as f:
+        head = f.read(HEAD_BYTES)
+        f.seek(max(0, size - TAIL_BYTES))
+        tail = f.read()
+        startxref = check_head_and_tail(head, tail, size, limits)
+        f.seek(startxref)
+        check_xref_target(f.read(64), startxref)
+
+        f.seek(0)
+        checker = PdfPrechecker(limits)
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            checker.feed(chunk)
+    return checker.finish()
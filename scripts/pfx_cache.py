@@ -0,0 +1,52 @@
+"""
+In-process cache of decrypted PKCS#12 (PFX) signers.
+
+Opening a PFX runs its password KDF, which is slow on purpose. Batch signing
+with the same PFX should pay it once per process, so loaded signers are kept
+keyed by (real path, mtime, size, SHA-256 of the passphrase): replacing the
+file or changing the passphrase loads it again, and the passphrase itself is
+never stored.
+"""
+
+import hashlib
+import os
+import threading
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def _cache_key(pfx_path, passphrase):
+    stat = os.stat(pfx_path)
+    passphrase_hash = hashlib.sha256(passphrase or b"").hexdigest()
+    return os.path.realpath(pfx_path), stat.st_mtime_ns, stat.st_size, passphrase_hash
+
+
+def load_pkcs12_signer(pfx_path, passphrase=None):
+    """
+    Returns a pyhanko SimpleSigner for `pfx_path`, decrypting it only on the first
+    call for this file version and passphrase. Raises ValueError if it cannot be loaded.
+    """
+    from pyhanko.sign import signers
+
+    if isinstance(passphrase, str):
+        passphrase = passphrase.encode()
+    key = _cache_key(pfx_path, passphrase)
+    with _lock:
+        signer = _cache.get(key)
+    if signer is not None:
+        return signer
+
+    signer = signers.SimpleSigner.load_pkcs12(pfx_file=pfx_path, passphrase=passphrase)
+    if signer is None:
+        raise ValueError(f"No se pudo cargar el PFX {pfx_path}. Verifica la contraseña.")
+    with _lock:
+        # Older versions of the same file are dropped
+        for stale in [k for k in _cache if k[0] == key[0] and k != key]:
+            del _cache[stale]
+        return _cache.setdefault(key, signer)
+
+
+def clear():
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,204 @@
+"""
+PKCS#11 (HSM / token) signing backend with pooled sessions.
+
+Opening a PKCS#11 session and logging in costs far more than the signature
+itself, so each slot keeps a small pool of logged-in sessions that are
+reused across signatures. Key and certificate lookups happen once per
+(session, key) and stay cached in the pyhanko PKCS11Signer bound to that
+session. Access to a slot is serialized through its pool (size 1 by
+default, the safe choice for most tokens) while different slots sign in
+parallel.
+
+A certificate row in user_certificates selects this backend with
+`signer_backend = 'pkcs11'` plus `pkcs11_token_label` and `pkcs11_key_label`
+(optionally `pkcs11_cert_label`). The module path and PINs come from the
+environment, never from the database:
+
+    PKCS11_MODULE                 e.g. /usr/lib/softhsm/libsofthsm2.so
+    PKCS11_PIN_<TOKEN_LABEL>      PIN of one token (label upper-cased, non-alphanumerics as _)
+    PKCS11_USER_PIN               fallback PIN for every token
+    PKCS11_SESSIONS_PER_SLOT      pool size per slot (default 1)
+
+Requires pyhanko's PKCS#11 extra (python-pkcs11).
+"""
+
+import os
+import queue
+import re
+import threading
+from contextlib import contextmanager
+
+DEFAULT_MODULE = "/usr/lib/softhsm/libsofthsm2.so"
+SIGNER_BACKEND_PKCS11 = "pkcs11"
+
+
+def _pin_for_token(token_label):
+    env_name = "PKCS11_PIN_" + re.sub(r"[^A-Z0-9]", "_", token_label.upper())
+    pin = os.getenv(env_name) or os.getenv("PKCS11_USER_PIN")
+    if not pin:
+        raise RuntimeError(f"No hay PIN configurado para el token '{token_label}' ({env_name} o PKCS11_USER_PIN).")
+    return pin
+
+
+class _PooledSession:
+    """A logged-in session plus the PKCS11Signer objects (with their cached key handles) built on it."""
+
+    def __init__(self, session):
+        self.session = session
+        self.signers = {}
+
+    def signer(self, key_label, cert_label):
+        from pyhanko.sign.pkcs11 import PKCS11Signer
+
+        key = (key_label, cert_label)
+        if key not in self.signers:
+            self.signers[key] = PKCS11Signer(self.session, key_label=key_label, cert_label=cert_label or key_label)
+        return self.signers[key]
+
+    def close(self):
+        try:
+            self.session.close()
+        except Exception:
+            pass
+
+
+class SlotSessionPool:
+    """Up to `size` logged-in sessions on one token; callers block while all of them are leased."""
+
+    def __init__(self, module_path, token_label, user_pin, size=1):
+        self.module_path = module_path
+        self.token_label = token_label
+        self.user_pin = user_pin
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.sessions_opened = 0
+
+    def _open(self):
+        from pyhanko.sign.pkcs11 import open_pkcs11_session
+
+        session = open_pkcs11_session(self.module_path, token_label=self.token_label, user_pin=self.user_pin)
+        with self._lock:
+            self.sessions_opened += 1
+        return _PooledSession(session)
+
+    @contextmanager
+    def lease(self):
+        """Yields a logged-in _PooledSession. Sessions that fail with a PKCS#11 error are discarded."""
+        from pkcs11.exceptions import PKCS11Error
+
+        self._slots.acquire()
+        try:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                pooled = self._open()
+            broken = False
+            try:
+                yield pooled
+            except PKCS11Error:
+                # Session handle invalid, token removed, logged out...: a fresh session replaces it
+                broken = True
+                raise
+            finally:
+                if broken:
+                    pooled.close()
+                else:
+                    self._idle.put(pooled)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def _pooled_signer_class():
+    from pyhanko.sign.signers import Signer
+
+    class PooledPKCS11Signer(Signer):
+        """
+        pyhanko Signer whose raw signatures run on a leased pool session.
+        The certificate is read from the token once, when the signer is built.
+        """
+
+        def __init__(self, pool, key_label, cert_label=None):
+            self.pool = pool
+            self.key_label = key_label
+            self.cert_label = cert_label
+            with pool.lease() as pooled:
+                token_signer = pooled.signer(key_label, cert_label)
+                signing_cert = token_signer.signing_cert
+                cert_registry = token_signer.cert_registry
+            super().__init__(signing_cert=signing_cert, cert_registry=cert_registry)
+
+        async def async_sign_raw(self, data, digest_algorithm, dry_run=False):
+            with self.pool.lease() as pooled:
+                return await pooled.signer(self.key_label, self.cert_label).async_sign_raw(
+                    data, digest_algorithm, dry_run=dry_run
+                )
+
+    return PooledPKCS11Signer
+
+
+class Pkcs11SignerRegistry:
+    """Process-wide pools (one per token) and signers (one per key), created on first use."""
+
+    def __init__(self, module_path=None, sessions_per_slot=None):
+        self.module_path = module_path or os.getenv("PKCS11_MODULE", DEFAULT_MODULE)
+        self.sessions_per_slot = sessions_per_slot or int(os.getenv("PKCS11_SESSIONS_PER_SLOT", 1))
+        self._pools = {}
+        self._signers = {}
+        self._lock = threading.Lock()
+
+    def pool(self, token_label):
+        with self._lock:
+            if token_label not in self._pools:
+                self._pools[token_label] = SlotSessionPool(
+                    self.module_path, token_label, _pin_for_token(token_label), self.sessions_per_slot
+                )
+            return self._pools[token_label]
+
+    def signer(self, token_label, key_label, cert_label=None):
+        key = (token_label, key_label, cert_label)
+        with self._lock:
+            cached = self._signers.get(key)
+        if cached is not None:
+            return cached
+        signer = _pooled_signer_class()(self.pool(token_label), key_label, cert_label)
+        with self._lock:
+            return self._signers.setdefault(key, signer)
+
+    def signer_for_certificate(self, certificate_row):
+        """Signer for a user_certificates row with signer_backend = 'pkcs11'."""
+        token_label = certificate_row.get("pkcs11_token_label")
+        key_label = certificate_row.get("pkcs11_key_label")
+        if not token_label or not key_label:
+            raise ValueError("El certificado PKCS#11 requiere pkcs11_token_label y pkcs11_key_label.")
+        return self.signer(token_label, key_label, certificate_row.get("pkcs11_cert_label"))
+
+    def close(self):
+        with self._lock:
+            pools, self._pools, self._signers = list(self._pools.values()), {}, {}
+        for pool in pools:
+            pool.close()
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = Pkcs11SignerRegistry()
+        return _registry
+
+
+def uses_pkcs11(certificate_row):
+    return (certificate_row or {}).get("signer_backend") == SIGNER_BACKEND_PKCS11
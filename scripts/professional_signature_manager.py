@@ -9,24 +9,11 @@ import json
 import sys
 import base64
 from datetime import datetime, timedelta
-from pathlib import Path
-import tempfile
-import os
 
-try:
-    from cryptography import x509
-    from cryptography.x509.oid import NameOID, ExtensionOID
-    from cryptography.hazmat.primitives import hashes, serialization
-    from cryptography.hazmat.primitives.asymmetric import rsa
-    from pyhanko import stamp
-    from pyhanko.pdf_utils.reader import PdfFileReader
-    from pyhanko.pdf_utils.writer import PdfFileWriter
-    from pyhanko.sign import signers, fields
-    from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter
-    import io
-except ImportError as e:
-    print(json.dumps({"error": f"Missing required Python packages: {e}"}))
-    sys.exit(1)
+# Heavy dependencies (cryptography, pyhanko) and the audit log (sqlite3, its
+# writer thread) are imported inside each action so that a generate_certificate
+# invocation never pays for the PDF stack, and the key is built before the log loads.
+
 
 def generate_certificate_and_key(
     common_name: str,
@@ -34,17 +21,27 @@ def generate_certificate_and_key(
     country_name: str = "MX",
     organization_name: str = "Casa Monarca",
     organizational_unit_name: str = "General",
-    days_valid: int = 365
+    days_valid: int = 365,
+    key_type: str = "rsa2048"
 ):
     """
     Generate a self-signed certificate and private key with specified parameters
     """
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa, ec
+
     try:
         # Generate private key
-        private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-        )
+        if key_type == "rsa2048":
+            private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        elif key_type == "rsa3072":
+            private_key = rsa.generate_private_key(public_exponent=65537, key_size=3072)
+        elif key_type == "ec-p256":
+            private_key = ec.generate_private_key(ec.SECP256R1())
+        else:
+            raise ValueError(f"Unsupported key type: {key_type}")
 
         # Create certificate subject and issuer
         subject = issuer = x509.Name([
@@ -119,6 +116,7 @@ def generate_certificate_and_key(
             "valid_from": valid_from.isoformat(),
             "valid_to": valid_to.isoformat(),
             "issuer_common_name": common_name,  # Self-signed
+            "key_type": key_type,
             "fingerprint_sha256": certificate.fingerprint(hashes.SHA256()).hex()
         }
 
@@ -138,6 +136,7 @@ def main():
     parser.add_argument("--org_name", default="Casa Monarca", help="Organization name")
     parser.add_argument("--org_unit_name", default="General", help="Organizational unit name")
     parser.add_argument("--days_valid", type=int, default=365, help="Certificate validity in days")
+    parser.add_argument("--key_type", default="rsa2048", choices=["rsa2048", "rsa3072", "ec-p256"], help="Key algorithm and size")
     
     # PDF signing arguments
     parser.add_argument("--pdf_path", help="Path to PDF file to sign")
@@ -159,9 +158,14 @@ def main():
                 country_name=args.country_name,
                 organization_name=args.org_name,
                 organizational_unit_name=args.org_unit_name,
-                days_valid=args.days_valid
+                days_valid=args.days_valid,
+                key_type=args.key_type
             )
             
+            from audit_log import audit
+            audit("certificate_issue", user_name=args.user_name, email=args.email,
+                  serial_number=str(cert_info["serial_number"]), fingerprint_sha256=cert_info["fingerprint_sha256"])
+            
             result = {
                 "success": True,
                 "private_key_pem_base64": base64.b64encode(private_key_pem).decode('utf-8'),
@@ -175,6 +179,9 @@ def main():
             print(json.dumps({"error": f"Action '{args.action}' not implemented yet"}))
             sys.exit(1)
             
+    except ImportError as e:
+        print(json.dumps({"error": f"Missing required Python packages: {e}"}))
+        sys.exit(1)
     except Exception as e:
         print(json.dumps({"error": str(e)}))
         sys.exit(1)
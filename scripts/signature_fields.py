@@ -0,0 +1,83 @@
+"""
+Pre-allocated signature fields for multi-signer documents.
+
+When a document's signature limit is set (requires_signatures / MaxSigners),
+all N empty signature fields are created once, with their placement. Later
+signers only fill an existing field, so their incremental update no longer
+rewrites the AcroForm and the page annotations.
+"""
+
+SIGNATURE_FIELD_PREFIX = "Signature"
+
+# Placement grid at the bottom of the last page (PDF points, US Letter / A4 safe)
+FIELD_WIDTH = 180
+FIELD_HEIGHT = 50
+FIELD_MARGIN = 36
+FIELD_GAP = 12
+FIELDS_PER_ROW = 3
+
+
+def field_name(index):
+    """Name of the 1-based `index`-th signature field."""
+    return f"{SIGNATURE_FIELD_PREFIX}{index}"
+
+
+def field_box(index):
+    """(x1, y1, x2, y2) of the 1-based `index`-th field, filled left to right, bottom to top."""
+    row, column = divmod(index - 1, FIELDS_PER_ROW)
+    x1 = FIELD_MARGIN + column * (FIELD_WIDTH + FIELD_GAP)
+    y1 = FIELD_MARGIN + row * (FIELD_HEIGHT + FIELD_GAP)
+    return (x1, y1, x1 + FIELD_WIDTH, y1 + FIELD_HEIGHT)
+
+
+def prepare_signature_fields(writer, max_signers, on_page=-1):
+    """
+    Adds empty fields Signature1..SignatureN to an IncrementalPdfFileWriter,
+    skipping names that already exist. Returns the names that were created.
+    """
+    from pyhanko.sign import fields
+
+    existing = {name for name, _, _ in fields.enumerate_sig_fields(writer.prev)}
+    created = []
+    for index in range(1, max_signers + 1):
+        name = field_name(index)
+        if name in existing:
+            continue
+        fields.append_signature_field(
+            writer,
+            fields.SigFieldSpec(sig_field_name=name, on_page=on_page, box=field_box(index)),
+        )
+        created.append(name)
+    return created
+
+
+def prepare_signature_fields_file(pdf_path, max_signers, on_page=-1):
+    """Runs prepare_signature_fields on a PDF on disk, appending a single incremental update."""
+    from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter
+
+    with open(pdf_path, "r+b") as pdf_file:
+        writer = IncrementalPdfFileWriter(pdf_file)
+        created = prepare_signature_fields(writer, max_signers, on_page)
+        if created:
+            writer.write_in_place()
+    return created
+
+
+def choose_signature_field(reader, fallback_name=None):
+    """
+    Returns (field_name, existing_fields_only) for the next signature.
+    The first empty pre-allocated field is preferred; documents prepared
+    before pre-allocation existed fall back to creating `fallback_name`
+    (or the next SignatureN).
+    """
+    from pyhanko.sign import fields
+
+    empty, filled = [], 0
+    for name, value, _ in fields.enumerate_sig_fields(reader):
+        if value is None:
+            empty.append(name)
+        else:
+            filled += 1
+    if empty:
+        return empty[0], True
+    return fallback_name or field_name(filled + 1), False
@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+"""
+Signature summary index.
+
+The signed-documents and document-detail views only need each signature's
+field, signer, time, reason, location and status. Re-parsing and
+re-validating every PDF to list them does not scale, so the summary is
+extracted once — when the document is signed, or by the backfill job for
+documents signed earlier — into a compact table indexed by document, signer
+and signing time:
+
+- SqliteSignatureIndex: local development and the CLI scripts
+  (SIGNATURE_INDEX_PATH, default index/signature_index.sqlite3).
+- SupabaseSignatureIndex: production, table `signature_index`
+  (see create-signature-index-table.sql).
+
+Both expose the same upsert/query methods, so listing the signatures of
+1,000 documents is a single indexed query. Re-indexing a document only
+validates signatures that were not indexed yet; known rows keep the status
+recorded when they were first seen.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from datetime import datetime, timezone
+
+DEFAULT_INDEX_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "index", "signature_index.sqlite3"
+)
+SUPABASE_TABLE = "signature_index"
+SUPABASE_DOCUMENTS_FUNCTION = "signature_index_for_documents"
+
+COLUMNS = (
+    "document_id", "field_name", "signer_cn", "signer_email", "signing_time", "reason", "location",
+    "cert_sha256", "byte_range", "intact", "valid", "trusted", "content_hash", "indexed_at",
+)
+STATUS_COLUMNS = ("intact", "valid", "trusted")
+
+
+def _postgrest_quote(value):
+    """Value as a double-quoted PostgREST filter literal (backslash escapes for \\ and ")."""
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _utc_iso(value):
+    """Signing times are stored as UTC ISO-8601 strings, so ranges compare lexicographically."""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).isoformat(timespec="seconds")
+
+
+def _text(pdf_value):
+    return str(pdf_value) if pdf_value is not None else None
+
+
+class _QuietIndexing(logging.Filter):
+    """
+    Drops pyhanko's validation logs (e.g. a traceback per self-signed certificate) on
+    threads that are indexing: the outcome is already recorded in the status columns.
+    Other threads, such as an explicit verification, keep logging as before.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.active = threading.local()
+
+    def filter(self, record):
+        return not getattr(self.active, "on", False)
+
+
+_quiet_indexing = _QuietIndexing()
+# Logger filters do not apply to records propagated from child loggers: attach it where they are emitted
+logging.getLogger("pyhanko.sign.validation.generic_cms").addFilter(_quiet_indexing)
+
+
+def extract_signatures(pdf_reader, known=None, validation_context=None):
+    """
+    Summary rows (without document_id) for every embedded signature of `pdf_reader`.
+    Signatures in `known` ({field_name: row} whose byte range is unchanged) reuse their
+    recorded status instead of being validated again.
+    """
+    from pyhanko.sign.validation import validate_pdf_signature
+
+    known = known or {}
+    rows = []
+    for sig in pdf_reader.embedded_signatures:
+        field_name = str(sig.field_name)
+        sig_object = sig.sig_object
+        byte_range = [int(value) for value in sig_object.get("/ByteRange", [])]
+        cert = sig.signer_cert
+        subject = cert.subject.native
+        row = {
+            "field_name": field_name,
+            "signer_cn": subject.get("common_name"),
+            "signer_email": (subject.get("email_address") or "").lower() or None,
+            "signing_time": _utc_iso(sig.self_reported_timestamp),
+            "reason": _text(sig_object.get("/Reason")),
+            "location": _text(sig_object.get("/Location")),
+            "cert_sha256": hashlib.sha256(cert.dump()).hexdigest(),
+            "byte_range": byte_range,
+        }
+        previous = known.get(field_name)
+        if previous is not None and list(previous["byte_range"]) == byte_range:
+            row.update({column: previous[column] for column in STATUS_COLUMNS})
+        else:
+            _quiet_indexing.active.on = True
+            try:
+                status = validate_pdf_signature(sig, signer_validation_context=validation_context)
+                row.update(intact=bool(status.intact), valid=bool(status.valid), trusted=bool(status.trusted))
+                row["signing_time"] = _utc_iso(status.signer_reported_dt) or row["signing_time"]
+            except Exception:
+                row.update(intact=False, valid=False, trusted=False)
+            finally:
+                _quiet_indexing.active.on = False
+        rows.append(row)
+    return rows
+
+
+def _offline_validation_context():
+    from pyhanko_certvalidator import ValidationContext
+    return ValidationContext(allow_fetching=False)
+
+
+def index_pdf_file(index, document_id, pdf_path, content_hash=None):
+    """Indexes (or re-indexes) the signatures of a PDF on disk; returns the rows written."""
+    from pdf_io import mapped_pdf
+    from pyhanko.pdf_utils.reader import PdfFileReader
+
+    known = {row["field_name"]: row for row in index.for_document(document_id)}
+    with mapped_pdf(pdf_path) as stream:
+        rows = extract_signatures(PdfFileReader(stream), known, _offline_validation_context())
+    return index.replace_document(document_id, rows, content_hash)
+
+
+def index_pdf_bytes(index, document_id, pdf_bytes, content_hash=None):
+    """Same as index_pdf_file for a document held in memory."""
+    import io
+    from pyhanko.pdf_utils.reader import PdfFileReader
+
+    known = {row["field_name"]: row for row in index.for_document(document_id)}
+    rows = extract_signatures(PdfFileReader(io.BytesIO(pdf_bytes)), known, _offline_validation_context())
+    return index.replace_document(document_id, rows, content_hash)
+
+
+def _stamp(document_id, rows, content_hash):
+    indexed_at = datetime.now(timezone.utc).isoformat()
+    return [
+        {**row, "document_id": str(document_id), "content_hash": content_hash, "indexed_at": indexed_at}
+        for row in rows
+    ]
+
+
+class SqliteSignatureIndex:
+    """Signature index in a local SQLite file; safe to share between threads and processes."""
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as db:
+            db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS signature_index (
+                    document_id TEXT NOT NULL,
+                    field_name TEXT NOT NULL,
+                    signer_cn TEXT,
+                    signer_email TEXT,
+                    signing_time TEXT,
+                    reason TEXT,
+                    location TEXT,
+                    cert_sha256 TEXT,
+                    byte_range TEXT,
+                    intact INTEGER,
+                    valid INTEGER,
+                    trusted INTEGER,
+                    content_hash TEXT,
+                    indexed_at TEXT NOT NULL,
+                    PRIMARY KEY (document_id, field_name)
+                );
+                CREATE INDEX IF NOT EXISTS idx_signature_index_signer_cn ON signature_index (signer_cn, signing_time);
+                CREATE INDEX IF NOT EXISTS idx_signature_index_signer_email ON signature_index (signer_email, signing_time);
+                CREATE INDEX IF NOT EXISTS idx_signature_index_signing_time ON signature_index (signing_time);
+                """
+            )
+
+    def _connect(self):
+        # One connection per thread (and per process after a fork)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @staticmethod
+    def _row(record):
+        row = dict(record)
+        row["byte_range"] = json.loads(row["byte_range"]) if row["byte_range"] else []
+        for column in STATUS_COLUMNS:
+            row[column] = bool(row[column])
+        return row
+
+    def replace_document(self, document_id, rows, content_hash=None):
+        """Makes `rows` the document's full set of signatures (fields no longer present are removed)."""
+        rows = _stamp(document_id, rows, content_hash)
+        values = [
+            tuple(json.dumps(row[c]) if c == "byte_range" else row[c] for c in COLUMNS) for row in rows
+        ]
+        with self._connect() as db:
+            db.execute("DELETE FROM signature_index WHERE document_id = ?", (str(document_id),))
+            db.executemany(
+                f"INSERT INTO signature_index ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                values,
+            )
+        return rows
+
+    def query(self, document_ids=None, signer=None, since=None, until=None, limit=None):
+        """
+        Signatures filtered by any combination of documents, signer (CN or email)
+        and signing-time range [since, until], ordered by document and signing time.
+        """
+        clauses, params = [], []
+        if document_ids is not None:
+            # A single JSON parameter keeps long id lists in one query (no bound-variable limit)
+            clauses.append("document_id IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps([str(document_id) for document_id in document_ids]))
+        if signer:
+            clauses.append("(signer_cn = ? OR signer_email = ?)")
+            params.extend([signer, signer.lower()])
+        if since:
+            clauses.append("signing_time >= ?")
+            params.append(_utc_iso(since) if isinstance(since, datetime) else since)
+        if until:
+            clauses.append("signing_time <= ?")
+            params.append(_utc_iso(until) if isinstance(until, datetime) else until)
+        sql = "SELECT * FROM signature_index"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY document_id, signing_time, field_name"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        return [self._row(record) for record in self._connect().execute(sql, params)]
+
+    def for_document(self, document_id):
+        return self.query(document_ids=[document_id])
+
+    def for_documents(self, document_ids):
+        """{document_id: [rows]} for every requested document (empty list if not indexed)."""
+        grouped = {str(document_id): [] for document_id in document_ids}
+        for row in self.query(document_ids=document_ids):
+            grouped[row["document_id"]].append(row)
+        return grouped
+
+    def by_signer(self, signer, since=None, until=None, limit=None):
+        return self.query(signer=signer, since=since, until=until, limit=limit)
+
+
+class SupabaseSignatureIndex:
+    """Same interface over the Supabase table `signature_index` (create-signature-index-table.sql)."""
+
+    def __init__(self, client):
+        self.supabase = client
+
+    def replace_document(self, document_id, rows, content_hash=None):
+        rows = _stamp(document_id, rows, content_hash)
+        fields = [row["field_name"] for row in rows]
+        table = self.supabase.table(SUPABASE_TABLE)
+        stale = table.delete().eq("document_id", str(document_id))
+        if fields:
+            stale = stale.not_.in_("field_name", fields)
+        stale.execute()
+        if rows:
+            table.upsert(rows, on_conflict="document_id,field_name").execute()
+        return rows
+
+    def query(self, document_ids=None, signer=None, since=None, until=None, limit=None):
+        if document_ids is not None:
+            # Long id lists go in the RPC body instead of the URL
+            request = self.supabase.rpc(
+                SUPABASE_DOCUMENTS_FUNCTION, {"document_ids": [str(document_id) for document_id in document_ids]}
+            )
+        else:
+            request = self.supabase.table(SUPABASE_TABLE).select("*")
+        if signer:
+            # Quoted: a CN can contain the filter syntax's own delimiters (, . ( ) ")
+            request = request.or_(
+                f"signer_cn.eq.{_postgrest_quote(signer)},signer_email.eq.{_postgrest_quote(signer.lower())}"
+            )
+        if since:
+            request = request.gte("signing_time", _utc_iso(since) if isinstance(since, datetime) else since)
+        if until:
+            request = request.lte("signing_time", _utc_iso(until) if isinstance(until, datetime) else until)
+        request = request.order("document_id").order("signing_time").order("field_name")
+        if limit:
+            request = request.limit(int(limit))
+        return request.execute().data or []
+
+    def for_document(self, document_id):
+        return self.query(document_ids=[document_id])
+
+    def for_documents(self, document_ids):
+        grouped = {str(document_id): [] for document_id in document_ids}
+        for row in self.query(document_ids=document_ids):
+            grouped[row["document_id"]].append(row)
+        return grouped
+
+    def by_signer(self, signer, since=None, until=None, limit=None):
+        return self.query(signer=signer, since=since, until=until, limit=limit)
+
+
+_default_index = None
+_default_lock = threading.Lock()
+
+
+def get_signature_index():
+    """Process-wide local index at SIGNATURE_INDEX_PATH."""
+    global _default_index
+    with _default_lock:
+        if _default_index is None:
+            _default_index = SqliteSignatureIndex(os.getenv("SIGNATURE_INDEX_PATH", DEFAULT_INDEX_PATH))
+        return _default_index
+
+
+def index_signed_file(document_id, pdf_path, content_hash=None):
+    """
+    Sign-time hook for the local index. Indexing is derived data: a failure is
+    reported on stderr and never fails the signature (the backfill job repairs it).
+    """
+    try:
+        return index_pdf_file(get_signature_index(), document_id, pdf_path, content_hash)
+    except Exception as e:
+        print(f"⚠️ No se pudo indexar las firmas de {document_id}: {e}", file=sys.stderr)
+        return None
+
+
+def index_signed_bytes(document_id, pdf_bytes, content_hash=None):
+    """Same as index_signed_file for a signed document held in memory."""
+    try:
+        return index_pdf_bytes(get_signature_index(), document_id, pdf_bytes, content_hash)
+    except Exception as e:
+        print(f"⚠️ No se pudo indexar las firmas de {document_id}: {e}", file=sys.stderr)
+        return None
+
+
+# --- Backfill ---
+def backfill_paths(index, paths, document_id_for=None):
+    """Indexes local PDFs (document id = path unless `document_id_for` maps it). Returns counts."""
+    documents = signatures = failed = 0
+    for path in paths:
+        try:
+            rows = index_pdf_file(index, document_id_for(path) if document_id_for else path, path)
+            documents += 1
+            signatures += len(rows)
+        except Exception as e:
+            failed += 1
+            print(f"⚠️ {path}: {e}", file=sys.stderr)
+    return {"documents": documents, "signatures": signatures, "failed_documents": failed}
+
+
+def backfill_supabase(client, bucket="documents", page_size=200):
+    """Indexes every row of `documents`, downloading each file from Storage once."""
+    index = SupabaseSignatureIndex(client)
+    documents = signatures = failed = 0
+    offset = 0
+    while True:
+        page = (
+            client.table("documents").select("id, file_path").order("id")
+            .range(offset, offset + page_size - 1).execute().data or []
+        )
+        for document in page:
+            try:
+                pdf_bytes = client.storage.from_(bucket).download(document["file_path"])
+                rows = index_pdf_bytes(index, document["id"], pdf_bytes, hashlib.sha256(pdf_bytes).hexdigest())
+                documents += 1
+                signatures += len(rows)
+            except Exception as e:
+                failed += 1
+                print(f"⚠️ {document['id']}: {e}", file=sys.stderr)
+        if len(page) < page_size:
+            break
+        offset += page_size
+    return {"documents": documents, "signatures": signatures, "failed_documents": failed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query the signature summary index")
+    parser.add_argument("--action", required=True, choices=["backfill", "backfill_supabase", "query"])
+    parser.add_argument("--index_path", default=os.getenv("SIGNATURE_INDEX_PATH", DEFAULT_INDEX_PATH))
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--directory", help="Backfill every PDF under this directory (backfill)")
+    source.add_argument("--manifest", help="Backfill the PDF paths listed in this file (backfill)")
+    parser.add_argument("--document_id", action="append", help="Document to list; repeatable (query)")
+    parser.add_argument("--signer", help="Signer CN or email (query)")
+    parser.add_argument("--since", help="ISO-8601 lower bound of signing time (query)")
+    parser.add_argument("--until", help="ISO-8601 upper bound of signing time (query)")
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--bucket", default="documents", help="Storage bucket of the documents (backfill_supabase)")
+    parser.add_argument("--supabase_url", default=os.getenv("SUPABASE_URL"))
+    parser.add_argument("--supabase_key", default=os.getenv("SUPABASE_SERVICE_ROLE_KEY"))
+    args = parser.parse_args()
+
+    if args.action == "backfill_supabase":
+        if not args.supabase_url or not args.supabase_key:
+            print(json.dumps({"error": "supabase_url y supabase_key son obligatorios"}))
+            sys.exit(1)
+        import supabase
+        report = backfill_supabase(supabase.create_client(args.supabase_url, args.supabase_key), args.bucket)
+        print(json.dumps(report))
+        sys.exit(1 if report["failed_documents"] else 0)
+
+    index = SqliteSignatureIndex(args.index_path)
+    if args.action == "backfill":
+        from bulk_verify import iter_directory, iter_manifest
+        if not args.directory and not args.manifest:
+            print(json.dumps({"error": "--directory o --manifest es obligatorio para backfill"}))
+            sys.exit(1)
+        paths = iter_directory(args.directory) if args.directory else iter_manifest(args.manifest)
+        report = backfill_paths(index, paths)
+        print(json.dumps(report))
+        sys.exit(1 if report["failed_documents"] else 0)
+
+    rows = index.query(args.document_id, args.signer, args.since, args.until, args.limit)
+    print(json.dumps({"signatures": rows}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+Soak test for the signing paths: leak detection over long runs.
+
+Drives sign + verify in a loop for a fixed duration (hours, in CI nightly)
+inside this process, so tracemalloc, RSS, open file descriptors, threads and
+the private temp directory all describe the code under test:
+
+- manager: DigitalSignatureManager (digital_signature_backend.py) over
+  FakeSupabaseClient, with injected latency and errors.
+- service: the FastAPI signing service (python_signing_service/main.py)
+  served by uvicorn on a local port and driven over HTTP, with the source
+  documents on a local HTTP server.
+
+After a warm-up (caches, lazy imports, pools), the growth of traced memory
+and RSS per request is estimated from the samples; a leak has to show in
+both halves of the run, so one-time growth does not fail it.
+The run fails when it exceeds the budget, when the file-descriptor count
+grows (unclosed clients, sockets, mmaps) or when temp entries are left
+behind (mkdtemp directories that are never removed). The report lists the
+allocation sites that grew the most since the warm-up.
+
+Usage:
+    python soak_test.py --target manager --duration 600
+    python soak_test.py --target service --duration 14400 --sample_every 30
+"""
+
+import argparse
+import contextlib
+import gc
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.join(os.path.dirname(SCRIPTS_DIR), "python_signing_service")
+
+
+def _rss_bytes():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def _slope(points, max_points=200):
+    """Theil-Sen slope of [(requests, value)]: median of the pairwise slopes, robust to noise."""
+    if len(points) > max_points:
+        stride = len(points) / max_points
+        points = [points[int(i * stride)] for i in range(max_points)] + [points[-1]]
+    slopes = sorted(
+        (y2 - y1) / (x2 - x1)
+        for i, (x1, y1) in enumerate(points)
+        for x2, y2 in points[i + 1:]
+        if x2 != x1
+    )
+    if not slopes:
+        return 0.0
+    middle = len(slopes) // 2
+    return slopes[middle] if len(slopes) % 2 else (slopes[middle - 1] + slopes[middle]) / 2
+
+
+def _growth_per_request(points):
+    """
+    Sustained growth per request: the smaller of the slopes of both halves of the run.
+    A leak grows in both; a one-time step (a dict or buffer resized once) only in one.
+    """
+    if len(points) < 4:
+        return _slope(points)
+    half = len(points) // 2
+    return min(_slope(points[:half + 1]), _slope(points[half:]))
+
+
+class Sampler:
+    def __init__(self, tmp_dir):
+        self.tmp_dir = tmp_dir
+        self.samples = []
+        self.started = time.monotonic()
+
+    def sample(self, requests, errors):
+        gc.collect()  # Only what survives a full collection counts as growth
+        traced, _ = tracemalloc.get_traced_memory()
+        entry = {
+            "elapsed_s": round(time.monotonic() - self.started, 1),
+            "requests": requests,
+            "errors": errors,
+            "traced_bytes": traced,
+            "rss_bytes": _rss_bytes(),
+            "fds": _open_fds(),
+            "threads": threading.active_count(),
+            "tmp_entries": len(os.listdir(self.tmp_dir)),
+        }
+        self.samples.append(entry)
+        print(json.dumps(entry), file=sys.stderr, flush=True)
+        return entry
+
+
+# --- Targets ---
+
+class ManagerTarget:
+    """DigitalSignatureManager against the in-memory Supabase stand-in."""
+
+    def __init__(self, args, workdir):
+        from benchmark_signatures import make_synthetic_pdf
+        from digital_signature_backend import DigitalSignatureManager
+        from fake_supabase import FakeSupabaseClient
+
+        self.client = FakeSupabaseClient(latency=(args.latency_min, args.latency_max), seed=args.seed)
+        self.manager = DigitalSignatureManager(None, None, client=self.client)
+        self.pdf = make_synthetic_pdf(args.pages)
+        self.documents = args.documents
+        self.user_id = "soak-user"
+        key_pem, cert_pem, serial = self.manager.generate_certificate_and_key("Soak Test", "soak@casamonarca.org", self.user_id)
+        self.certificate_id = self.manager.save_certificate_to_supabase(self.user_id, "Soak Test", key_pem, cert_pem, serial)
+        # Errors are injected only once the certificate exists
+        self.client.error_rate = args.error_rate
+
+    def step(self, i):
+        signed = self.manager.sign_pdf_with_certificate(
+            self.pdf, self.user_id, self.certificate_id, "Soak", document_id=f"soak-{i % self.documents}"
+        )
+        result = self.manager.verify_pdf_signatures(signed)
+        if result["total_signatures"] != 1:
+            raise AssertionError(f"expected 1 signature, got {result['total_signatures']}")
+
+    def close(self):
+        pass
+
+    def report(self):
+        return {"supabase": self.client.stats()}
+
+
+class ServiceTarget:
+    """The FastAPI service in this process, driven over HTTP like the web app does."""
+
+    def __init__(self, args, workdir):
+        import httpx
+        import uvicorn
+
+        sys.path.insert(0, SERVICE_DIR)
+        from benchmark_signatures import make_synthetic_pdf
+        from scale_test import PFX_PASSWORD, _free_port, _serve_documents, _write_pfx
+
+        pfx_path = os.path.join(workdir, "soak.pfx")
+        _write_pfx(pfx_path)
+        port = _free_port()
+        self.url = f"http://127.0.0.1:{port}"
+        os.environ.update({
+            "PFX_FILE_PATH": pfx_path,
+            "PFX_PASSPHRASE": PFX_PASSWORD,
+            "CONTENT_STORE_DIR": os.path.join(workdir, "content"),
+            "SIGNED_DOCS_BASE_URL": self.url,
+        })
+        documents_dir = os.path.join(workdir, "documents")
+        os.makedirs(documents_dir)
+        with open(os.path.join(documents_dir, "documento.pdf"), "wb") as f:
+            f.write(make_synthetic_pdf(args.pages))
+        self.documents_server = _serve_documents(documents_dir)
+        self.documents_url = f"http://127.0.0.1:{self.documents_server.server_address[1]}/documento.pdf"
+
+        import main
+        self.server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        self.http = httpx.Client(base_url=self.url, timeout=120)
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                if self.http.get("/ready").status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError("the signing service did not become ready")
+            time.sleep(0.1)
+        self.documents = args.documents
+
+    def step(self, i):
+        signed = self.http.post("/sign_document", json={
+            "document_url": self.documents_url,
+            "original_file_name": "documento.pdf",
+            "document_id": f"soak-{i % self.documents}",
+            "user_id": "soak-user",
+            "lane": "bulk",
+        })
+        if signed.status_code != 200:
+            raise RuntimeError(f"sign: HTTP {signed.status_code} {signed.text[:200]}")
+        verified = self.http.post("/verify_document", json={
+            "document_url": signed.json()["signed_document_url"],
+            "user_id": "soak-user",
+            "lane": "bulk",
+        })
+        if verified.status_code != 200 or len(verified.json()["signatures"]) != 1:
+            raise RuntimeError(f"verify: HTTP {verified.status_code} {verified.text[:200]}")
+
+    def close(self):
+        self.http.close()
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+        self.documents_server.shutdown()
+        self.documents_server.server_close()
+
+    def report(self):
+        return {}
+
+
+TARGETS = {"manager": ManagerTarget, "service": ServiceTarget}
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="signing-soak-")
+    tmp_dir = os.path.join(workdir, "tmp")
+    os.makedirs(tmp_dir)
+    # Everything the code under test creates with tempfile lands here and is counted
+    tempfile.tempdir = tmp_dir
+    os.environ.update({
+        "TMPDIR": tmp_dir,
+        "AUDIT_LOG_PATH": os.path.join(workdir, "audit.jsonl"),
+        "SIGNATURE_INDEX_PATH": os.path.join(workdir, "signature_index.sqlite3"),
+        "ADMISSION_BULK_USER_RATE": "1000000",
+        "ADMISSION_BULK_USER_BURST": "1000000",
+        # The same bytes are signed again and again: without this they would be replayed, not signed
+        "IDEMPOTENCY_ENABLED": "0",
+    })
+
+    # Self-signed test certificates make pyhanko log a validation traceback per signature
+    logging.getLogger("pyhanko").setLevel(logging.CRITICAL)
+    tracemalloc.start(args.traceback_frames)
+    sampler = Sampler(tmp_dir)
+    requests = errors = 0
+    last_errors = []
+    # The code under test logs every step to stdout; progress samples go to stderr
+    with contextlib.redirect_stdout(open(os.devnull, "w")) as devnull:
+        target = TARGETS[args.target](args, workdir)
+        try:
+            for _ in range(args.warmup_requests):
+                try:
+                    target.step(requests)
+                except Exception:
+                    errors += 1
+                requests += 1
+            baseline = sampler.sample(requests, errors)
+            baseline_snapshot = tracemalloc.take_snapshot()
+
+            deadline = time.monotonic() + args.duration
+            next_sample = time.monotonic() + args.sample_every
+            while time.monotonic() < deadline and (not args.requests or requests < args.requests):
+                try:
+                    target.step(requests)
+                except Exception as e:
+                    errors += 1
+                    last_errors = (last_errors + [str(e)[:200]])[-5:]
+                requests += 1
+                if time.monotonic() >= next_sample:
+                    sampler.sample(requests, errors)
+                    next_sample = time.monotonic() + args.sample_every
+            # Before shutting the target down: its threads, sockets and buffers are part of the steady state
+            final = sampler.sample(requests, errors)
+            final_snapshot = tracemalloc.take_snapshot()
+        finally:
+            target.close()
+        devnull.close()
+    tracemalloc.stop()
+
+    measured = [s for s in sampler.samples if s["requests"] >= baseline["requests"]]
+    measured_requests = final["requests"] - baseline["requests"]
+    traced_per_request = _growth_per_request([(s["requests"], s["traced_bytes"]) for s in measured])
+    rss_per_request = _growth_per_request([(s["requests"], s["rss_bytes"]) for s in measured])
+    growth = {
+        "traced_bytes_per_request": round(traced_per_request, 1),
+        "rss_bytes_per_request": round(rss_per_request, 1),
+        "fds": final["fds"] - baseline["fds"],
+        "threads": final["threads"] - baseline["threads"],
+        "tmp_entries": final["tmp_entries"] - baseline["tmp_entries"],
+    }
+    failures = []
+    if measured_requests < args.min_requests:
+        failures.append(f"only {measured_requests} requests after warm-up (need {args.min_requests})")
+    if traced_per_request > args.max_bytes_per_request:
+        failures.append(f"traced memory grows {traced_per_request:.0f} B/request (max {args.max_bytes_per_request})")
+    if args.max_rss_bytes_per_request and rss_per_request > args.max_rss_bytes_per_request:
+        failures.append(f"RSS grows {rss_per_request:.0f} B/request (max {args.max_rss_bytes_per_request})")
+    if growth["fds"] > args.max_fd_growth:
+        failures.append(f"{growth['fds']} more open file descriptors than after warm-up")
+    if growth["threads"] > args.max_thread_growth:
+        failures.append(f"{growth['threads']} more threads than after warm-up")
+    if growth["tmp_entries"] > 0:
+        failures.append(f"{growth['tmp_entries']} temp entries left behind in {tmp_dir}")
+    if errors and not args.error_rate:
+        failures.append(f"{errors} failed requests without injected errors: {last_errors}")
+
+    top_growth = [
+        {"site": stat.traceback.format(most_recent_first=True), "size_diff": stat.size_diff, "count_diff": stat.count_diff}
+        for stat in final_snapshot.compare_to(baseline_snapshot, "traceback")[:args.top]
+        if stat.size_diff > 0
+    ]
+    report = {
+        "success": not failures,
+        "target": args.target,
+        "requests": requests,
+        "errors": errors,
+        "last_errors": last_errors,
+        "elapsed_s": final["elapsed_s"],
+        "baseline": baseline,
+        "final": final,
+        "growth": growth,
+        "failures": failures,
+        "top_growth": top_growth,
+        **target.report(),
+    }
+    if not args.keep_workdir:
+        import shutil
+        shutil.rmtree(workdir, ignore_errors=True)
+    else:
+        report["workdir"] = workdir
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak test: leak detection for the sign/verify paths")
+    parser.add_argument("--target", choices=sorted(TARGETS), default="manager")
+    parser.add_argument("--duration", type=float, default=600, help="Seconds to run after the warm-up")
+    parser.add_argument("--requests", type=int, default=0, help="Stop after this many requests (0: duration only)")
+    parser.add_argument("--warmup_requests", type=int, default=50, help="Requests before the baseline sample")
+    parser.add_argument("--sample_every", type=float, default=10, help="Seconds between samples")
+    parser.add_argument("--documents", type=int, default=20, help="Distinct document_ids to rotate through")
+    parser.add_argument("--pages", type=int, default=5, help="Pages of the synthetic PDF")
+    parser.add_argument("--latency_min", type=float, default=0.0, help="Fake Supabase latency range (manager)")
+    parser.add_argument("--latency_max", type=float, default=0.0)
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fake Supabase error probability (manager)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--max_bytes_per_request", type=float, default=1024, help="Traced memory growth budget")
+    parser.add_argument("--max_rss_bytes_per_request", type=float, default=0, help="RSS growth budget (0: report only)")
+    parser.add_argument("--max_fd_growth", type=int, default=2)
+    parser.add_argument("--max_thread_growth", type=int, default=2)
+    parser.add_argument("--min_requests", type=int, default=100, help="Requests needed after warm-up for a verdict")
+    parser.add_argument("--traceback_frames", type=int, default=1, help="tracemalloc frames per allocation")
+    parser.add_argument("--top", type=int, default=10, help="Allocation sites listed in the report")
+    parser.add_argument("--keep_workdir", action="store_true")
+    args = parser.parse_args()
+    if args.error_rate and args.target != "manager":
+        parser.error("--error_rate only applies to --target manager")
+
+    report = run(args)
+    print(json.dumps(report, indent=2, default=str))
+    sys.exit(0 if report["success"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Acceso a Supabase sin bloquear para DigitalSignatureManager.
+
+Cada operación que el gestor necesita de Supabase (consultas, altas y
+cambios en user_certificates, cambios en documents, subidas, descargas y
+borrados en el bucket certificates) es aquí una corrutina. Así el gestor se
+puede usar dentro de un servicio async sin bloquear su event loop, y las
+operaciones independientes (las subidas de certificado y clave de una
+emisión, las dos descargas previas a una firma) corren en paralelo.
+
+- Con URL y llave, las operaciones usan el AsyncClient de supabase, creado
+  una vez por cada event loop que lo usa: sus pools de conexiones HTTP se
+  comparten entre operaciones en vez de abrir una conexión por llamada.
+- Con un cliente síncrono inyectado (FakeSupabaseClient o un cliente
+  supabase síncrono), las operaciones corren en un pool de hilos acotado.
+
+En ambos casos hay como mucho `max_concurrency` operaciones en curso
+(SUPABASE_MAX_CONCURRENCY).
+
+El código síncrono (la CLI) usa `run_sync`, que ejecuta la corrutina en un
+loop privado en segundo plano con su propio cliente de larga vida, así que
+también reutiliza sus conexiones de una llamada a la siguiente.
+"""
+
+import asyncio
+import inspect
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MAX_CONCURRENCY = 16
+CERTIFICATES_BUCKET = "certificates"
+
+
+class SupabaseDataAccess:
+    def __init__(self, supabase_url=None, supabase_key=None, client=None, max_concurrency=None):
+        self.supabase_url = supabase_url
+        self.supabase_key = supabase_key
+        self.max_concurrency = max_concurrency or int(
+            os.getenv("SUPABASE_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)
+        )
+        self._sync_client = client
+        self._executor = (
+            ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="supabase")
+            if client is not None else None
+        )
+        self._loops = weakref.WeakKeyDictionary()  # loop -> _LoopState
+        self._portal = None
+        self._portal_loop = None
+        self._lock = threading.Lock()
+
+    # --- Event loops ---
+    def _state(self):
+        """
+        Estado por loop: las primitivas de asyncio y los pools de httpx no se pueden compartir
+        entre loops, así que cada loop que usa este objeto (el del servicio, el de run_sync)
+        tiene el suyo.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            state = self._loops.get(loop)
+            if state is None:
+                state = self._loops[loop] = _LoopState(self.max_concurrency)
+        return state
+
+    def run_sync(self, coroutine):
+        """
+        Ejecuta `coroutine` hasta terminar desde código síncrono y devuelve su resultado. Corre en
+        un loop privado en segundo plano, así que el cliente async y sus conexiones se reutilizan.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            coroutine.close()
+            raise RuntimeError("Llamada síncrona desde un event loop; usa el método async con await")
+        with self._lock:
+            if self._portal_loop is None:
+                self._portal_loop = asyncio.new_event_loop()
+                self._portal = threading.Thread(target=self._portal_loop.run_forever, name="supabase-loop", daemon=True)
+                self._portal.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._portal_loop).result()
+
+    # --- Ejecución ---
+    async def _client(self, state):
+        if self._sync_client is not None:
+            return self._sync_client
+        async with state.client_lock:
+            if state.client is None:
+                from supabase import acreate_client
+                state.client = await acreate_client(self.supabase_url, self.supabase_key)
+        return state.client
+
+    async def _run(self, operation):
+        """
+        `operation(client)` arma y ejecuta una solicitud. Con el cliente async devuelve un
+        awaitable; con un cliente síncrono bloquea, así que corre en el pool.
+        """
+        state = self._state()
+        async with state.semaphore:
+            client = await self._client(state)
+            if self._sync_client is not None:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, operation, client)
+            result = operation(client)
+            return await result if inspect.isawaitable(result) else result
+
+    async def run_blocking(self, function, *args):
+        """Trabajo de CPU o bloqueante alrededor de una solicitud (envolver llaves, KMS, firmar) fuera del event loop."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    # --- user_certificates ---
+    async def select_certificates(self, user_id, certificate_id=None, renewed_from_id=None, active_only=True):
+        def operation(client):
+            query = client.table("user_certificates").select("*").eq("user_id", user_id)
+            if active_only:
+                query = query.eq("is_active", True)
+            if certificate_id:
+                query = query.eq("id", certificate_id)
+            if renewed_from_id:
+                query = query.eq("renewed_from_id", renewed_from_id)
+            return query.execute()
+        return (await self._run(operation)).data or []
+
+    async def select_certificate_page(self, offset, limit):
+        """Página de todos los certificados (de todos los usuarios) en orden de id, para migraciones."""
+        return (await self._run(
+            lambda client: client.table("user_certificates").select("*").order("id")
+            .range(offset, offset + limit - 1).execute()
+        )).data or []
+
+    async def insert_certificates(self, rows):
+        return (await self._run(lambda client: client.table("user_certificates").insert(rows).execute())).data
+
+    async def update_certificate(self, certificate_id, values):
+        return (await self._run(
+            lambda client: client.table("user_certificates").update(values).eq("id", certificate_id).execute()
+        )).data
+
+    # --- documents ---
+    async def update_document(self, document_id, values):
+        return (await self._run(
+            lambda client: client.table("documents").update(values).eq("id", document_id).execute()
+        )).data
+
+    # --- Bucket certificates ---
+    async def upload(self, path, data, content_type):
+        return await self._run(
+            lambda client: client.storage.from_(CERTIFICATES_BUCKET).upload(path, data, {"content-type": content_type})
+        )
+
+    async def download(self, path):
+        return await self._run(lambda client: client.storage.from_(CERTIFICATES_BUCKET).download(path))
+
+    async def remove(self, paths):
+        return await self._run(lambda client: client.storage.from_(CERTIFICATES_BUCKET).remove(list(paths)))
+
+    # --- Cierre ---
+    async def aclose(self):
+        """Cierra el cliente async del loop que llama (desde el hook de apagado del servicio)."""
+        with self._lock:
+            state = self._loops.pop(asyncio.get_running_loop(), None)
+        if state is not None and state.client is not None:
+            for closer in (getattr(state.client.postgrest, "aclose", None), getattr(state.client.storage, "aclose", None)):
+                if closer is not None:
+                    await closer()
+
+    def close(self):
+        if self._portal_loop is not None:
+            self.run_sync(self.aclose())
+            self._portal_loop.call_soon_threadsafe(self._portal_loop.stop)
+            self._portal.join(timeout=5)
+            self._portal_loop.close()
+            self._portal = self._portal_loop = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+class _LoopState:
+    def __init__(self, max_concurrency):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.client_lock = asyncio.Lock()
+        self.client = None